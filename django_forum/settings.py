@@ -45,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'forumapp.metrics.MetricsMiddleware',
+    'forumapp.routers.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,9 +84,32 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+
+        # Keep connections open between requests, checking them before reuse
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+
+        # Tests run against a file so that concurrent writers wait for the
+        # lock instead of failing like they do on a shared in-memory database
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
+    },
+
+    # A read replica, for local testing a copy of the primary refreshed by
+    # "manage.py snapshot_replica --interval 5". List it in FORUM_READ_REPLICAS
+    # to use it; tests read the primary through it.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db_replica.sqlite3'),
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
 }
 
+DATABASE_ROUTERS = ['forumapp.routers.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -123,3 +148,68 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Forum
+
+# Number of channels, threads or comments shown per page
+FORUM_PAGE_SIZE = 50
+
+# Cache alias and timeout (seconds) of rendered channel, thread and comment
+# listings; a timeout of 0 turns the fragment cache off
+FORUM_FRAGMENT_CACHE = 'default'
+FORUM_FRAGMENT_TIMEOUT = 600
+
+# Write the channel rows of new comments (counters, last comment, recent_date)
+# in batches instead of with every post: after a request once the oldest waited
+# FORUM_TOUCH_INTERVAL seconds, and at the latest after FORUM_TOUCH_MAX_STALENESS
+# seconds
+FORUM_TOUCH_BUFFER = False
+FORUM_TOUCH_INTERVAL = 0.25
+FORUM_TOUCH_MAX_STALENESS = 2.0
+
+# Record request metrics per URL name, served to staff at /metrics; scrapers
+# can authenticate with "Authorization: Bearer <FORUM_METRICS_TOKEN>" instead
+FORUM_METRICS = True
+FORUM_METRICS_TOKEN = None
+
+# Database aliases the channel, thread, comment, user and favorites pages read
+# from, and how long (seconds) users read from the primary after they post
+FORUM_READ_REPLICAS = []
+FORUM_PRIMARY_PIN_SECONDS = 5
+
+# Pragmas set on every new SQLite connection on top of the defaults in
+# forumapp/sqlite.py (WAL, synchronous=normal, a 20 MB page cache, 128 MB of
+# memory mapped I/O and waiting up to 5 s for locks); None leaves one out.
+# Writes in the forum views are retried FORUM_LOCK_RETRIES times with jittered
+# backoff starting at FORUM_LOCK_RETRY_DELAY seconds when the database stays
+# locked.
+FORUM_SQLITE_PRAGMAS = {}
+FORUM_LOCK_RETRIES = 5
+FORUM_LOCK_RETRY_DELAY = 0.05
+
+# Deleted channels and threads are hidden at once and their rows deleted by a
+# background thread, FORUM_PURGE_CHUNK_SIZE rows per transaction with
+# FORUM_PURGE_PAUSE seconds in between. Without FORUM_PURGE_IN_BACKGROUND,
+# run "manage.py drain_purges" (e.g. from cron) instead.
+FORUM_PURGE_IN_BACKGROUND = True
+FORUM_PURGE_CHUNK_SIZE = 500
+FORUM_PURGE_PAUSE = 0.05
+
+# Admin change forms show this many child rows inline and link to the rest
+FORUM_ADMIN_INLINE_LIMIT = 20
+
+# Live comment streams: at most FORUM_LIVE_MAX_CONNECTIONS listeners per
+# process, a heartbeat after FORUM_LIVE_HEARTBEAT quiet seconds, streams and
+# long polls end after FORUM_LIVE_TIMEOUT seconds, and a listener more than
+# FORUM_LIVE_BACKLOG comments behind catches up from the database
+FORUM_LIVE_MAX_CONNECTIONS = 100
+FORUM_LIVE_HEARTBEAT = 15
+FORUM_LIVE_TIMEOUT = 300
+FORUM_LIVE_BACKLOG = 100
+
+# Largest page the JSON API returns for ?limit=
+FORUM_API_MAX_PAGE_SIZE = 100
+
+# Rows read per query by NDJSON exports
+FORUM_EXPORT_CHUNK_SIZE = 1000
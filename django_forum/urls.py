@@ -16,10 +16,12 @@ Including another URLconf
 from django.urls import path, include
 from django.contrib import admin
 from django.views.generic.base import TemplateView
+from forumapp.views import MetricsView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('forum/', include('forumapp.urls')),
     path('registration/', include('registration.urls')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     path('', TemplateView.as_view(template_name='index.html'), name='welcome')
 ]
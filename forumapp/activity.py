@@ -0,0 +1,48 @@
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+## Recompute the activity counters and last comment snapshots of every
+## channel (or only the named ones) and their threads from the child tables.
+## Takes the models as arguments so migrations can pass historical ones.
+def recount_activity(Channel, Thread, Comment, channel_names=None):
+    channels = Channel.objects.all()
+    threads = Thread.objects.all()
+
+    if channel_names is not None:
+        channels = channels.filter(channel_name__in=channel_names)
+        threads = threads.filter(channel__in=channel_names)
+
+    comments = Comment.objects.filter(thread=OuterRef('pk'))
+    latest = comments.order_by('-pub_date', '-comment_id')
+
+    threads.update(
+        comment_count=Coalesce(Subquery(comments.order_by().values('thread') \
+                .annotate(count=Count('*')).values('count')), 0),
+        last_comment_id=Subquery(latest.values('comment_id')[:1]),
+        last_comment_owner=Subquery(latest.values('owner')[:1]),
+        last_comment_date=Subquery(latest.values('pub_date')[:1]),
+    )
+
+    channels.update(**channel_updates(Thread))
+
+## Return update() arguments recomputing channels' thread and comment counters
+## and last comment snapshots from their threads' own
+def channel_updates(Thread):
+    children = Thread.objects.filter(channel=OuterRef('pk')).order_by()
+
+    # hidden threads left the counters when they were hidden (the models of
+    # migrations before 0008 have none)
+    if any(field.name == 'hidden_date' for field in Thread._meta.fields):
+        children = children.filter(hidden_date=None)
+    latest = children.filter(last_comment_date__isnull=False).order_by('-last_comment_date')
+
+    return {
+        'thread_count': Coalesce(Subquery(children.values('channel') \
+                .annotate(count=Count('*')).values('count')), 0),
+        'comment_count': Coalesce(Subquery(children.values('channel') \
+                .annotate(count=Sum('comment_count')).values('count')), 0),
+        'last_thread_id': Subquery(latest.values('thread_id')[:1]),
+        'last_comment_id': Subquery(latest.values('last_comment_id')[:1]),
+        'last_comment_owner': Subquery(latest.values('last_comment_owner')[:1]),
+        'last_comment_date': Subquery(latest.values('last_comment_date')[:1]),
+    }
@@ -1,54 +1,156 @@
+from django.conf import settings
 from django.contrib import admin
-from .models import Channel, Thread, Comment
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import User
+from django.forms.models import BaseInlineFormSet
+from django.urls import reverse
+from django.utils.html import format_html
+from django.utils.http import urlencode
+from .models import Channel, ChannelMembership, Thread, Comment
+from .pagination import EstimatedCountPaginator
+from . import ownership, search
 # Register your models here.
 
-class ThreadInline(admin.TabularInline):
+def get_inline_limit():
+    return getattr(settings, 'FORUM_ADMIN_INLINE_LIMIT', 20)
+
+# Shows only the first FORUM_ADMIN_INLINE_LIMIT rows of an inline, in the
+# inline's ordering, so a parent with thousands of children still opens; the
+# parent links to the full list in the changelist
+class CappedInlineFormSet(BaseInlineFormSet):
+
+    def get_queryset(self):
+        if not hasattr(self, '_capped_queryset'):
+            self._capped_queryset = super(CappedInlineFormSet, self).get_queryset()[:get_inline_limit()]
+
+        return self._capped_queryset
+
+## Return a link to the changelist of model filtered on field=value, for
+## children that don't all fit in a capped inline
+def children_link(model, field, value, count, noun):
+    if value is None:
+        return '-'
+
+    url = reverse('admin:forumapp_%s_changelist' % model._meta.model_name) + '?' + urlencode({field: value})
+
+    if count > get_inline_limit():
+        return format_html('Showing {} of {} {}. <a href="{}">See all</a>', get_inline_limit(), count, noun, url)
+
+    return format_html('<a href="{}">{} {}</a>', url, count, noun)
+
+# Changelist settings for tables too big to count or sort: estimated counts,
+# no extra unfiltered count, newest rows first in primary key order
+class BigTableAdminMixin(object):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ('-pk',)
+
+# Inline rows show their owner read-only from a join, instead of a widget
+# that looks up each row's owner on its own
+class OwnedInlineMixin(object):
+    readonly_fields = ('owner',)
+
+    def get_queryset(self, request):
+        return super(OwnedInlineMixin, self).get_queryset(request).select_related('owner')
+
+class ThreadInline(OwnedInlineMixin, admin.TabularInline):
     model = Thread
+    formset = CappedInlineFormSet
     extra = 3
 
-class CommentInline(admin.TabularInline):
+    fields = ('thread_id', 'thread_name', 'description', 'owner', 'pub_date')
+    readonly_fields = ('thread_id', 'owner')
+    show_change_link = True
+
+class ChannelMembershipInline(admin.TabularInline):
+    model = ChannelMembership
+    formset = CappedInlineFormSet
+    extra = 1
+
+    raw_id_fields = ('user',)
+
+class CommentInline(OwnedInlineMixin, admin.TabularInline):
     model = Comment
+    formset = CappedInlineFormSet
     extra = 3
 
-class ChannelAdmin(admin.ModelAdmin):
+    fields = ('comment_id', 'text', 'owner', 'pub_date')
+    readonly_fields = ('comment_id', 'owner')
+
+class ChannelAdmin(BigTableAdminMixin, admin.ModelAdmin):
     fieldsets = [
-        (None,               {'fields': ['channel_name', 'description']}),
+        (None,               {'fields': ['channel_name', 'description', 'threads']}),
         ('Date Information', {'fields': ['pub_date']}),
         ('Owner',            {'fields': ['owner']}),
-        ('Moderators',       {'fields': ['moderators']}),
-        ('Banned',           {'fields': ['banned_users']}),
     ]
 
-    inlines = [ThreadInline]
+    inlines = [ChannelMembershipInline, ThreadInline]
+    readonly_fields = ('threads',)
+    raw_id_fields = ('owner',)
 
-    list_display = ('channel_name', 'description', 'owner', 'moderators', 'banned_users', 'pub_date', 'is_recent')
+    list_display = ('channel_name', 'description', 'owner', 'pub_date', 'is_recent')
     list_filter = ['pub_date']
+    list_select_related = ('owner',)
     search_fields = ['channel_name']
 
-class ThreadAdmin(admin.ModelAdmin):
+    def threads(self, obj):
+        return children_link(Thread, 'channel', obj.pk, obj.thread_count, 'threads')
+
+class ThreadAdmin(BigTableAdminMixin, admin.ModelAdmin):
     fieldsets = [
-        (None,              {'fields': ['channel', 'thread_name', 'description']}),
+        (None,              {'fields': ['channel', 'thread_name', 'description', 'comments']}),
         ('Date Information',{'fields': ['pub_date']}),
         ('Owner',           {'fields': ['owner']}),
     ]
 
     inlines = [CommentInline]
+    readonly_fields = ('comments',)
+    raw_id_fields = ('channel', 'owner')
 
     list_display = ('thread_name', 'thread_id', 'channel', 'description', 'owner', 'pub_date', 'is_recent')
     list_filter = ['pub_date']
+    list_select_related = ('channel', 'owner')
     search_fields = ['thread_name']
 
-class CommentAdmin(admin.ModelAdmin):
+    def comments(self, obj):
+        return children_link(Comment, 'thread', obj.pk, obj.comment_count, 'comments')
+
+    # use the full-text index instead of LIKE scans where it exists
+    def get_search_results(self, request, queryset, search_term):
+        if search_term and search.is_available():
+            return search.filter_matching(queryset, search_term, threads=True), False
+
+        return super(ThreadAdmin, self).get_search_results(request, queryset, search_term)
+
+class CommentAdmin(BigTableAdminMixin, admin.ModelAdmin):
     fieldsets = [
         (None,               {'fields': ['thread', 'comment_id', 'text']}),
         ('Date Information', {'fields': ['pub_date']}),
         ('Owner'           , {'fields': ['owner']}),
     ]
 
+    raw_id_fields = ('thread', 'owner')
+
     list_display = ('text','comment_id', 'thread', 'owner', 'pub_date', 'is_recent')
     list_filter = ['pub_date']
+    list_select_related = ('thread', 'owner')
     search_fields = ['text']
 
+    # use the full-text index instead of LIKE scans where it exists
+    def get_search_results(self, request, queryset, search_term):
+        if search_term and search.is_available():
+            return search.filter_matching(queryset, search_term), False
+
+        return super(CommentAdmin, self).get_search_results(request, queryset, search_term)
+
+# Bulk deletes reassign the users' channels in one pass (see ownership.py)
+class ForumUserAdmin(UserAdmin):
+
+    def delete_queryset(self, request, queryset):
+        ownership.delete_users(queryset)
+
 admin.site.register(Channel, ChannelAdmin)
 admin.site.register(Thread, ThreadAdmin)
 admin.site.register(Comment, CommentAdmin)
+admin.site.unregister(User)
+admin.site.register(User, ForumUserAdmin)
@@ -0,0 +1,106 @@
+from django.conf import settings
+from django.http import JsonResponse
+from .models import Channel, Thread, Comment
+from .pagination import KeysetPaginator, InvalidCursor
+
+# Read-only JSON API, version 1. Listings are read with .values() and written
+# out as they come, without model instances, templates or template tags.
+# ?fields=a,b picks the fields of each row (all of them by default) and pages
+# are keyset pages in the HTML views' order, walked by passing the returned
+# next or previous cursor as ?after= or ?before=.
+
+VERSION = 1
+
+# The fields each kind of row can have, in the order they're written out.
+# Foreign keys are written as their value: owners as usernames.
+FIELDS = {
+    Channel: ('channel_name', 'description', 'owner', 'pub_date', 'recent_date', 'pin_date', 'thread_count', \
+            'comment_count', 'last_thread_id', 'last_comment_id', 'last_comment_owner', 'last_comment_date'),
+    Thread: ('thread_id', 'thread_name', 'description', 'owner', 'pub_date', 'recent_date', 'pin_date', \
+            'comment_count', 'last_comment_id', 'last_comment_owner', 'last_comment_date'),
+    Comment: ('comment_id', 'text', 'owner', 'pub_date'),
+}
+
+def get_max_page_size():
+    return getattr(settings, 'FORUM_API_MAX_PAGE_SIZE', 100)
+
+# A bad request, answered with its message and status
+class ApiError(Exception):
+
+    def __init__(self, message, status=400):
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+## Return a compact JSON response
+def render(data, status=200):
+    return JsonResponse(data, status=status, json_dumps_params={'separators': (',', ':')})
+
+def error(message, status):
+    return render({'error': message}, status=status)
+
+## Return [(name, column)] of the fields named in ?fields= (comma separated),
+## or of all the model's fields when it's empty
+def get_fields(model, requested):
+    names = FIELDS[model]
+
+    if requested:
+        chosen = list(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+        unknown = [name for name in chosen if name not in names]
+
+        if unknown:
+            raise ApiError("Unknown fields: %s. Choose from %s." % (', '.join(unknown), ', '.join(names)))
+
+        names = chosen
+
+    return [(name, model._meta.get_field(name).attname) for name in names]
+
+## Return the page size asked for in ?limit=, FORUM_PAGE_SIZE by default and
+## at most FORUM_API_MAX_PAGE_SIZE
+def get_page_size(limit):
+    if not limit:
+        return min(getattr(settings, 'FORUM_PAGE_SIZE', 50), get_max_page_size())
+
+    try:
+        size = int(limit)
+
+    except ValueError:
+        raise ApiError("Invalid limit.")
+
+    if size < 1:
+        raise ApiError("Invalid limit.")
+
+    return min(size, get_max_page_size())
+
+## Read the keyset page of queryset asked for in params (fields, limit, after
+## and before) with one query for just the chosen columns and the ordering keys.
+## Returns {'results': [rows], 'next': cursor, 'previous': cursor}.
+def read_page(queryset, ordering, params):
+    model = queryset.model
+    fields = get_fields(model, params.get('fields'))
+
+    columns = [column for name, column in fields]
+    columns += [model._meta.get_field(key.lstrip('-')).attname for key in ordering]
+
+    paginator = KeysetPaginator(queryset.values(*dict.fromkeys(columns)), ordering, \
+            get_page_size(params.get('limit')))
+
+    try:
+        page = paginator.page(after=params.get('after'), before=params.get('before'))
+
+    except InvalidCursor:
+        raise ApiError("Invalid cursor.")
+
+    return {
+        'results': [{name: row[column] for name, column in fields} for row in page],
+        'next': page.next_cursor,
+        'previous': page.previous_cursor,
+    }
+
+## What the viewer may do in a channel, as the HTML pages show it: banned
+## users can't post, moderators and staff get the moderation tools
+def describe_permissions(user, permissions):
+    return {
+        'banned': permissions.is_banned,
+        'can_post': user.is_authenticated and not permissions.is_banned,
+        'can_moderate': user.is_staff or permissions.is_moderator,
+    }
@@ -0,0 +1,156 @@
+import json, zlib
+from django.conf import settings
+from .models import Channel, Thread, Comment
+from .pagination import CursorEncoder
+
+# Export of channels with their threads and comments as NDJSON: one JSON
+# object per line, each channel followed by its threads in thread_id order and
+# each thread by its comments in comment_id order. Every line says where it
+# belongs:
+#
+#   {"type": "channel", "channel_name": ..., ...}
+#   {"type": "thread", "channel": ..., "thread_id": ..., ...}
+#   {"type": "comment", "channel": ..., "thread": ..., "comment_id": ..., ...}
+#
+# Rows are read with keyset queries of FORUM_EXPORT_CHUNK_SIZE rows, so memory
+# use doesn't depend on the size of the forum. An export can resume after the
+# position (channel, thread_id, comment_id) of the last line it wrote; rows
+# written meanwhile show up if they come after that position. Hidden channels
+# and threads are left out.
+
+CHANNEL_FIELDS = ('channel_name', 'description', 'owner', 'pub_date', 'recent_date', 'pin_date', 'thread_seq', \
+        'thread_count', 'comment_count', 'last_thread_id', 'last_comment_id', 'last_comment_owner', 'last_comment_date')
+THREAD_FIELDS = ('thread_id', 'thread_name', 'description', 'owner', 'pub_date', 'recent_date', 'pin_date', \
+        'comment_seq', 'comment_count', 'last_comment_id', 'last_comment_owner', 'last_comment_date')
+COMMENT_FIELDS = ('comment_id', 'text', 'owner', 'pub_date')
+
+def get_chunk_size():
+    return getattr(settings, 'FORUM_EXPORT_CHUNK_SIZE', 1000)
+
+## Parse a position "channel[:thread_id[:comment_id]]", or "thread_id[:comment_id]"
+## within channel. Returns (channel, thread_id, comment_id) with None for the
+## parts left out; raises ValueError when it's malformed.
+def parse_position(text, channel=None):
+    parts = text.split(':')
+
+    if channel is not None:
+        parts.insert(0, channel)
+
+    if not parts[0] or len(parts) > 3:
+        raise ValueError("Invalid position %r" % text)
+
+    numbers = [int(part) for part in parts[1:]]
+    return tuple([parts[0]] + numbers + [None] * (2 - len(numbers)))
+
+## Return the position of an exported record, to resume after it
+def get_position(record):
+    if record['type'] == 'channel':
+        return (record['channel_name'], None, None)
+
+    if record['type'] == 'thread':
+        return (record['channel'], record['thread_id'], None)
+
+    return (record['channel'], record['thread'], record['comment_id'])
+
+def format_position(position):
+    return ':'.join(str(part) for part in position if part is not None)
+
+## Yield the rows of queryset (values of columns) in order of key, reading
+## chunk_size rows per query
+def chunked(queryset, key, columns, chunk_size):
+    queryset = queryset.order_by(key).values(*columns)
+    after = None
+
+    while True:
+        rows = list((queryset if after is None else queryset.filter(**{key + '__gt': after}))[:chunk_size])
+
+        for row in rows:
+            yield row
+
+        if len(rows) < chunk_size:
+            return
+
+        after = rows[-1][key]
+
+def _record(kind, row, fields, **parents):
+    record = {'type': kind}
+    record.update(parents)
+    record.update((name, row[column]) for name, column in fields)
+
+    return record
+
+def _fields(model, names):
+    return [(name, model._meta.get_field(name).attname) for name in names]
+
+## Yield the records of one channel (a name) or of all channels, after the
+## position after (see parse_position) if given
+def records(channel=None, after=None, chunk_size=None):
+    chunk_size = chunk_size or get_chunk_size()
+    start_channel, start_thread, start_comment = after or (None, None, None)
+
+    channel_fields = _fields(Channel, CHANNEL_FIELDS)
+    thread_fields = _fields(Thread, THREAD_FIELDS)
+    comment_fields = _fields(Comment, COMMENT_FIELDS)
+
+    channels = Channel.objects.filter(hidden_date=None)
+
+    if channel is not None:
+        channels = channels.filter(pk=channel)
+
+    if start_channel is not None:
+        channels = channels.filter(pk__gte=start_channel)
+
+    for channel_row in chunked(channels, 'channel_name', [column for name, column in channel_fields], chunk_size):
+        name = channel_row['channel_name']
+        resuming = name == start_channel
+
+        if not resuming:
+            yield _record('channel', channel_row, channel_fields)
+
+        threads = Thread.objects.filter(channel_id=name, hidden_date=None)
+
+        if resuming and start_thread is not None:
+            threads = threads.filter(thread_id__gte=start_thread)
+
+        for thread_row in chunked(threads, 'thread_id', ['pk'] + [column for _, column in thread_fields], chunk_size):
+            thread_id = thread_row['thread_id']
+            comments = Comment.objects.filter(thread_id=thread_row['pk'])
+
+            if resuming and thread_id == start_thread:
+                if start_comment is not None:
+                    comments = comments.filter(comment_id__gt=start_comment)
+
+            else:
+                yield _record('thread', thread_row, thread_fields, channel=name)
+
+            for comment_row in chunked(comments, 'comment_id', [column for _, column in comment_fields], chunk_size):
+                yield _record('comment', comment_row, comment_fields, channel=name, thread=thread_id)
+
+## Encode records as NDJSON bytes, gzip-compressed if compress, in chunks of
+## about buffer_size bytes
+def ndjson(records, compress=False, buffer_size=65536):
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer, size = [], 0
+
+    for record in records:
+        line = (json.dumps(record, cls=CursorEncoder, separators=(',', ':')) + '\n').encode()
+        buffer.append(line)
+        size += len(line)
+
+        if size >= buffer_size:
+            data = b''.join(buffer)
+            buffer, size = [], 0
+
+            if compressor is not None:
+                data = compressor.compress(data)
+
+            if data:
+                yield data
+
+    data = b''.join(buffer)
+
+    if compressor is not None:
+        data = compressor.compress(data) + compressor.flush()
+
+    if data:
+        yield data
@@ -0,0 +1,146 @@
+import hashlib, threading, time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+# Rendered listings are cached under keys that include a version number of
+# the channel or thread they belong to. Changing a channel or thread bumps
+# its version, so every fragment rendered from the old data stops matching
+# at once and simply ages out of the cache; nothing has to be enumerated.
+#
+# Versions start at a timestamp rather than 1, so a version key that was
+# evicted can't come back at a number old fragments were stored under.
+
+VERSION_PREFIX = 'forumapp:version:'
+FRAGMENT_PREFIX = 'forumapp:fragment:'
+
+# Version bumped for every fragment at once, e.g. after bulk updates
+GLOBAL = ('all', '')
+
+# viewer roles fragments are rendered for
+ANONYMOUS = 'anonymous'
+MEMBER = 'member'
+MODERATOR = 'moderator'
+STAFF = 'staff'
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+def get_cache():
+    return caches[getattr(settings, 'FORUM_FRAGMENT_CACHE', 'default')]
+
+def get_timeout():
+    return getattr(settings, 'FORUM_FRAGMENT_TIMEOUT', 600)
+
+def version_key(kind, ident):
+    return '%s%s:%s' % (VERSION_PREFIX, kind, ident)
+
+def _new_version():
+    return int(time.time() * 1000)
+
+## Bump the version of a channel ('channel', name) or thread ('thread', pk)
+def bump_version(kind, ident):
+    cache = get_cache()
+    key = version_key(kind, ident)
+
+    try:
+        cache.incr(key)
+
+    except ValueError:
+        cache.set(key, _new_version(), None)
+
+## Bump a version now and again once the current transaction commits, so a
+## page rendered from the uncommitted rows in between can't stay cached
+def invalidate(kind, ident, using=None):
+    bump_version(kind, ident)
+
+    if transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(lambda: bump_version(kind, ident), using=using)
+
+def invalidate_all():
+    bump_version(*GLOBAL)
+
+## Look up versions for many channels or threads with one cache call and
+## remember them for the rest of the request
+def preload_versions(request, kind, idents):
+    versions = _request_versions(request)
+    keys = {version_key(kind, ident): (kind, ident) for ident in idents}
+    keys[version_key(*GLOBAL)] = GLOBAL
+
+    missing = [key for key, pair in keys.items() if pair not in versions]
+    found = get_cache().get_many(missing) if missing else {}
+
+    for key in missing:
+        versions[keys[key]] = found.get(key)
+
+def get_version(request, kind, ident):
+    versions = _request_versions(request)
+
+    if (kind, ident) not in versions:
+        preload_versions(request, kind, [ident])
+
+    # first use: start the version so later bumps have something to incr
+    if versions[(kind, ident)] is None:
+        cache = get_cache()
+        cache.add(version_key(kind, ident), _new_version(), None)
+        versions[(kind, ident)] = cache.get(version_key(kind, ident))
+
+    return versions[(kind, ident)]
+
+def _request_versions(request):
+    versions = getattr(request, '_forum_fragment_versions', None)
+
+    if versions is None:
+        versions = {}
+        request._forum_fragment_versions = versions
+
+    return versions
+
+## Return the viewer's role for a fragment; channel_name narrows members down
+## to moderators of that channel
+def get_role(user, channel_name=None):
+    if not user.is_authenticated:
+        return ANONYMOUS
+
+    if user.is_staff:
+        return STAFF
+
+    if channel_name:
+        from .permissions import get_channel_permissions
+
+        if get_channel_permissions(user, channel_name).is_moderator:
+            return MODERATOR
+
+    return MEMBER
+
+def fragment_key(name, parts, role, versions):
+    raw = ':'.join(str(part) for part in list(parts) + list(versions))
+    digest = hashlib.md5(raw.encode()).hexdigest()
+
+    return '%s%s:%s:%s' % (FRAGMENT_PREFIX, name, role, digest)
+
+def get_fragment(key):
+    html = get_cache().get(key)
+    _count('hits' if html is not None else 'misses')
+    return html
+
+def set_fragment(key, html):
+    get_cache().set(key, html, get_timeout())
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+## Hit and miss counts of this process since it started (or reset_stats)
+def get_stats():
+    with _lock:
+        stats = dict(_stats)
+
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / total if total else 0.0
+    return stats
+
+def reset_stats():
+    with _lock:
+        _stats['hits'] = 0
+        _stats['misses'] = 0
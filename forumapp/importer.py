@@ -0,0 +1,318 @@
+import csv, datetime, gzip, json
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from . import fragments
+from .activity import recount_activity
+from .models import Channel, Thread, Comment, allocate_ids
+
+# Bulk import of channels, threads and comments from the records written by
+# export.py, as NDJSON or as CSV with the same keys for columns. Threads must
+# come after their channel (or name one that exists) and comments after their
+# thread, which records refer to by its thread_id in the source.
+#
+# Nothing goes through save(): rows are collected into batches, thread ids are
+# reserved per channel with one update and handed out in memory, comment ids
+# are counted in memory, and each batch is written with bulk_create in its own
+# transaction. Owners are looked up by username once per batch for the names
+# not seen yet. The counters, last comment snapshots, id sequences and dates
+# of activity are filled in by a few set-based updates at the end.
+
+# rows per statement in the final updates, below SQLite's parameter limit
+UPDATE_BATCH_SIZE = 500
+
+# A record that can't be imported, with the line of the input it came from
+class InvalidRecord(ValueError):
+
+    def __init__(self, message, line=None):
+        super(InvalidRecord, self).__init__(message if line is None else "Line %d: %s" % (line, message))
+        self.line = line
+
+def _batches(items, size=UPDATE_BATCH_SIZE):
+    items = list(items)
+
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+
+    return open(path, encoding='utf-8', newline='')
+
+## Yield (line number, record) of an NDJSON file, gzip-compressed if its name
+## ends in .gz
+def read_ndjson(path):
+    with _open(path) as lines:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line)
+
+            except ValueError as e:
+                raise InvalidRecord("Invalid JSON: %s" % e, number)
+
+            if not isinstance(record, dict):
+                raise InvalidRecord("Expected an object", number)
+
+            yield number, record
+
+## Yield (line number, record) of a CSV file with a header row, leaving out
+## empty cells
+def read_csv(path):
+    with _open(path) as rows:
+        reader = csv.DictReader(rows)
+
+        for row in reader:
+            yield reader.line_num, {key: value for key, value in row.items() if key and value not in ('', None)}
+
+## Return the reader for a file: CSV for .csv (or .csv.gz) files, NDJSON otherwise
+def get_reader(path, format=None):
+    format = format or ('csv' if path[:-3 if path.endswith('.gz') else None].endswith('.csv') else 'ndjson')
+    return read_csv if format == 'csv' else read_ndjson
+
+class Importer(object):
+
+    def __init__(self, batch_size=5000, create_users=False, progress=None):
+        self.batch_size = batch_size
+        self.create_users = create_users
+        self.progress = progress
+
+        # usernames known to exist or to be missing
+        self.users = {}
+        # channel name -> whether it's created by this import
+        self.channels = {}
+        # (channel, source thread_id) -> pk once written, the Thread before
+        self.threads = {}
+        # (channel, source thread_id) -> next comment_id
+        self.next_comment = {}
+        self.imported_threads = []
+
+        self.pending_channels, self.pending_threads, self.pending_comments = [], [], []
+        self.counts = {'channels': 0, 'threads': 0, 'comments': 0, 'users': 0, 'missing_owners': 0}
+
+    def convert(self, model, name, record, line, required=False):
+        value = record.get(name)
+
+        if value is None:
+            if required:
+                raise InvalidRecord("%s is missing %r" % (record.get('type'), name), line)
+
+            return None
+
+        field = model._meta.get_field(name)
+
+        try:
+            value = field.to_python(value)
+
+        except ValidationError as e:
+            raise InvalidRecord("Invalid %s %r: %s" % (name, value, '; '.join(e.messages)), line)
+
+        if isinstance(value, datetime.datetime) and timezone.is_naive(value):
+            value = timezone.make_aware(value)
+
+        return value
+
+    # (channel, source thread_id) of a thread, from a thread record's
+    # thread_id or a comment record's thread
+    def thread_key(self, record, name, line):
+        value = record.get(name)
+
+        try:
+            return (record.get('channel'), int(value))
+
+        except (TypeError, ValueError):
+            raise InvalidRecord("Invalid %s %r" % (name, value), line)
+
+    def check_channel(self, name, line):
+        if name is None:
+            raise InvalidRecord("Record is missing 'channel'", line)
+
+        if name not in self.channels:
+            if not Channel.objects.filter(pk=name, hidden_date=None).exists():
+                raise InvalidRecord("Unknown channel %r" % name, line)
+
+            self.channels[name] = False
+
+    ## Queue one record, writing a batch when it's full
+    def add(self, record, line=None):
+        kind = record.get('type')
+
+        if kind == 'comment':
+            self.add_comment(record, line)
+
+        elif kind == 'thread':
+            self.add_thread(record, line)
+
+        elif kind == 'channel':
+            self.add_channel(record, line)
+
+        else:
+            raise InvalidRecord("Unknown record type %r" % kind, line)
+
+        if max(len(self.pending_channels), len(self.pending_threads), len(self.pending_comments)) >= self.batch_size:
+            self.flush()
+
+    # A channel that exists already gets the threads that follow; only new
+    # ones take the record's fields
+    def add_channel(self, record, line):
+        name = self.convert(Channel, 'channel_name', record, line, required=True)
+
+        if name in self.channels:
+            raise InvalidRecord("Channel %r appears twice" % name, line)
+
+        if Channel.objects.filter(pk=name).exists():
+            self.check_channel(name, line)
+            return
+
+        pub_date = self.convert(Channel, 'pub_date', record, line) or timezone.now()
+        self.channels[name] = True
+        self.pending_channels.append(Channel(channel_name=name, owner_id=record.get('owner'), \
+                description=self.convert(Channel, 'description', record, line) or '', \
+                pin_date=self.convert(Channel, 'pin_date', record, line), pub_date=pub_date, recent_date=pub_date))
+
+    def add_thread(self, record, line):
+        channel = record.get('channel')
+        self.check_channel(channel, line)
+
+        key = self.thread_key(record, 'thread_id', line)
+        if key in self.next_comment:
+            raise InvalidRecord("Thread %s:%d appears twice" % key, line)
+
+        pub_date = self.convert(Thread, 'pub_date', record, line) or timezone.now()
+        thread = Thread(channel_id=channel, owner_id=record.get('owner'), \
+                thread_name=self.convert(Thread, 'thread_name', record, line, required=True), \
+                description=self.convert(Thread, 'description', record, line) or '', \
+                pin_date=self.convert(Thread, 'pin_date', record, line), pub_date=pub_date, recent_date=pub_date)
+        thread.import_key = key
+
+        self.threads[key] = thread
+        self.next_comment[key] = 0
+        self.pending_threads.append(thread)
+
+    def add_comment(self, record, line):
+        key = self.thread_key(record, 'thread', line)
+
+        if key not in self.next_comment:
+            raise InvalidRecord("Comment of unknown thread %s:%s" % key, line)
+
+        comment = Comment(owner_id=record.get('owner'), comment_id=self.next_comment[key], \
+                text=self.convert(Comment, 'text', record, line, required=True), \
+                pub_date=self.convert(Comment, 'pub_date', record, line) or timezone.now())
+
+        # the thread, or its pk once it's written
+        thread = self.threads[key]
+        if isinstance(thread, Thread):
+            comment.thread = thread
+        else:
+            comment.thread_id = thread
+
+        self.next_comment[key] += 1
+        self.pending_comments.append(comment)
+
+    ## Point each row's owner at its user, looking up the usernames not seen
+    ## before with one query; unknown owners are created or left empty
+    def resolve_owners(self, rows):
+        unseen = {row.owner_id for row in rows if row.owner_id is not None and row.owner_id not in self.users}
+
+        for batch in _batches(unseen):
+            self.users.update((name, True) for name in User.objects.filter(username__in=batch) \
+                    .values_list('username', flat=True))
+
+        missing = [name for name in unseen if name not in self.users]
+
+        if missing and self.create_users:
+            password = make_password(None)
+            User.objects.bulk_create([User(username=name, password=password) for name in missing], \
+                    batch_size=self.batch_size)
+            self.counts['users'] += len(missing)
+
+        self.users.update((name, self.create_users) for name in missing)
+
+        for row in rows:
+            if row.owner_id is not None and not self.users[row.owner_id]:
+                row.owner_id = None
+                self.counts['missing_owners'] += 1
+
+    ## Write the queued rows in one transaction
+    def flush(self):
+        channels, threads, comments = self.pending_channels, self.pending_threads, self.pending_comments
+        self.pending_channels, self.pending_threads, self.pending_comments = [], [], []
+
+        with transaction.atomic():
+            self.resolve_owners(channels + threads + comments)
+            Channel.objects.bulk_create(channels, batch_size=self.batch_size)
+
+            by_channel = {}
+            for thread in threads:
+                by_channel.setdefault(thread.channel_id, []).append(thread)
+
+            # reserve each channel's thread ids at once
+            for name, channel_threads in by_channel.items():
+                ids = allocate_ids(Channel.objects.filter(pk=name), 'thread_seq', len(channel_threads))
+
+                for thread, thread_id in zip(channel_threads, ids):
+                    thread.thread_id = thread_id
+
+            Thread.objects.bulk_create(threads, batch_size=self.batch_size)
+            Comment.objects.bulk_create(comments, batch_size=self.batch_size)
+
+        # later comments refer to written threads by pk
+        for thread in threads:
+            self.threads[thread.import_key] = thread.pk
+            self.imported_threads.append(thread.pk)
+
+        self.counts['channels'] += len(channels)
+        self.counts['threads'] += len(threads)
+        self.counts['comments'] += len(comments)
+
+        if self.progress is not None:
+            self.progress.add(len(channels) + len(threads) + len(comments))
+
+    ## Fill in what the bulk inserts skipped for the imported rows: counters
+    ## and last comments, comment_seq and the dates of last activity
+    def finish(self):
+        next_comment = Comment.objects.filter(thread=OuterRef('pk')).order_by().values('thread') \
+                .annotate(next=models.Max('comment_id') + 1).values('next')
+        latest_thread = Thread.objects.filter(channel=OuterRef('pk'), hidden_date=None).order_by() \
+                .values('channel').annotate(latest=models.Max('recent_date')).values('latest')
+
+        with transaction.atomic():
+            for names in _batches(self.channels):
+                recount_activity(Channel, Thread, Comment, names)
+
+            for pks in _batches(self.imported_threads):
+                Thread.objects.filter(pk__in=pks).update(comment_seq=Coalesce(Subquery(next_comment), 0), \
+                        recent_date=Greatest('pub_date', Coalesce('last_comment_date', 'pub_date')))
+
+            for names in _batches(self.channels):
+                Channel.objects.filter(pk__in=names).update( \
+                        recent_date=Greatest('recent_date', Coalesce(Subquery(latest_thread), 'recent_date')))
+
+        fragments.invalidate_all()
+
+    ## Import (line number, record) pairs. The rows before an invalid record
+    ## stay imported, and are counted before the error is raised.
+    def run(self, records):
+        try:
+            try:
+                for line, record in records:
+                    self.add(record, line)
+
+            # the queued rows all came before it
+            except InvalidRecord:
+                self.flush()
+                raise
+
+            self.flush()
+
+        finally:
+            self.finish()
+
+        return self.counts
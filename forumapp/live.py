@@ -0,0 +1,187 @@
+import collections, json, threading, time
+from django.conf import settings
+from .models import Comment
+
+# Live comments. Every new comment is published, once its transaction
+# commits, to an in-process hub that hands it to the listeners of its thread,
+# so a listener waiting for comments costs no queries. The database is only
+# read to catch a listener up: once when it connects with an older cursor, and
+# again if it fell more than FORUM_LIVE_BACKLOG comments behind.
+#
+# The hub only reaches listeners in the same process. With several worker
+# processes a listener sees the comments posted through its own process at
+# once, and the others when it reconnects.
+
+def get_max_connections():
+    return getattr(settings, 'FORUM_LIVE_MAX_CONNECTIONS', 100)
+
+def get_heartbeat():
+    return getattr(settings, 'FORUM_LIVE_HEARTBEAT', 15)
+
+def get_timeout():
+    return getattr(settings, 'FORUM_LIVE_TIMEOUT', 300)
+
+def get_backlog():
+    return getattr(settings, 'FORUM_LIVE_BACKLOG', 100)
+
+# Raised when the process already serves FORUM_LIVE_MAX_CONNECTIONS listeners
+class HubFull(Exception):
+    pass
+
+## The event sent for a comment
+def comment_event(comment):
+    return {
+        'comment_id': comment.comment_id,
+        'owner': comment.owner_id,
+        'text': comment.text,
+        'pub_date': comment.pub_date.isoformat(),
+    }
+
+## Events of the comments in the thread (pk) after comment_id after, oldest
+## first and at most FORUM_LIVE_BACKLOG of them
+def catch_up(thread_pk, after):
+    comments = Comment.objects.filter(thread_id=thread_pk, comment_id__gt=after).order_by('comment_id')
+    return [comment_event(comment) for comment in comments[:get_backlog()]]
+
+# One listener's queue of events for one thread
+class Subscription(object):
+
+    def __init__(self, hub, thread_pk):
+        self.hub = hub
+        self.thread_pk = thread_pk
+        self.events = collections.deque()
+        self.overflowed = False
+        self.ready = threading.Event()
+
+    # called by the hub, holding its lock
+    def push(self, event):
+        if len(self.events) >= get_backlog():
+            self.events.clear()
+            self.overflowed = True
+
+        elif not self.overflowed:
+            self.events.append(event)
+
+        self.ready.set()
+
+    # Wait up to timeout seconds for events. Returns (events, overflowed);
+    # after an overflow the events are gone and have to be read from the database
+    def wait(self, timeout):
+        self.ready.wait(timeout)
+
+        with self.hub.lock:
+            self.ready.clear()
+            events, self.events = list(self.events), collections.deque()
+            overflowed, self.overflowed = self.overflowed, False
+
+        return events, overflowed
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Hub(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.connections = 0
+
+    ## Start listening to a thread (pk); raises HubFull over the connection limit
+    def subscribe(self, thread_pk):
+        with self.lock:
+            if self.connections >= get_max_connections():
+                raise HubFull()
+
+            subscription = Subscription(self, thread_pk)
+            self.subscriptions.setdefault(thread_pk, set()).add(subscription)
+            self.connections += 1
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            listeners = self.subscriptions.get(subscription.thread_pk, set())
+
+            if subscription in listeners:
+                listeners.remove(subscription)
+                self.connections -= 1
+
+                if not listeners:
+                    del self.subscriptions[subscription.thread_pk]
+
+    def publish(self, thread_pk, event):
+        with self.lock:
+            for subscription in self.subscriptions.get(thread_pk, ()):
+                subscription.push(event)
+
+hub = Hub()
+
+## Send a new comment to the listeners of its thread
+def publish(comment):
+    hub.publish(comment.thread_id, comment_event(comment))
+
+## Wait up to timeout seconds for comments after the cursor and return their
+## events, at once if there are some already
+def poll(subscription, after, timeout):
+    deadline = time.monotonic() + timeout
+    events = catch_up(subscription.thread_pk, after)
+
+    while True:
+        events = [event for event in events if event['comment_id'] > after]
+        remaining = deadline - time.monotonic()
+
+        if events or remaining <= 0:
+            return events
+
+        events, overflowed = subscription.wait(remaining)
+
+        if overflowed:
+            events = catch_up(subscription.thread_pk, after)
+
+# Server-Sent Events of the comments after a cursor: the ones already posted,
+# then new ones as they're published, with a heartbeat comment whenever the
+# stream was quiet for FORUM_LIVE_HEARTBEAT seconds. Ends after
+# FORUM_LIVE_TIMEOUT seconds; browsers reconnect with the last event id.
+# Closing it (as the server does with the response) ends the subscription.
+class EventStream(object):
+
+    def __init__(self, subscription, after, caught_up=False):
+        self.subscription = subscription
+        self.after = after
+        self.caught_up = caught_up
+
+    def __iter__(self):
+        subscription = self.subscription
+        start = time.monotonic()
+
+        # clients wait a heartbeat before reconnecting
+        yield 'retry: %d\n\n' % (get_heartbeat() * 1000)
+
+        events = [] if self.caught_up else catch_up(subscription.thread_pk, self.after)
+
+        while True:
+            for event in events:
+                if event['comment_id'] > self.after:
+                    self.after = event['comment_id']
+                    yield 'id: %d\nevent: comment\ndata: %s\n\n' % (self.after, json.dumps(event))
+
+            remaining = start + get_timeout() - time.monotonic()
+            if remaining <= 0:
+                return
+
+            events, overflowed = subscription.wait(min(get_heartbeat(), remaining))
+
+            if overflowed:
+                events = catch_up(subscription.thread_pk, self.after)
+
+            elif not events:
+                yield ': heartbeat\n\n'
+
+    def close(self):
+        self.subscription.close()
@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError
+from django.urls import reverse
+from forumapp.models import Channel, Thread, Comment
+from . import bench_endpoints
+
+# Benchmark the admin changelists and the change forms of the busiest channel
+# and thread (the ones with the biggest inlines) like bench_endpoints does the
+# forum pages. Logs in as a superuser, so create one after generate_forum.
+class Command(bench_endpoints.Command):
+    help = "Benchmark the forum's admin pages, optionally comparing with a baseline JSON file."
+
+    endpoints = ('channels', 'threads', 'comments', 'channel', 'thread', 'comment')
+
+    def get_pages(self, options):
+        username = options['username'] or User.objects.filter(is_superuser=True) \
+                .order_by('pk').values_list('username', flat=True).first()
+
+        if username is None:
+            raise CommandError("There is no superuser, run createsuperuser or pass --username.")
+
+        channel = Channel.objects.order_by('-thread_count', 'channel_name').first()
+
+        if channel is None:
+            raise CommandError("There are no channels, run generate_forum first.")
+
+        urls = {
+            'channels': reverse('admin:forumapp_channel_changelist'),
+            'threads': reverse('admin:forumapp_thread_changelist'),
+            'comments': reverse('admin:forumapp_comment_changelist'),
+            'channel': reverse('admin:forumapp_channel_change', args=[channel.pk]),
+        }
+
+        thread = Thread.objects.filter(channel=channel).order_by('-comment_count', 'thread_id').first()
+        if thread is not None:
+            urls['thread'] = reverse('admin:forumapp_thread_change', args=[thread.pk])
+
+            comment = Comment.objects.filter(thread=thread).values_list('pk', flat=True).first()
+            if comment is not None:
+                urls['comment'] = reverse('admin:forumapp_comment_change', args=[comment])
+
+        return urls, username
@@ -0,0 +1,41 @@
+from django.urls import reverse
+from forumapp.models import Channel, Thread
+from . import bench_endpoints
+
+# Benchmark the JSON API against the HTML pages it stands in for, like
+# bench_endpoints does the forum pages: the channel list, the busiest
+# channel's threads and its busiest thread's comments, all at the default page
+# size. Ends with the API's payload size and median latency relative to HTML.
+class Command(bench_endpoints.Command):
+    help = "Benchmark the JSON API against the HTML pages, optionally comparing with a baseline JSON file."
+
+    endpoints = ('channel', 'thread', 'comment', 'api_channel', 'api_thread', 'api_comment')
+
+    def get_pages(self, options):
+        pages, username = bench_endpoints.pick_pages(options['username'])
+        urls = {name: pages[name] for name in ('channel', 'thread', 'comment') if name in pages}
+
+        channel = Channel.objects.order_by('-thread_count', 'channel_name').first()
+        urls['api_channel'] = reverse('forumapp:api_channels')
+        urls['api_thread'] = reverse('forumapp:api_threads', kwargs={'channel': channel.pk})
+
+        thread = Thread.objects.filter(channel=channel).order_by('-comment_count', 'thread_id').first()
+        if thread is not None:
+            urls['api_comment'] = reverse('forumapp:api_comments', \
+                    kwargs={'channel': channel.pk, 'thread': thread.thread_id})
+
+        return urls, username
+
+    def summarize(self, results):
+        super(Command, self).summarize(results)
+        endpoints = results['endpoints']
+        self.stdout.write("\n%-10s %14s %14s %12s" % ('api page', 'bytes vs html', 'p50 vs html', 'queries'))
+
+        for name in ('channel', 'thread', 'comment'):
+            html, api = endpoints.get(name), endpoints.get('api_' + name)
+
+            if html is None or api is None:
+                continue
+
+            self.stdout.write("%-10s %13.0f%% %13.0f%% %5d vs %d" % (name, 100.0 * api['bytes'] / max(html['bytes'], 1), \
+                    100.0 * api['p50_ms'] / max(html['p50_ms'], 1e-9), api['queries'], html['queries']))
@@ -0,0 +1,217 @@
+import datetime, json, platform, time, tracemalloc
+import django
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+from forumapp.models import Channel, Thread, Comment
+from .generate_forum import PASSWORD
+
+# Counts the statements run on a connection. Unlike connection.queries this
+# isn't reset when a request starts.
+class QueryCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+## Nearest-rank percentile of a sorted list
+def percentile(values, percent):
+    index = max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+## Pick the pages to measure from the data: the busiest channel, its busiest
+## thread and a user who posts a lot (or username). Returns ({page: url}, username).
+def pick_pages(username=None):
+    channel = Channel.objects.order_by('-thread_count', 'channel_name').first()
+
+    if channel is None:
+        raise CommandError("There are no channels, run generate_forum first.")
+
+    thread = Thread.objects.filter(channel=channel).order_by('-comment_count', 'thread_id').first()
+
+    if username is None:
+        poster = User.objects.annotate(posts=Count('comment')) \
+                .order_by('-posts').values_list('username', flat=True).first()
+        username = poster or channel.owner_id
+
+    urls = {
+        'channel': reverse('forumapp:channel'),
+        'thread': reverse('forumapp:thread', kwargs={'channel': channel.pk}),
+        'user': reverse('forumapp:user', kwargs={'username': username}),
+        'favorites': reverse('forumapp:favorites'),
+    }
+
+    if thread is not None:
+        urls['comment'] = reverse('forumapp:comment', kwargs={'channel': channel.pk, 'thread': thread.thread_id})
+
+    return urls, username
+
+# Request each forum page a number of times through the full middleware stack
+# and report latency percentiles, SQL queries and peak Python memory per page.
+# Pages are picked from the data: the busiest channel, its busiest thread and
+# a user who posts a lot, so run generate_forum first.
+class Command(BaseCommand):
+    help = "Benchmark the forum pages, optionally comparing with a baseline JSON file."
+
+    endpoints = ('channel', 'thread', 'comment', 'user', 'favorites')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=20, help="Timed requests per page")
+        parser.add_argument('--warmup', type=int, default=2, help="Untimed requests per page first")
+        parser.add_argument('--cold', action='store_true', help="Clear the cache before every request")
+        parser.add_argument('--username', help="Log in as this user (default: a generated user)")
+        parser.add_argument('--endpoints', nargs='*', choices=self.endpoints, default=self.endpoints)
+        parser.add_argument('--output', help="Write the results to this JSON file")
+        parser.add_argument('--baseline', help="Compare with results stored by an earlier --output")
+        parser.add_argument('--tolerance', type=float, default=0.2, \
+                help="Fail when a median gets slower than the baseline by more than this fraction")
+
+    # Return ({page: url}, username of the user to log in as)
+    def get_pages(self, options):
+        return pick_pages(options['username'])
+
+    def handle(self, *args, **options):
+        urls, username = self.get_pages(options)
+        client = Client()
+
+        if not client.login(username=username, password=PASSWORD):
+            client.force_login(User.objects.get(username=username))
+
+        results = {
+            'meta': {
+                'date': datetime.datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'username': username,
+                'runs': options['runs'],
+                'cold': options['cold'],
+                'rows': {model.__name__.lower(): model.objects.count() for model in (Channel, Thread, Comment)},
+            },
+            'endpoints': {},
+        }
+
+        self.stdout.write("%-12s %6s %9s %9s %9s %9s %8s %10s %10s" % \
+                ('page', 'status', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries', 'peak KiB', 'bytes'))
+
+        for name in options['endpoints']:
+            if name not in urls:
+                continue
+
+            result = self.measure(client, urls[name], options)
+            results['endpoints'][name] = result
+
+            self.stdout.write("%-12s %6d %9.2f %9.2f %9.2f %9.2f %8d %10.1f %10d" % (name, result['status'], \
+                    result['p50_ms'], result['p90_ms'], result['p99_ms'], result['max_ms'], \
+                    result['queries'], result['peak_kib'], result['bytes']))
+
+        self.summarize(results)
+
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                json.dump(results, out, indent=2, sort_keys=True)
+
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def measure(self, client, url, options):
+        for i in range(options['warmup']):
+            client.get(url)
+
+        timings = []
+
+        for i in range(options['runs']):
+            if options['cold']:
+                caches['default'].clear()
+
+            queries = QueryCounter()
+
+            with connection.execute_wrapper(queries):
+                start = time.perf_counter()
+                response = client.get(url)
+                timings.append((time.perf_counter() - start) * 1000)
+
+        # one more request under tracemalloc, which slows everything down
+        if options['cold']:
+            caches['default'].clear()
+
+        tracemalloc.start()
+        try:
+            client.get(url)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        timings.sort()
+        return {
+            'url': url,
+            'status': response.status_code,
+            'p50_ms': percentile(timings, 50),
+            'p90_ms': percentile(timings, 90),
+            'p99_ms': percentile(timings, 99),
+            'max_ms': timings[-1],
+            'mean_ms': sum(timings) / len(timings),
+            'queries': queries.count,
+            'peak_kib': peak / 1024.0,
+            'bytes': len(response.content),
+        }
+
+    # Report on the results of all pages after the table, and store the
+    # summary with them: the slowest page at the median and the tail, and the
+    # queries per request over all pages
+    def summarize(self, results):
+        endpoints = results['endpoints']
+
+        if not endpoints:
+            return
+
+        median = max(endpoints, key=lambda name: endpoints[name]['p50_ms'])
+        tail = max(endpoints, key=lambda name: endpoints[name]['p99_ms'])
+        queries = [result['queries'] for result in endpoints.values()]
+
+        results['summary'] = {
+            'slowest_p50': median,
+            'slowest_p99': tail,
+            'queries_per_request': sum(queries) / float(len(queries)),
+            'max_queries': max(queries),
+        }
+
+        self.stdout.write("\nslowest page: %s at p50 (%.2f ms), %s at p99 (%.2f ms)" % (median, \
+                endpoints[median]['p50_ms'], tail, endpoints[tail]['p99_ms']))
+        self.stdout.write("queries per request: %.1f on average, %d at most" % \
+                (results['summary']['queries_per_request'], results['summary']['max_queries']))
+
+    def compare(self, results, path, tolerance):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)['endpoints']
+
+        regressions = []
+        self.stdout.write("\n%-10s %12s %12s %8s %12s" % ('page', 'base p50', 'p50', 'change', 'queries'))
+
+        for name, result in results['endpoints'].items():
+            if name not in baseline:
+                continue
+
+            before = baseline[name]
+            change = result['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0.0
+
+            self.stdout.write("%-10s %12.2f %12.2f %+7.0f%% %5d -> %d" % (name, before['p50_ms'], \
+                    result['p50_ms'], change * 100, before['queries'], result['queries']))
+
+            if change > tolerance:
+                regressions.append("%s is %.0f%% slower" % (name, change * 100))
+
+            if result['queries'] > before['queries']:
+                regressions.append("%s runs %d more queries" % (name, result['queries'] - before['queries']))
+
+        if regressions:
+            raise CommandError("Regressions against %s: %s" % (path, '; '.join(regressions)))
+
+        self.stdout.write(self.style.SUCCESS("No regressions against %s." % path))
@@ -0,0 +1,75 @@
+import random, threading, time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.test.utils import override_settings
+from forumapp import touch
+from forumapp.models import Channel, Thread
+from forumapp.views import post_comment
+
+# Post comments from many threads into one hot channel and compare the
+# throughput with the touch buffer off and on. Runs against the configured
+# database and removes its channel afterwards.
+class Command(BaseCommand):
+    help = "Measure comment throughput on one hot channel with and without the touch buffer."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help="Concurrent posting threads")
+        parser.add_argument('--posts', type=int, default=50, help="Comments per worker")
+        parser.add_argument('--threads', type=int, default=4, help="Forum threads in the hot channel")
+
+    def handle(self, *args, **options):
+        owner, _ = User.objects.get_or_create(username='bench-touch-user')
+        channel = Channel.objects.create(channel_name='bench-touch', owner=owner)
+        threads = [Thread.objects.create(channel=channel, owner=owner, thread_name='bench thread %d' % i, \
+                description='bench') for i in range(options['threads'])]
+
+        try:
+            self.stdout.write("%-8s %10s %10s %8s" % ('buffer', 'posts/s', 'seconds', 'errors'))
+
+            for enabled in (False, True):
+                with override_settings(FORUM_TOUCH_BUFFER=enabled):
+                    posts, errors, elapsed = self.run(owner, threads, options['workers'], options['posts'])
+
+                self.stdout.write("%-8s %10.1f %10.2f %8d" % ('on' if enabled else 'off', \
+                        posts / elapsed, elapsed, errors))
+
+        finally:
+            channel.delete()
+            owner.delete()
+
+    def run(self, owner, threads, workers, posts):
+        results = []
+        start = time.perf_counter()
+
+        def work():
+            done = errors = 0
+
+            try:
+                for i in range(posts):
+                    try:
+                        post_comment(random.choice(threads), owner, {'text': 'benchmark comment %d' % i})
+                        done += 1
+
+                    except OperationalError:
+                        errors += 1
+
+                    # what request_finished does after each post
+                    touch.flush_if_due()
+
+            finally:
+                connection.close()
+                results.append((done, errors))
+
+        workers = [threading.Thread(target=work) for i in range(workers)]
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        touch.flush()
+
+        elapsed = time.perf_counter() - start
+        return sum(done for done, errors in results), sum(errors for done, errors in results), elapsed
@@ -0,0 +1,96 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from forumapp.forms import ThreadForm, CommentForm
+from forumapp.models import Channel, Thread, Comment
+from forumapp.views import post_thread, post_comment
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+# Raised to roll back everything the benchmark wrote
+class Rollback(Exception):
+    pass
+
+## The flow the views used before post_thread/post_comment: save a placeholder
+## row, fill it from the form, bump the parents and delete it on rejection
+def placeholder_thread(channel, owner, data):
+    thread = Thread(channel=channel, owner=owner)
+    thread.save()
+    form = ThreadForm(data, instance=thread)
+
+    if form.is_valid() and len(form.cleaned_data['thread_name']) > 5 and len(form.cleaned_data['description']) > 5:
+        form.save()
+        Channel.objects.filter(pk=channel.pk).update(recent_date=timezone.now())
+        return thread
+
+    thread.delete()
+
+def placeholder_comment(thread, owner, data):
+    comment = Comment(thread=thread, owner=owner)
+    comment.save()
+    form = CommentForm(data, instance=comment)
+
+    if form.is_valid() and len(form.cleaned_data['text']) > 5:
+        form.save()
+        date = timezone.now()
+        Channel.objects.filter(pk=thread.channel_id).update(recent_date=date)
+        Thread.objects.filter(pk=thread.pk).update(recent_date=date)
+        return comment
+
+    comment.delete()
+
+# Count the statements each way of posting runs, inside a transaction that is
+# rolled back afterwards
+class Command(BaseCommand):
+    help = "Measure queries, writes and time per thread and comment post, before and after validating first."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=50, help="Posts per measurement")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['posts'])
+                raise Rollback
+
+        except Rollback:
+            pass
+
+    def run(self, posts):
+        owner = User.objects.create(username='bench-writes-user')
+        channel = Channel.objects.create(channel_name='bench-writes', owner=owner)
+        thread = Thread.objects.create(channel=channel, owner=owner, thread_name='bench thread', description='bench')
+
+        thread_data = {'valid': {'thread_name': 'benchmark thread', 'description': 'benchmark description'},
+                'rejected': {'thread_name': 'short', 'description': 'benchmark description'}}
+        comment_data = {'valid': {'text': 'a benchmark comment'}, 'rejected': {'text': 'short'}}
+
+        cases = [
+            ('thread', 'placeholder', lambda data: placeholder_thread(channel, owner, data), thread_data),
+            ('thread', 'validate first', lambda data: post_thread(channel, owner, data), thread_data),
+            ('comment', 'placeholder', lambda data: placeholder_comment(thread, owner, data), comment_data),
+            ('comment', 'validate first', lambda data: post_comment(thread, owner, data), comment_data),
+        ]
+
+        self.stdout.write("%-8s %-15s %-9s %8s %8s %8s" % ('post', 'flow', 'input', 'queries', 'writes', 'ms'))
+
+        for kind, flow, post, data in cases:
+            for label in ('valid', 'rejected'):
+                queries, writes, elapsed = self.measure(post, data[label], posts)
+                self.stdout.write("%-8s %-15s %-9s %8.1f %8.1f %8.2f" % (kind, flow, label, \
+                        queries / posts, writes / posts, elapsed * 1000 / posts))
+
+    def measure(self, post, data, posts):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+
+            for i in range(posts):
+                post(data)
+
+            elapsed = time.perf_counter() - start
+
+        writes = [query for query in captured if query['sql'].lstrip().upper().startswith(WRITES)]
+        return len(captured), len(writes), elapsed
@@ -0,0 +1,96 @@
+import re
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from forumapp import fragments
+from forumapp.models import Channel
+from forumapp.testing import normalize_sql
+from .bench_endpoints import pick_pages
+
+# A table read from start to end
+FULL_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)(\S+)$')
+# Rows sorted after they were read; fine for a handful, but a page query that
+# sorts reads every matching row before its LIMIT applies
+SORT = re.compile(r'^USE TEMP B-TREE FOR (ORDER|GROUP) BY')
+
+# Records the SELECT statements a request runs, once per statement shape
+class StatementCollector(object):
+
+    def __init__(self):
+        self.statements = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith('SELECT'):
+            self.statements.setdefault(normalize_sql(sql), (sql, params))
+
+        return execute(sql, params, many, context)
+
+# Render the forum pages (and their second pages) the way a logged-in channel
+# owner sees them, then run EXPLAIN QUERY PLAN on every SELECT they issued and
+# fail if one scans a whole table. Sorts are reported, and fail the check with
+# --fail-on-sort. Uses the existing data, so run generate_forum first on an
+# empty database.
+class Command(BaseCommand):
+    help = "Check that the queries behind the forum pages use indexes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail-on-sort', action='store_true', help="Also fail on queries that sort without an index")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("Plans are only checked on SQLite.")
+
+        urls, username = pick_pages()
+        owner = Channel.objects.filter(thread__isnull=False).values_list('owner_id', flat=True).first() \
+                or Channel.objects.values_list('owner_id', flat=True).first()
+
+        client = Client()
+        client.force_login(User.objects.get(username=owner))
+        collector = StatementCollector()
+
+        for name, url in sorted(urls.items()):
+            fragments.get_cache().clear()
+
+            with connection.execute_wrapper(collector):
+                response = client.get(url)
+
+                # seek past the first row and back, so the keyset conditions run too
+                page = response.context and response.context.get('page')
+                if page is not None and page.object_list:
+                    cursor = page.paginator.encode_cursor(page.object_list[0])
+                    client.get(url, {'after': cursor})
+                    client.get(url, {'before': cursor})
+
+            if response.status_code != 200:
+                raise CommandError("%s answered %d" % (url, response.status_code))
+
+        problems = []
+        sorts = 0
+
+        for shape, (sql, params) in collector.statements.items():
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = [row[-1] for row in cursor.fetchall()]
+
+            scans = [line for line in plan if FULL_SCAN.match(line)]
+            sorted_lines = [line for line in plan if SORT.match(line)]
+            bad = scans + (sorted_lines if options['fail_on_sort'] else [])
+            sorts += bool(sorted_lines)
+
+            if bad or options['verbosity'] > 1:
+                self.stdout.write(shape[:300])
+
+                for line in plan:
+                    marker = "   <-- full scan" if line in scans else "   <-- sort" if line in sorted_lines else ""
+                    self.stdout.write("    %s%s" % (line, marker))
+
+            if bad:
+                problems.append("%s (%s)" % (shape[:120], '; '.join(bad)))
+
+        if problems:
+            raise CommandError("%d of %d queries don't use an index:\n%s" % \
+                    (len(problems), len(collector.statements), '\n'.join(problems)))
+
+        self.stdout.write(self.style.SUCCESS("All %d queries use indexes, %d of them sort their rows." % \
+                (len(collector.statements), sorts)))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from forumapp import purge
+from forumapp.models import PendingPurge
+
+# Delete the rows of hidden channels and threads, e.g. after a crash stopped
+# the background worker or when FORUM_PURGE_IN_BACKGROUND is off
+class Command(BaseCommand):
+    help = "Finish deleting hidden channels and threads in chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, help="Rows deleted per transaction (default: FORUM_PURGE_CHUNK_SIZE)")
+        parser.add_argument('--pause', type=float, help="Seconds to wait between chunks (default: FORUM_PURGE_PAUSE)")
+
+    def handle(self, *args, **options):
+        pending = PendingPurge.objects.count()
+
+        def progress(pending_purge, deleted):
+            if options['verbosity'] > 1:
+                self.stdout.write("Deleted %d rows of %s" % (deleted, pending_purge))
+
+        count = purge.drain(options['chunk_size'], options['pause'], progress)
+        self.stdout.write(self.style.SUCCESS("Deleted %d rows of %d hidden channels and threads." % (count, pending)))
@@ -0,0 +1,82 @@
+import resource, sys, time
+from django.core.management.base import BaseCommand, CommandError
+from forumapp import export
+
+## Peak resident memory of this process in MiB
+def peak_memory_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# Reports progress of a long-running command at most every interval seconds:
+# rows done, rows per second and peak memory
+class Progress(object):
+
+    def __init__(self, out, interval=5.0, noun='rows'):
+        self.out = out
+        self.interval = interval
+        self.noun = noun
+        self.count = 0
+        self.start = self.last = time.monotonic()
+
+    def rate(self):
+        return self.count / max(time.monotonic() - self.start, 1e-9)
+
+    def add(self, count, detail=''):
+        self.count += count
+        now = time.monotonic()
+
+        if now - self.last >= self.interval:
+            self.last = now
+            self.out.write("%d %s, %.0f/s, peak memory %.1f MiB%s" % \
+                    (self.count, self.noun, self.rate(), peak_memory_mib(), detail))
+
+# Export channels with their threads and comments as NDJSON (see
+# forumapp/export.py), to a file or stdout. Progress and the position reached
+# go to stderr; pass the position of the last line written to --after to
+# continue an interrupted export into a new file.
+class Command(BaseCommand):
+    help = "Export a channel or the whole forum as NDJSON, optionally gzip-compressed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--channel', help="Export only this channel")
+        parser.add_argument('--after', help="Resume after this position: CHANNEL[:THREAD_ID[:COMMENT_ID]], " \
+                "or THREAD_ID[:COMMENT_ID] with --channel")
+        parser.add_argument('--output', default='-', help="File to write (default: stdout)")
+        parser.add_argument('--gzip', action='store_true', help="Compress the output with gzip")
+        parser.add_argument('--chunk-size', type=int, help="Rows per query (default: FORUM_EXPORT_CHUNK_SIZE)")
+        parser.add_argument('--progress', type=float, default=5.0, help="Seconds between progress reports")
+
+    def handle(self, *args, **options):
+        after = None
+
+        if options['after']:
+            try:
+                after = export.parse_position(options['after'], options['channel'])
+
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        progress = Progress(self.stderr, options['progress'], 'records')
+        position = [after]
+
+        def tracked(records):
+            for record in records:
+                position[0] = export.get_position(record)
+                progress.add(1, ", at %s" % export.format_position(position[0]))
+                yield record
+
+        records = tracked(export.records(options['channel'], after, options['chunk_size']))
+        out = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+
+        try:
+            for data in export.ndjson(records, compress=options['gzip']):
+                out.write(data)
+
+        finally:
+            out.flush()
+
+            if out is not sys.stdout.buffer:
+                out.close()
+
+        self.stderr.write(self.style.SUCCESS("Exported %d records (%.0f/s, peak memory %.1f MiB)%s." % \
+                (progress.count, progress.rate(), peak_memory_mib(), \
+                position[0] and ", last at %s" % export.format_position(position[0]) or '')))
@@ -0,0 +1,201 @@
+import datetime, random
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from forumapp import fragments
+from forumapp.activity import recount_activity
+from forumapp.models import Channel, ChannelMembership, Favorite, Thread, Comment
+
+# Password of every generated user, so benchmarks can log in as them
+PASSWORD = 'forum-bench'
+
+## Split total into buckets counts with a Zipf-like skew (a few big buckets
+## and a long tail), in random order
+def spread(total, buckets, rng, skew=1.0):
+    if buckets <= 0:
+        return []
+
+    weights = [1.0 / (rank + 1) ** skew for rank in range(buckets)]
+    scale = total / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+
+    for i in range(total - sum(counts)):
+        counts[i % buckets] += 1
+
+    rng.shuffle(counts)
+    return counts
+
+## Return a random date between start and end
+def between(rng, start, end):
+    return start + (end - start) * rng.random()
+
+# Fill the database with a reproducible forum: the same seed and sizes always
+# give the same rows, with dates relative to the time of the run. Everything
+# is written with bulk inserts in chunks, and the activity counters are
+# computed by SQL at the end.
+class Command(BaseCommand):
+    help = "Generate a seeded synthetic forum for benchmarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--channels', type=int, default=1000)
+        parser.add_argument('--threads', type=int, default=100000)
+        parser.add_argument('--comments', type=int, default=5000000)
+        parser.add_argument('--days', type=int, default=365, help="Spread the posts over this many days")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--prefix', default='gen', help="Prefix of generated user and channel names")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows per bulk insert")
+        parser.add_argument('--clear', action='store_true', help="Delete rows generated with this prefix first")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.prefix = options['prefix']
+        self.batch_size = options['batch_size']
+        self.verbosity = options['verbosity']
+        self.end = timezone.now().replace(microsecond=0)
+        self.start = self.end - datetime.timedelta(days=options['days'])
+
+        if options['clear']:
+            self.clear()
+
+        if Channel.objects.filter(channel_name__startswith=self.prefix + '-').exists():
+            raise CommandError("Channels named %s-* exist already, use --clear to replace them." % self.prefix)
+
+        users = self.create_users(options['users'])
+        channels = self.create_channels(options['channels'], users)
+        thread_counts = spread(options['threads'], len(channels), self.rng)
+
+        self.create_memberships(channels, users)
+        self.create_favorites(channels, users, thread_counts)
+        self.create_posts(channels, users, thread_counts, options['comments'])
+
+        self.log("Counting activity")
+        with transaction.atomic():
+            recount_activity(Channel, Thread, Comment, [channel.pk for channel in channels])
+
+        fragments.invalidate_all()
+
+        self.stdout.write(self.style.SUCCESS("Generated %d users, %d channels, %d threads and %d comments." % \
+                (len(users), len(channels), options['threads'], options['comments'])))
+
+    def log(self, message):
+        if self.verbosity > 1:
+            self.stdout.write(message)
+
+    def clear(self):
+        self.log("Deleting %s-* channels and users" % self.prefix)
+        with transaction.atomic():
+            channels = Channel.objects.filter(channel_name__startswith=self.prefix + '-')
+            Comment.objects.filter(thread__channel__in=channels).delete()
+            Thread.objects.filter(channel__in=channels).delete()
+            channels.delete()
+            User.objects.filter(username__startswith=self.prefix + '-').delete()
+
+    def bulk_insert(self, model, rows):
+        for i in range(0, len(rows), self.batch_size):
+            with transaction.atomic():
+                model.objects.bulk_create(rows[i:i + self.batch_size])
+
+    def create_users(self, count):
+        self.log("Creating %d users" % count)
+        password = make_password(PASSWORD)
+        names = ['%s-user-%d' % (self.prefix, i) for i in range(count)]
+
+        self.bulk_insert(User, [User(username=name, password=password, \
+                date_joined=between(self.rng, self.start, self.end)) for name in names])
+
+        return names
+
+    def create_channels(self, count, users):
+        self.log("Creating %d channels" % count)
+        channels = []
+
+        for i in range(count):
+            channels.append(Channel(channel_name='%s-%d' % (self.prefix, i), owner_id=self.rng.choice(users), \
+                    description='Generated channel number %d' % i, pub_date=self.start, recent_date=self.start))
+
+        self.bulk_insert(Channel, channels)
+        return channels
+
+    # Most channels have no moderators and no bans, a few have several
+    def create_memberships(self, channels, users):
+        self.log("Creating moderators and bans")
+        rows = []
+
+        for channel in channels:
+            moderators = self.rng.choices([0, 1, 2, 3, 5], weights=[50, 30, 12, 6, 2])[0]
+            banned = self.rng.choices([0, 1, 3, 10], weights=[85, 10, 4, 1])[0]
+            picked = self.rng.sample(users, min(len(users), moderators + banned + 1))
+            picked = [name for name in picked if name != channel.owner_id][:moderators + banned]
+
+            for n, name in enumerate(picked):
+                role = ChannelMembership.MODERATOR if n < moderators else ChannelMembership.BANNED
+                rows.append(ChannelMembership(channel_id=channel.pk, user_id=name, role=role, pub_date=self.start))
+
+        self.bulk_insert(ChannelMembership, rows)
+
+    # Users favorite a handful of channels, busy ones more often
+    def create_favorites(self, channels, users, thread_counts):
+        self.log("Creating favorites")
+        weights = [count + 1 for count in thread_counts]
+        rows = []
+
+        for name in users:
+            count = min(len(channels), int(self.rng.expovariate(1 / 3.0)))
+            picked = {channel.pk for channel in self.rng.choices(channels, weights=weights, k=count)}
+            rows.extend(Favorite(user_id=name, channel_id=pk) for pk in sorted(picked))
+
+        self.bulk_insert(Favorite, rows)
+
+    # Threads per channel and comments per thread both follow a skewed
+    # distribution; ids are assigned here so comments can refer to threads
+    def create_posts(self, channels, users, thread_counts, comment_total):
+        thread_total = sum(thread_counts)
+        comment_counts = spread(comment_total, thread_total, self.rng)
+
+        next_thread = (Thread.objects.aggregate(Max('pk'))['pk__max'] or 0) + 1
+        next_comment = (Comment.objects.aggregate(Max('pk'))['pk__max'] or 0) + 1
+        done = 0
+
+        for channel, thread_count in zip(channels, thread_counts):
+            recent_date = channel.recent_date
+            threads = []
+            comments = []
+
+            for thread_id in range(thread_count):
+                pub_date = between(self.rng, self.start, self.end)
+                count = comment_counts[done + thread_id]
+
+                threads.append(Thread(pk=next_thread, channel_id=channel.pk, thread_id=thread_id, \
+                        thread_name='Generated thread %d in %s' % (thread_id, channel.pk), \
+                        description='Thread number %d' % thread_id, owner_id=self.rng.choice(users), \
+                        comment_seq=count, pub_date=pub_date, recent_date=pub_date))
+
+                dates = sorted(between(self.rng, pub_date, self.end) for i in range(count))
+                for comment_id, date in enumerate(dates):
+                    comments.append(Comment(pk=next_comment, thread_id=next_thread, comment_id=comment_id, \
+                            text='Generated comment %d of thread %d' % (comment_id, thread_id), \
+                            owner_id=self.rng.choice(users), pub_date=date))
+                    next_comment += 1
+
+                if dates:
+                    threads[-1].recent_date = dates[-1]
+
+                recent_date = max(recent_date, threads[-1].recent_date)
+                next_thread += 1
+
+                # keep memory flat on channels with huge threads
+                if len(comments) >= self.batch_size * 10:
+                    self.bulk_insert(Thread, threads)
+                    self.bulk_insert(Comment, comments)
+                    threads, comments = [], []
+
+            self.bulk_insert(Thread, threads)
+            self.bulk_insert(Comment, comments)
+            Channel.objects.filter(pk=channel.pk).update(thread_seq=thread_count, recent_date=recent_date)
+
+            done += thread_count
+            self.log("Created %d of %d threads" % (done, thread_total))
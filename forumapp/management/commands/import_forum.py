@@ -0,0 +1,45 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from forumapp.importer import Importer, InvalidRecord, get_reader
+from .export_forum import Progress, peak_memory_mib
+
+# Import a forum dump in the format of export_forum, as NDJSON or CSV (see
+# forumapp/importer.py), reporting rows, throughput and peak memory as it goes
+class Command(BaseCommand):
+    help = "Bulk import channels, threads and comments from NDJSON or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, gzip-compressed if it ends in .gz")
+        parser.add_argument('--format', choices=('ndjson', 'csv'), help="Default: csv for .csv files, else ndjson")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows per transaction")
+        parser.add_argument('--create-users', action='store_true', \
+                help="Create missing owners with unusable passwords instead of leaving the rows ownerless")
+        parser.add_argument('--progress', type=float, default=5.0, help="Seconds between progress reports")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        progress = Progress(self.stdout, options['progress'])
+        importer = Importer(options['batch_size'], options['create_users'], progress)
+        reader = get_reader(options['path'], options['format'])
+        start = time.monotonic()
+
+        try:
+            counts = importer.run(reader(options['path']))
+
+        except (InvalidRecord, OSError) as e:
+            raise CommandError("%s (imported %d channels, %d threads and %d comments before it)" % \
+                    (e, importer.counts['channels'], importer.counts['threads'], importer.counts['comments']))
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS("Imported %d channels, %d threads and %d comments in %.1f s " \
+                "(%.0f rows/s, peak memory %.1f MiB)." % (counts['channels'], counts['threads'], counts['comments'], \
+                elapsed, progress.count / max(elapsed, 1e-9), peak_memory_mib())))
+
+        if counts['users']:
+            self.stdout.write("Created %d users." % counts['users'])
+
+        if counts['missing_owners']:
+            self.stdout.write(self.style.WARNING("%d rows had owners that don't exist and were imported without one." % \
+                    counts['missing_owners']))
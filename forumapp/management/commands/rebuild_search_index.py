@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from forumapp import search
+
+# Rebuild the full-text search index, e.g. for databases that had content
+# before the index existed or after it got out of sync
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index of threads and comments in chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help="Rows copied per transaction")
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError("Full-text search needs an SQLite database with FTS5.")
+
+        def progress(count):
+            if options['verbosity'] > 1:
+                self.stdout.write("Indexed %d rows" % count)
+
+        count = search.rebuild_index(options['chunk_size'], progress)
+        self.stdout.write(self.style.SUCCESS("Indexed %d threads and comments." % count))
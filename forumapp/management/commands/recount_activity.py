@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from forumapp.activity import recount_activity
+from forumapp.fragments import invalidate_all
+from forumapp.models import Channel, Thread, Comment
+
+# Repair the denormalized activity counters from the child tables
+class Command(BaseCommand):
+    help = "Recompute thread/comment counts and last comment snapshots for channels and threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('channels', nargs='*', help="Only recount these channels")
+
+    def handle(self, *args, **options):
+        channel_names = options['channels'] or None
+
+        with transaction.atomic():
+            recount_activity(Channel, Thread, Comment, channel_names)
+
+        # the counters changed without saves, so drop every cached listing
+        invalidate_all()
+
+        self.stdout.write(self.style.SUCCESS("Recounted %s." % \
+                (', '.join(channel_names) if channel_names else "all channels")))
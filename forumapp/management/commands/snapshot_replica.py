@@ -0,0 +1,59 @@
+import os, sqlite3, time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+## Copy the SQLite database at source to target with the online backup API,
+## which gives a consistent snapshot while the source is being written. The
+## copy replaces target in one rename, so readers see either snapshot whole.
+def snapshot(source, target):
+    partial = target + '.partial'
+
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(partial)
+
+    try:
+        src.backup(dst)
+
+    finally:
+        dst.close()
+        src.close()
+
+    os.replace(partial, target)
+
+# Refresh a local SQLite read replica from the primary, once or periodically,
+# to try replica routing (and its lag) without a real replicated database
+class Command(BaseCommand):
+    help = "Copy the primary SQLite database to a replica alias, optionally every few seconds."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='replica', help="Replica alias to write (default: replica)")
+        parser.add_argument('--interval', type=float, help="Repeat every this many seconds until interrupted")
+
+    def handle(self, *args, **options):
+        alias = options['database']
+
+        if alias == DEFAULT_DB_ALIAS or alias not in settings.DATABASES:
+            raise CommandError("%s is not a replica alias in DATABASES." % alias)
+
+        databases = (settings.DATABASES[DEFAULT_DB_ALIAS], settings.DATABASES[alias])
+        if any(not database['ENGINE'].endswith('sqlite3') for database in databases):
+            raise CommandError("Snapshots only work between SQLite databases.")
+
+        source, target = (str(database['NAME']) for database in databases)
+
+        while True:
+            start = time.perf_counter()
+            snapshot(source, target)
+
+            if options['verbosity'] > 1 or not options['interval']:
+                self.stdout.write("Copied %s to %s in %.0f ms" % (source, target, (time.perf_counter() - start) * 1000))
+
+            if not options['interval']:
+                break
+
+            try:
+                time.sleep(options['interval'])
+
+            except KeyboardInterrupt:
+                break
@@ -0,0 +1,237 @@
+import itertools, threading, time, weakref
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from . import fragments
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Everything recorded for one route in one thread
+class RouteStats(object):
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.statuses = {}
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.renders = 0
+        self.render_seconds = 0.0
+        self.response_bytes = 0
+
+    def add(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.seconds += other.seconds
+        for key, count in other.statuses.items():
+            self.statuses[key] = self.statuses.get(key, 0) + count
+        self.queries += other.queries
+        self.query_seconds += other.query_seconds
+        self.renders += other.renders
+        self.render_seconds += other.render_seconds
+        self.response_bytes += other.response_bytes
+
+# Keeps a thread's routes alive in its thread-local; it's dropped when the
+# thread ends, which retires the routes
+class ThreadRoutes(object):
+
+    def __init__(self, routes):
+        self.routes = routes
+
+# Collects request metrics without a lock on the request path: every thread
+# writes to its own {route: RouteStats}, and only reading them (a scrape)
+# takes the lock to walk the live threads and add them up. When a thread ends
+# its routes are folded into the shared totals of retired threads, so servers
+# that start a thread per request don't pile them up.
+class Aggregator(object):
+
+    def __init__(self):
+        # reentrant: a finalizer may retire routes while its thread holds the lock
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.threads = {}
+        self.retired = {}
+        self.keys = itertools.count()
+
+    def _routes(self):
+        holder = getattr(self.local, 'holder', None)
+
+        if holder is None:
+            key = next(self.keys)
+            holder = self.local.holder = ThreadRoutes({})
+
+            with self.lock:
+                self.threads[key] = holder.routes
+
+            weakref.finalize(holder, self._retire, key)
+
+        return holder.routes
+
+    def _retire(self, key):
+        with self.lock:
+            for route, stats in self.threads.pop(key, {}).items():
+                self.retired.setdefault(route, RouteStats()).add(stats)
+
+    def record(self, route, method, status, seconds, queries, query_seconds, render_seconds, response_bytes):
+        routes = self._routes()
+        stats = routes.get(route)
+
+        if stats is None:
+            stats = routes[route] = RouteStats()
+
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                stats.buckets[i] += 1
+                break
+
+        stats.count += 1
+        stats.seconds += seconds
+        stats.statuses[(method, status)] = stats.statuses.get((method, status), 0) + 1
+        stats.queries += queries
+        stats.query_seconds += query_seconds
+        stats.response_bytes += response_bytes
+
+        if render_seconds is not None:
+            stats.renders += 1
+            stats.render_seconds += render_seconds
+
+    # Return {route: RouteStats} summed over all threads
+    def collect(self):
+        totals = {}
+
+        with self.lock:
+            threads = list(self.threads.values())
+
+            for route, stats in self.retired.items():
+                totals.setdefault(route, RouteStats()).add(stats)
+
+        for routes in threads:
+            for route, stats in dict(routes).items():
+                totals.setdefault(route, RouteStats()).add(stats)
+
+        return totals
+
+    def reset(self):
+        with self.lock:
+            self.retired = {}
+
+            for routes in list(self.threads.values()):
+                routes.clear()
+
+aggregator = Aggregator()
+
+# Counts the statements and time a request spends in the database
+class QueryTimer(object):
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+
+        try:
+            return execute(sql, params, many, context)
+
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+# Records latency, SQL, template render time and response size of every
+# request under its URL name. List it first in MIDDLEWARE so it times the
+# other middleware too and renders template responses last.
+# Removes itself from the stack when FORUM_METRICS is off.
+class MetricsMiddleware(object):
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'FORUM_METRICS', False):
+            raise MiddlewareNotUsed
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        request._forum_render_seconds = None
+        start = time.perf_counter()
+
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timer))
+
+            response = self.get_response(request)
+
+        seconds = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        route = (match.view_name if match else None) or 'unmatched'
+        size = 0 if response.streaming else len(response.content)
+
+        aggregator.record(route, request.method, response.status_code, seconds, timer.count, timer.seconds, \
+                request._forum_render_seconds, size)
+
+        return response
+
+    # Runs after every other middleware's hook, so rendering here is final
+    def process_template_response(self, request, response):
+        start = time.perf_counter()
+        response.render()
+        request._forum_render_seconds = time.perf_counter() - start
+
+        return response
+
+def _labels(**labels):
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in sorted(labels.items()))
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+## Render the collected metrics in the Prometheus text exposition format
+def render_metrics():
+    routes = sorted(aggregator.collect().items())
+    lines = []
+
+    def family(name, kind, description):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+    family('forum_request_duration_seconds', 'histogram', 'Time to answer a request, by URL name.')
+    for route, stats in routes:
+        cumulative = 0
+
+        for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+            cumulative += count
+            lines.append('forum_request_duration_seconds_bucket%s %d' % (_labels(route=route, le=bound), cumulative))
+
+        lines.append('forum_request_duration_seconds_bucket%s %d' % (_labels(route=route, le='+Inf'), stats.count))
+        lines.append('forum_request_duration_seconds_sum%s %s' % (_labels(route=route), _format(stats.seconds)))
+        lines.append('forum_request_duration_seconds_count%s %d' % (_labels(route=route), stats.count))
+
+    family('forum_requests_total', 'counter', 'Requests by URL name, method and status code.')
+    for route, stats in routes:
+        for (method, status), count in sorted(stats.statuses.items()):
+            lines.append('forum_requests_total%s %d' % (_labels(route=route, method=method, status=status), count))
+
+    counters = [
+        ('forum_db_queries_total', 'SQL statements run while answering requests.', 'queries'),
+        ('forum_db_query_seconds_total', 'Time spent in SQL statements.', 'query_seconds'),
+        ('forum_template_renders_total', 'Template responses rendered.', 'renders'),
+        ('forum_template_render_seconds_total', 'Time spent rendering templates.', 'render_seconds'),
+        ('forum_response_bytes_total', 'Bytes of response bodies, streaming responses excluded.', 'response_bytes'),
+    ]
+
+    for name, description, attribute in counters:
+        family(name, 'counter', description)
+
+        for route, stats in routes:
+            lines.append('%s%s %s' % (name, _labels(route=route), _format(getattr(stats, attribute))))
+
+    cache = fragments.get_stats()
+    family('forum_fragment_cache_requests_total', 'counter', 'Fragment cache lookups by result.')
+    lines.append('forum_fragment_cache_requests_total%s %d' % (_labels(result='hit'), cache['hits']))
+    lines.append('forum_fragment_cache_requests_total%s %d' % (_labels(result='miss'), cache['misses']))
+
+    return '\n'.join(lines) + '\n'
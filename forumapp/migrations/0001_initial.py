@@ -0,0 +1,76 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Channel',
+            fields=[
+                ('channel_name', models.SlugField(max_length=30, primary_key=True, serialize=False)),
+                ('description', models.CharField(default='', max_length=250)),
+                ('banned_users', models.TextField(default='[]')),
+                ('moderators', models.TextField(default='[]')),
+                ('pin_date', models.DateTimeField(null=True, verbose_name='date pinned')),
+                ('pub_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date published')),
+                ('recent_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date used')),
+                ('owner', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, to_field='username')),
+            ],
+            options={
+                'ordering': ['-recent_date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserSettings',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('favorites', models.TextField(default='[]')),
+                ('bio', models.TextField(default='Hello world', max_length=250)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Thread',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('thread_id', models.IntegerField(default=0)),
+                ('thread_name', models.CharField(max_length=90)),
+                ('description', models.CharField(max_length=150)),
+                ('pin_date', models.DateTimeField(null=True, verbose_name='date pinned')),
+                ('pub_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date published')),
+                ('recent_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date used')),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='forumapp.channel')),
+                ('owner', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, to_field='username')),
+            ],
+            options={
+                'ordering': ['pin_date', '-recent_date'],
+                'unique_together': {('channel', 'thread_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='Comment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('comment_id', models.IntegerField(default=0)),
+                ('text', models.CharField(max_length=250)),
+                ('pub_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date published')),
+                ('owner', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, to_field='username')),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='forumapp.thread')),
+            ],
+            options={
+                'ordering': ['-pub_date'],
+                'unique_together': {('thread', 'comment_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:07
+
+import json
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+# Copy the moderators/banned_users JSON lists into membership rows
+def copy_json_memberships(apps, schema_editor):
+    Channel = apps.get_model('forumapp', 'Channel')
+    ChannelMembership = apps.get_model('forumapp', 'ChannelMembership')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+
+    usernames = set(User.objects.values_list('username', flat=True))
+    memberships = []
+
+    for channel in Channel.objects.only('channel_name', 'moderators', 'banned_users').iterator():
+        seen = set()
+
+        # bans win over a stale moderator entry for the same user
+        for role, names in (('ban', channel.banned_users), ('mod', channel.moderators)):
+            for username in json.loads(names or '[]'):
+
+                # names of deleted users were never cleaned out of the lists
+                if username in usernames and username not in seen:
+                    seen.add(username)
+                    memberships.append(ChannelMembership(channel_id=channel.channel_name, \
+                            user_id=username, role=role))
+
+    ChannelMembership.objects.bulk_create(memberships, batch_size=500)
+
+# Rebuild the JSON lists from membership rows
+def copy_memberships_to_json(apps, schema_editor):
+    Channel = apps.get_model('forumapp', 'Channel')
+    ChannelMembership = apps.get_model('forumapp', 'ChannelMembership')
+
+    roles = {}
+    for channel_id, user_id, role in ChannelMembership.objects.order_by('pk') \
+            .values_list('channel_id', 'user_id', 'role').iterator():
+        roles.setdefault(channel_id, {'mod': [], 'ban': []})[role].append(user_id)
+
+    for channel_id, names in roles.items():
+        Channel.objects.filter(channel_name=channel_id).update( \
+                moderators=json.dumps(names['mod']), banned_users=json.dumps(names['ban']))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('forumapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelMembership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('mod', 'Moderator'), ('ban', 'Banned')], max_length=3)),
+                ('pub_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date added')),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='forumapp.channel')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='channel_memberships', to=settings.AUTH_USER_MODEL, to_field='username')),
+            ],
+            options={
+                'ordering': ['pub_date'],
+                'indexes': [models.Index(fields=['user', 'role', 'channel'], name='forumapp_ch_user_id_305f24_idx')],
+                'unique_together': {('channel', 'user')},
+            },
+        ),
+        migrations.RunPython(copy_json_memberships, copy_memberships_to_json),
+        migrations.RemoveField(
+            model_name='channel',
+            name='banned_users',
+        ),
+        migrations.RemoveField(
+            model_name='channel',
+            name='moderators',
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:09
+
+import json
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+# Copy each UserSettings.favorites JSON list into favorite rows
+def copy_json_favorites(apps, schema_editor):
+    UserSettings = apps.get_model('forumapp', 'UserSettings')
+    Channel = apps.get_model('forumapp', 'Channel')
+    Favorite = apps.get_model('forumapp', 'Favorite')
+
+    channel_names = set(Channel.objects.values_list('channel_name', flat=True))
+    favorites = []
+
+    for username, names in UserSettings.objects.values_list('user__username', 'favorites').iterator():
+
+        # the lists were never cleaned when a channel was deleted
+        for channel_name in set(json.loads(names or '[]')) & channel_names:
+            favorites.append(Favorite(user_id=username, channel_id=channel_name))
+
+    Favorite.objects.bulk_create(favorites, batch_size=500)
+
+# Rebuild the JSON lists from favorite rows
+def copy_favorites_to_json(apps, schema_editor):
+    UserSettings = apps.get_model('forumapp', 'UserSettings')
+    Favorite = apps.get_model('forumapp', 'Favorite')
+
+    favorites = {}
+    for username, channel_name in Favorite.objects.order_by('pk').values_list('user_id', 'channel_id').iterator():
+        favorites.setdefault(username, []).append(channel_name)
+
+    for username, names in favorites.items():
+        UserSettings.objects.filter(user__username=username).update(favorites=json.dumps(names))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('forumapp', '0002_channelmembership'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Favorite',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pub_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date added')),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='favorites', to='forumapp.channel')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='favorites', to=settings.AUTH_USER_MODEL, to_field='username')),
+            ],
+            options={
+                'unique_together': {('user', 'channel')},
+            },
+        ),
+        migrations.RunPython(copy_json_favorites, copy_favorites_to_json),
+        migrations.RemoveField(
+            model_name='usersettings',
+            name='favorites',
+        ),
+    ]
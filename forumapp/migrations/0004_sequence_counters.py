@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:11
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+# Start each counter one past the largest id already handed out
+def initialize_counters(apps, schema_editor):
+    Channel = apps.get_model('forumapp', 'Channel')
+    Thread = apps.get_model('forumapp', 'Thread')
+    Comment = apps.get_model('forumapp', 'Comment')
+
+    last_thread = Thread.objects.filter(channel=models.OuterRef('pk')).order_by('-thread_id').values('thread_id')[:1]
+    Channel.objects.update(thread_seq=Coalesce(models.Subquery(last_thread) + 1, 0))
+
+    last_comment = Comment.objects.filter(thread=models.OuterRef('pk')).order_by('-comment_id').values('comment_id')[:1]
+    Thread.objects.update(comment_seq=Coalesce(models.Subquery(last_comment) + 1, 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forumapp', '0003_favorite'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='thread_seq',
+            field=models.IntegerField(default=0, verbose_name='next thread id'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='comment_seq',
+            field=models.IntegerField(default=0, verbose_name='next comment id'),
+        ),
+        migrations.RunPython(initialize_counters, migrations.RunPython.noop),
+    ]
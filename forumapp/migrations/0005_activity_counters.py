@@ -0,0 +1,73 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from forumapp.activity import recount_activity
+
+
+def count_existing_activity(apps, schema_editor):
+    recount_activity(apps.get_model('forumapp', 'Channel'), apps.get_model('forumapp', 'Thread'), \
+            apps.get_model('forumapp', 'Comment'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('forumapp', '0004_sequence_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='comment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='last_comment_date',
+            field=models.DateTimeField(null=True, verbose_name='date of last comment'),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='last_comment_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='last_comment_owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, to_field='username'),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='last_thread_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='thread_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='comment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_comment_date',
+            field=models.DateTimeField(null=True, verbose_name='date of last comment'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_comment_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_comment_owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, to_field='username'),
+        ),
+        migrations.RunPython(count_existing_activity, migrations.RunPython.noop),
+    ]
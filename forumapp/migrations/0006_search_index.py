@@ -0,0 +1,91 @@
+from django.db import migrations
+
+
+# Full-text index over comment text and thread names/descriptions.
+# Comments use their primary key as rowid and threads the negated primary
+# key, so triggers can find a row's entry without scanning the index.
+CREATE_SEARCH_INDEX = [
+    """
+    CREATE VIRTUAL TABLE forumapp_search USING fts5(
+        title, body, channel UNINDEXED, thread_id UNINDEXED, comment_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER forumapp_search_comment_insert AFTER INSERT ON forumapp_comment BEGIN
+        INSERT INTO forumapp_search (rowid, title, body, channel, thread_id, comment_id)
+        SELECT NEW.id, '', NEW.text, t.channel_id, t.thread_id, NEW.comment_id
+        FROM forumapp_thread t WHERE t.id = NEW.thread_id;
+    END
+    """,
+    """
+    CREATE TRIGGER forumapp_search_comment_update AFTER UPDATE OF text, comment_id ON forumapp_comment BEGIN
+        UPDATE forumapp_search SET body = NEW.text, comment_id = NEW.comment_id WHERE rowid = NEW.id;
+    END
+    """,
+    """
+    CREATE TRIGGER forumapp_search_comment_delete AFTER DELETE ON forumapp_comment BEGIN
+        DELETE FROM forumapp_search WHERE rowid = OLD.id;
+    END
+    """,
+    """
+    CREATE TRIGGER forumapp_search_thread_insert AFTER INSERT ON forumapp_thread BEGIN
+        INSERT INTO forumapp_search (rowid, title, body, channel, thread_id, comment_id)
+        VALUES (-NEW.id, NEW.thread_name, NEW.description, NEW.channel_id, NEW.thread_id, NULL);
+    END
+    """,
+    """
+    CREATE TRIGGER forumapp_search_thread_update AFTER UPDATE OF thread_name, description ON forumapp_thread BEGIN
+        UPDATE forumapp_search SET title = NEW.thread_name, body = NEW.description WHERE rowid = -NEW.id;
+    END
+    """,
+    """
+    CREATE TRIGGER forumapp_search_thread_delete AFTER DELETE ON forumapp_thread BEGIN
+        DELETE FROM forumapp_search WHERE rowid = -OLD.id;
+    END
+    """,
+]
+
+DROP_SEARCH_INDEX = [
+    "DROP TRIGGER IF EXISTS forumapp_search_comment_insert",
+    "DROP TRIGGER IF EXISTS forumapp_search_comment_update",
+    "DROP TRIGGER IF EXISTS forumapp_search_comment_delete",
+    "DROP TRIGGER IF EXISTS forumapp_search_thread_insert",
+    "DROP TRIGGER IF EXISTS forumapp_search_thread_update",
+    "DROP TRIGGER IF EXISTS forumapp_search_thread_delete",
+    "DROP TABLE IF EXISTS forumapp_search",
+]
+
+FILL_SEARCH_INDEX = [
+    """
+    INSERT INTO forumapp_search (rowid, title, body, channel, thread_id, comment_id)
+    SELECT -id, thread_name, description, channel_id, thread_id, NULL FROM forumapp_thread
+    """,
+    """
+    INSERT INTO forumapp_search (rowid, title, body, channel, thread_id, comment_id)
+    SELECT c.id, '', c.text, t.channel_id, t.thread_id, c.comment_id
+    FROM forumapp_comment c JOIN forumapp_thread t ON t.id = c.thread_id
+    """,
+]
+
+
+# FTS5 is SQLite only; other databases go without the index
+def run_on_sqlite(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'sqlite':
+            for sql in statements:
+                schema_editor.execute(sql)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forumapp', '0005_activity_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_sqlite(CREATE_SEARCH_INDEX + FILL_SEARCH_INDEX), \
+                run_on_sqlite(DROP_SEARCH_INDEX)),
+    ]
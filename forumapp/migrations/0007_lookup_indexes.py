@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forumapp', '0006_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='channel',
+            index=models.Index(fields=['pin_date', '-recent_date', 'channel_name'], name='forumapp_ch_pin_dat_f9900e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['thread', '-pub_date', '-comment_id'], name='forumapp_co_thread__b2cc6e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['channel', 'pin_date', '-recent_date', '-thread_id'], name='forumapp_th_channel_c4145b_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forumapp', '0007_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='hidden_date',
+            field=models.DateTimeField(null=True, verbose_name='date hidden'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='hidden_date',
+            field=models.DateTimeField(null=True, verbose_name='date hidden'),
+        ),
+        migrations.CreateModel(
+            name='PendingPurge',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deleted_count', models.IntegerField(default=0, verbose_name='rows deleted so far')),
+                ('pub_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date hidden')),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='forumapp.channel')),
+                ('thread', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='forumapp.thread')),
+            ],
+            options={
+                'ordering': ['pub_date', 'pk'],
+            },
+        ),
+    ]
@@ -1,8 +1,22 @@
 import datetime
 from django.utils import timezone
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from .fragments import invalidate
+
+## Reserve count consecutive ids from a counter column on the single row in
+## queryset and return them as a range. The atomic F() update locks the
+## parent row, so the caller's transaction owns the ids until it commits.
+## Other column updates for the same row can ride along in updates.
+def allocate_ids(queryset, field, count=1, **updates):
+    with transaction.atomic(using=queryset.db):
+        if not queryset.update(**{field: models.F(field) + count}, **updates):
+            raise queryset.model.DoesNotExist("Can't allocate ids from a missing %s" % queryset.model.__name__)
+
+        last = queryset.values_list(field, flat=True).get()
+
+    return range(last - count, last)
 
 # manager that uses queryset with nulls last
 class NullsLastManager(models.Manager):
@@ -13,7 +27,6 @@ class NullsLastManager(models.Manager):
 # One-to-one with User
 class UserSettings(models.Model):
     user = models.OneToOneField(User, primary_key=True,on_delete=models.CASCADE)
-    favorites = models.TextField(default='[]')
     bio = models.TextField(max_length=250, default='Hello world')
 
     class Meta:
@@ -28,10 +41,18 @@ class Channel(models.Model):
 
     channel_name = models.SlugField(max_length=30, primary_key=True)
     description = models.CharField(max_length=250, default='')
+    thread_seq = models.IntegerField('next thread id', default=0)
+
+    # activity counters and a snapshot of the newest comment
+    thread_count = models.IntegerField(default=0)
+    comment_count = models.IntegerField(default=0)
+    last_thread_id = models.IntegerField(null=True)
+    last_comment_id = models.IntegerField(null=True)
+    last_comment_owner = models.ForeignKey(User, to_field="username", null=True, related_name='+', on_delete=models.SET_NULL)
+    last_comment_date = models.DateTimeField('date of last comment', null=True)
 
-    banned_users = models.TextField(default='[]')
-    moderators = models.TextField(default='[]')
     pin_date = models.DateTimeField('date pinned', null=True)
+    hidden_date = models.DateTimeField('date hidden', null=True)
     
     owner = models.ForeignKey(User, to_field="username", null=True, on_delete=models.SET_NULL)
     pub_date = models.DateTimeField('date published', default=timezone.now)
@@ -39,6 +60,10 @@ class Channel(models.Model):
 
     class Meta:
         ordering = ['-recent_date']
+        indexes = [
+            # the channel list, in ChannelView's keyset order
+            models.Index(fields=['pin_date', '-recent_date', 'channel_name']),
+        ]
 
     def __str__(self):
         return self.channel_name.replace('-', ' ')
@@ -51,6 +76,68 @@ class Channel(models.Model):
     is_recent.boolean = True
     is_recent.short_description = 'Published recently?'
 
+    def save(self, *args, **kwargs):
+        super(Channel, self).save(*args, **kwargs)
+        invalidate('channel', self.pk, kwargs.get('using'))
+
+    # hide the channel with its threads at once and leave deleting the rows
+    # to the purge worker; returns False if it was already hidden
+    def hide(self, using=None):
+        with transaction.atomic(using=using):
+            if not Channel.objects.filter(pk=self.pk, hidden_date=None).update(hidden_date=timezone.now()):
+                return False
+
+            PendingPurge.objects.create(channel_id=self.pk)
+            invalidate('channel', self.pk, using)
+
+        return True
+
+    # reserve thread ids for count new threads in this channel
+    def allocate_thread_ids(self, count=1):
+        return allocate_ids(Channel.objects.filter(pk=self.pk), 'thread_seq', count)
+
+    def moderator_names(self):
+        return self.memberships.filter(role=ChannelMembership.MODERATOR).values_list('user_id', flat=True)
+
+    def banned_names(self):
+        return self.memberships.filter(role=ChannelMembership.BANNED).values_list('user_id', flat=True)
+
+# A user's role in a channel, one row per (channel, user)
+class ChannelMembership(models.Model):
+    MODERATOR = 'mod'
+    BANNED = 'ban'
+    ROLE_CHOICES = [
+        (MODERATOR, 'Moderator'),
+        (BANNED, 'Banned'),
+    ]
+
+    channel = models.ForeignKey(Channel, related_name='memberships', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, to_field="username", related_name='channel_memberships', on_delete=models.CASCADE)
+    role = models.CharField(max_length=3, choices=ROLE_CHOICES)
+    pub_date = models.DateTimeField('date added', default=timezone.now)
+
+    class Meta:
+        unique_together = (('channel', 'user'))
+        indexes = [
+            models.Index(fields=['user', 'role', 'channel']),
+        ]
+        ordering = ['pub_date']
+
+    def __str__(self):
+        return '%s (%s)' % (self.user_id, self.get_role_display())
+
+# A channel on a user's favorites page, one row per (user, channel)
+class Favorite(models.Model):
+    user = models.ForeignKey(User, to_field="username", related_name='favorites', on_delete=models.CASCADE)
+    channel = models.ForeignKey(Channel, related_name='favorites', on_delete=models.CASCADE)
+    pub_date = models.DateTimeField('date added', default=timezone.now)
+
+    class Meta:
+        unique_together = (('user', 'channel'))
+
+    def __str__(self):
+        return '%s: %s' % (self.user_id, self.channel_id)
+
 # Store channel and thread_id as primary keys
 class Thread(models.Model):
     objects = NullsLastManager()
@@ -60,7 +147,15 @@ class Thread(models.Model):
     
     thread_name = models.CharField(max_length=90)
     description = models.CharField(max_length=150)
+    comment_seq = models.IntegerField('next comment id', default=0)
+
+    # activity counter and a snapshot of the newest comment
+    comment_count = models.IntegerField(default=0)
+    last_comment_id = models.IntegerField(null=True)
+    last_comment_owner = models.ForeignKey(User, to_field="username", null=True, related_name='+', on_delete=models.SET_NULL)
+    last_comment_date = models.DateTimeField('date of last comment', null=True)
     pin_date = models.DateTimeField('date pinned', null=True)
+    hidden_date = models.DateTimeField('date hidden', null=True)
     
     owner = models.ForeignKey(User, to_field="username", null=True, on_delete=models.SET_NULL)
     pub_date = models.DateTimeField('date published', default=timezone.now)
@@ -68,29 +163,87 @@ class Thread(models.Model):
 
     class Meta:
         unique_together = (('channel', 'thread_id'))
+        indexes = [
+            # a channel's threads in ThreadView's keyset order
+            models.Index(fields=['channel', 'pin_date', '-recent_date', '-thread_id']),
+        ]
         ordering = ['pin_date', '-recent_date']
 
     def __str__(self):
         return self.thread_name
 
-    # validate uniqueness on channel and thread_id
+    # validate uniqueness on channel and thread_id, unless excluded (like
+    # forms do, since thread_id is only allocated on save)
     def validate_unique(self, exclude=None):
+        fields = self._meta.unique_together[0]
+        if exclude and set(fields) & set(exclude):
+            return
+
         threads = Thread.objects.filter(channel=self.channel)
         if self._state.adding and threads.filter(thread_id=self.thread_id).exists():
-            raise ValidationError({field:'' for field in self._meta.unique_together[0]})
+            raise ValidationError({field:'' for field in fields})
 
-    # override to auto set thread_id
-    def save(self, *args, **kwargs):
+    # override to auto set thread_id from the channel's counter; the channel's
+    # counters (and recent_date, if given) are updated in the same statement
+    def save(self, *args, recent_date=None, **kwargs):
 
         if self._state.adding:
-            threads = Thread.objects.filter(channel=self.channel)
+            updates = {'thread_count': models.F('thread_count') + 1}
+            if recent_date is not None:
+                updates['recent_date'] = recent_date
+
+            with transaction.atomic(using=kwargs.get('using')):
+                self.thread_id = allocate_ids(Channel.objects.filter(pk=self.channel_id), 'thread_seq', **updates)[0]
+                super(Thread, self).save(*args, **kwargs)
+
+                invalidate('channel', self.channel_id, kwargs.get('using'))
+
+        else:
+            super(Thread, self).save(*args, **kwargs)
+
+        invalidate('thread', self.pk, kwargs.get('using'))
+
+    # take the thread and its comments out of the channel's counters, unless
+    # hiding it already did
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+
+        with transaction.atomic(using=kwargs.get('using')):
+            counted = Thread.objects.filter(pk=self.pk, hidden_date=None).exists()
+
+            if counted:
+                uncount_thread(self)
+
+            result = super(Thread, self).delete(*args, **kwargs)
+
+            if counted:
+                refresh_after_thread(self)
+
+            invalidate('channel', self.channel_id, kwargs.get('using'))
+            invalidate('thread', pk, kwargs.get('using'))
+
+        return result
 
-            last_id = threads.aggregate(largest=models.Max('thread_id'))['largest']
+    # hide the thread and take it out of the channel's counters at once, and
+    # leave deleting its comments to the purge worker; returns False if it
+    # was already hidden
+    def hide(self, using=None):
+        with transaction.atomic(using=using):
+            if not Thread.objects.filter(pk=self.pk, hidden_date=None).update(hidden_date=timezone.now()):
+                return False
 
-            if last_id is not None:
-                self.thread_id = last_id + 1
+            uncount_thread(self)
+            refresh_after_thread(self)
+            PendingPurge.objects.create(channel_id=self.channel_id, thread_id=self.pk)
 
-        super(Thread, self).save(*args, **kwargs)
+            invalidate('channel', self.channel_id, using)
+            invalidate('thread', self.pk, using)
+
+        return True
+
+    # reserve comment ids for count new comments in this thread
+    def allocate_comment_ids(self, count=1):
+        return allocate_ids(Thread.objects.filter(pk=self.pk), 'comment_seq', count)
 
     def is_recent(self):
         now = timezone.now()
@@ -112,31 +265,69 @@ class Comment(models.Model):
 
     class Meta:
         unique_together = (('thread', 'comment_id'))
+        indexes = [
+            # a thread's comments in CommentView's keyset order
+            models.Index(fields=['thread', '-pub_date', '-comment_id']),
+        ]
         ordering = ['-pub_date']
 
     def __str__(self):
         return self.text
 
-    # validate uniqueness on thread and comment_id
+    # validate uniqueness on thread and comment_id, unless excluded (like
+    # forms do, since comment_id is only allocated on save)
     def validate_unique(self, exclude=None):
+        fields = self._meta.unique_together[0]
+        if exclude and set(fields) & set(exclude):
+            return
+
         not_unique = Comment.objects.filter(thread=self.thread, comment_id=self.comment_id).exists()
         if self._state.adding and not_unique:
-            raise ValidationError({field:'' for field in self._meta.unique_together[0]})
+            raise ValidationError({field:'' for field in fields})
 
-    # override to auto set comment_id
-    def save(self, *args, **kwargs):
+    # override to auto set comment_id from the thread's counter. The thread's
+    # and channel's counters, snapshots (and recent_date, if given) are
+    # updated with one statement each; with defer_channel the channel's are
+    # left to the caller (see touch.py).
+    def save(self, *args, recent_date=None, defer_channel=False, **kwargs):
 
         if self._state.adding:
-            comments = Comment.objects.filter(thread=self.thread)
+            touch = {} if recent_date is None else {'recent_date': recent_date}
+
+            with transaction.atomic(using=kwargs.get('using')):
+                # the new comment's id is the counter's value before the update
+                thread_updates = comment_updates(Thread, self, 1, comment_id=models.F('comment_seq'))
+                self.comment_id = allocate_ids(Thread.objects.filter(pk=self.thread_id), 'comment_seq', \
+                        **thread_updates, **touch)[0]
+                super(Comment, self).save(*args, **kwargs)
+
+                if not defer_channel:
+                    Channel.objects.filter(pk=self.thread.channel_id).update(**comment_updates(Channel, self, 1), **touch)
+
+        else:
+            super(Comment, self).save(*args, **kwargs)
+
+        invalidate('thread', self.thread_id, kwargs.get('using'))
+        invalidate('channel', self.thread.channel_id, kwargs.get('using'))
+
+    # take the comment out of its thread and channel's counters
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            count_comment(self, -1)
+            result = super(Comment, self).delete(*args, **kwargs)
 
-            last_id = comments.aggregate(largest=models.Max('comment_id'))['largest']
-            
-            if last_id is not None:
-                self.comment_id = last_id + 1
+            thread = Thread.objects.filter(pk=self.thread_id)
+            if thread.filter(last_comment_id=self.comment_id).exists():
+                refresh_last_comment(thread)
 
-        #self.validate_unique()
+                channel = Channel.objects.filter(pk=self.thread.channel_id)
+                if channel.filter(last_thread_id=self.thread.thread_id, last_comment_id=self.comment_id).exists():
+                    refresh_last_comment(channel)
 
-        super(Comment, self).save(*args, **kwargs)
+            invalidate('thread', self.thread_id, kwargs.get('using'))
+            invalidate('channel', self.thread.channel_id, kwargs.get('using'))
+
+        return result
 
     # see if a comment was posted in the last day
     def is_recent(self):
@@ -146,3 +337,94 @@ class Comment(models.Model):
     is_recent.admin_order_field = 'pub_date'
     is_recent.boolean = True
     is_recent.short_description = 'Published recently?'
+
+# A hidden channel or thread whose rows haven't all been deleted yet. The
+# purge worker (see purge.py) deletes them a chunk at a time, and this row
+# goes with the channel or thread once it's gone.
+class PendingPurge(models.Model):
+    channel = models.ForeignKey(Channel, related_name='+', on_delete=models.CASCADE)
+    thread = models.ForeignKey(Thread, null=True, related_name='+', on_delete=models.CASCADE)
+
+    deleted_count = models.IntegerField('rows deleted so far', default=0)
+    pub_date = models.DateTimeField('date hidden', default=timezone.now)
+
+    class Meta:
+        ordering = ['pub_date', 'pk']
+
+    def __str__(self):
+        if self.thread_id is None:
+            return self.channel_id
+
+        return '%s thread %s' % (self.channel_id, self.thread_id)
+
+## Return update() arguments that replace the last comment snapshot with
+## values, but only on rows where condition holds
+def snapshot_updates(model, condition, values):
+    updates = {}
+
+    for name, value in values.items():
+        field = model._meta.get_field(name)
+
+        if not hasattr(value, 'resolve_expression'):
+            value = models.Value(value, output_field=field)
+
+        updates[name] = models.Case(models.When(condition, then=value), default=models.F(name), output_field=field)
+
+    return updates
+
+## Return update() arguments adding delta to the comment counter of a thread
+## or channel (model). A new comment becomes the last comment unless a newer
+## one is already recorded; comment_id may be an expression.
+def comment_updates(model, comment, delta, comment_id=None):
+    updates = {'comment_count': models.F('comment_count') + delta}
+
+    if delta > 0:
+        newer = models.Q(last_comment_date__isnull=True) | models.Q(last_comment_date__lte=comment.pub_date)
+        snapshot = {
+            'last_comment_id': comment.comment_id if comment_id is None else comment_id,
+            'last_comment_owner_id': comment.owner_id,
+            'last_comment_date': comment.pub_date,
+        }
+
+        if model is Channel:
+            snapshot['last_thread_id'] = comment.thread.thread_id
+
+        updates.update(snapshot_updates(model, newer, snapshot))
+
+    return updates
+
+## Add delta to the comment counters of comment's thread and channel
+def count_comment(comment, delta):
+    Thread.objects.filter(pk=comment.thread_id).update(**comment_updates(Thread, comment, delta))
+    Channel.objects.filter(pk=comment.thread.channel_id).update(**comment_updates(Channel, comment, delta))
+
+## Take thread and its comments out of its channel's counters
+def uncount_thread(thread):
+    comments = Thread.objects.filter(pk=thread.pk).values('comment_count')
+
+    Channel.objects.filter(pk=thread.channel_id).update(thread_count=models.F('thread_count') - 1, \
+            comment_count=models.F('comment_count') - models.Subquery(comments))
+
+## Find the channel's last comment elsewhere if it was in thread, which is
+## hidden or deleted
+def refresh_after_thread(thread):
+    channel = Channel.objects.filter(pk=thread.channel_id)
+
+    if channel.filter(last_thread_id=thread.thread_id).exists():
+        refresh_last_comment(channel)
+
+## Recompute the last comment snapshot of the single thread or channel in queryset
+def refresh_last_comment(queryset):
+    fields = ('last_comment_id', 'last_comment_owner_id', 'last_comment_date')
+
+    if queryset.model is Thread:
+        latest = Comment.objects.filter(thread__in=queryset).order_by('-pub_date', '-comment_id') \
+                .values_list('comment_id', 'owner_id', 'pub_date').first()
+        values = dict(zip(fields, latest or (None, None, None)))
+
+    else:
+        latest = Thread.objects.filter(channel__in=queryset, last_comment_date__isnull=False, hidden_date=None) \
+                .order_by('-last_comment_date').values_list('thread_id', *fields).first()
+        values = dict(zip(('last_thread_id',) + fields, latest or (None, None, None, None)))
+
+    queryset.update(**values)
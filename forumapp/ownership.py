@@ -0,0 +1,131 @@
+import threading
+from contextlib import contextmanager
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from django.utils import timezone
+from .fragments import invalidate
+from .models import Channel, ChannelMembership, PendingPurge
+from . import purge
+
+# Channels outlive their owners. When a user is deleted, each channel they
+# owned goes to its longest-serving moderator, or is hidden and left to the
+# purge worker (see purge.py) when it has none. Only the deleted users' own
+# channels are looked at, the successors of all of them are picked with one
+# query, and the changes are written in batches.
+#
+# Inside deferred_reassignment() the work waits until the block ends, so
+# deleting many users (one by one or as a queryset) does it once for all.
+
+# channels per statement, well below SQLite's limit on query parameters
+BATCH_SIZE = 500
+
+_deferred = threading.local()
+
+def _batches(items):
+    items = list(items)
+
+    for start in range(0, len(items), BATCH_SIZE):
+        yield items[start:start + BATCH_SIZE]
+
+## Return the names of the channels owned by users (a username, or a list or
+## queryset of them)
+def owned_channels(users, using=DEFAULT_DB_ALIAS):
+    if isinstance(users, str):
+        users = [users]
+
+    return list(Channel.objects.using(using).filter(owner__in=users).order_by().values_list('pk', flat=True))
+
+## Return {channel name: (membership pk, username)} of the longest-serving
+## moderator of each channel in channel_names that has one
+def pick_successors(channel_names, using=DEFAULT_DB_ALIAS):
+    memberships = ChannelMembership.objects.using(using).filter(role=ChannelMembership.MODERATOR)
+    successors = {}
+
+    for batch in _batches(channel_names):
+        first = memberships.filter(channel__in=batch).order_by().values('channel').annotate(first=models.Min('pk'))
+        rows = memberships.filter(pk__in=models.Subquery(first.values('first'))).values_list('channel_id', 'pk', 'user_id')
+
+        successors.update((channel, (pk, user)) for channel, pk, user in rows)
+
+    return successors
+
+## Give each ownerless channel in channel_names to its successor and hide the
+## ones without moderators. Returns (reassigned, hidden) channel counts.
+def reassign_channels(channel_names, using=DEFAULT_DB_ALIAS):
+    if not channel_names:
+        return 0, 0
+
+    with transaction.atomic(using=using):
+        # skip channels that were given an owner in the meantime
+        orphans = set()
+        for batch in _batches(set(channel_names)):
+            orphans.update(Channel.objects.using(using).filter(pk__in=batch, owner=None).order_by().values_list('pk', flat=True))
+
+        successors = pick_successors(orphans, using)
+        doomed = orphans - set(successors)
+
+        Channel.objects.using(using).bulk_update([Channel(pk=name, owner_id=user) for name, (_, user) in successors.items()], \
+                ['owner'], batch_size=BATCH_SIZE)
+
+        # the new owners stop being moderators
+        for batch in _batches(pk for pk, _ in successors.values()):
+            ChannelMembership.objects.using(using).filter(pk__in=batch).delete()
+
+        # like Channel.hide(), a batch at a time
+        now = timezone.now()
+
+        for batch in _batches(doomed):
+            names = list(Channel.objects.using(using).filter(pk__in=batch, hidden_date=None).values_list('pk', flat=True))
+
+            Channel.objects.using(using).filter(pk__in=names, hidden_date=None).update(hidden_date=now)
+            PendingPurge.objects.using(using).bulk_create([PendingPurge(channel_id=name, pub_date=now) for name in names])
+
+        if doomed:
+            purge.schedule(using)
+
+        for name in orphans:
+            invalidate('channel', name, using)
+
+    return len(successors), len(doomed)
+
+## Hold back channel reassignment for users deleted inside the block and do it
+## for all of them once it ends. Blocks can nest; the outermost one does the work.
+@contextmanager
+def deferred_reassignment(using=DEFAULT_DB_ALIAS):
+    pending = getattr(_deferred, 'channels', None)
+
+    if pending is not None:
+        yield pending
+        return
+
+    _deferred.channels = pending = set()
+
+    try:
+        yield pending
+
+    finally:
+        _deferred.channels = None
+
+    reassign_channels(pending, using)
+
+## Return the set collecting channels inside deferred_reassignment(), or None
+def get_deferred():
+    return getattr(_deferred, 'channels', None)
+
+## Delete the users in queryset and reassign their channels in one pass: one
+## query finds the channels they own, instead of one per deleted user
+def delete_users(queryset):
+    using = queryset.db
+
+    with transaction.atomic(using=using), deferred_reassignment(using) as pending:
+        _deferred.known = True
+
+        try:
+            pending.update(owned_channels(queryset.values('username'), using))
+            return queryset.delete()
+
+        finally:
+            _deferred.known = False
+
+## Return whether the deferred block already knows which channels are owned
+def channels_known():
+    return getattr(_deferred, 'known', False)
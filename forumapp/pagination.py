@@ -0,0 +1,234 @@
+import base64, datetime, json
+from functools import reduce
+from operator import or_
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import F, Max, Q, QuerySet
+from django.utils.functional import cached_property
+
+# Raised when a cursor can't be decoded for the paginator's ordering
+class InvalidCursor(Exception):
+    pass
+
+# DjangoJSONEncoder drops microseconds, which would make cursors skip rows
+class CursorEncoder(DjangoJSONEncoder):
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+
+        return super(CursorEncoder, self).default(o)
+
+## Pack a list of key values into an opaque, URL-safe cursor
+def encode_cursor(values):
+    data = json.dumps(values, cls=CursorEncoder).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+## Unpack a cursor made by encode_cursor into its list of raw JSON values
+def decode_cursor(cursor, length):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode())
+
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor(cursor)
+
+    return values
+
+# One page of a keyset pagination, similar to django.core.paginator.Page
+class Page(object):
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    # cursor pointing past the last row of this page (older rows)
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return self.paginator.encode_cursor(self.object_list[-1])
+
+    # cursor pointing before the first row of this page (newer rows)
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return self.paginator.encode_cursor(self.object_list[0])
+
+# Paginate a queryset by seeking past the ordering key of the last row seen
+# instead of using OFFSET, so a page costs the same no matter how deep it is.
+#
+# ordering is written like order_by() and must end in a unique column.
+# Nullable columns sort their nulls last, like NullsLastManager.
+class KeysetPaginator(object):
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.model = queryset.model
+        self.per_page = per_page
+
+        self.ordering = []
+        for key in ordering:
+            field = self.model._meta.get_field(key.lstrip('-'))
+            self.ordering.append((field, key.startswith('-')))
+
+    def encode_cursor(self, obj):
+        return encode_cursor([self._value(obj, field) for field, desc in self.ordering])
+
+    def decode_cursor(self, cursor):
+        values = decode_cursor(cursor, len(self.ordering))
+
+        try:
+            return [None if value is None else field.to_python(value) \
+                    for (field, desc), value in zip(self.ordering, values)]
+
+        except ValidationError:
+            raise InvalidCursor(cursor)
+
+    # Return the page after the `after` cursor, before the `before` cursor,
+    # or the first page if neither is given
+    def page(self, after=None, before=None):
+        size = self.per_page
+
+        if before:
+            rows = self._fetch(self.decode_cursor(before), reverse=True)
+            has_previous = len(rows) > size
+            return Page(rows[:size][::-1], self, has_next=True, has_previous=has_previous)
+
+        values = after and self.decode_cursor(after)
+        rows = self._fetch(values, reverse=False)
+
+        return Page(rows[:size], self, has_next=len(rows) > size, has_previous=bool(after))
+
+    def _fetch(self, values, reverse):
+        queryset = self.queryset
+
+        if values:
+            queryset = queryset.filter(self._seek(values, reverse))
+
+        # one extra row tells us whether there is another page
+        return list(queryset.order_by(*self._order_by(reverse))[:self.per_page + 1])
+
+    def _value(self, obj, field):
+        if isinstance(obj, dict):
+            return obj.get(field.attname, obj.get(field.name))
+
+        return getattr(obj, field.attname)
+
+    def _order_by(self, reverse):
+        order = []
+
+        for field, desc in self.ordering:
+            expression = F(field.attname)
+            nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+
+            if desc != reverse:
+                expression = expression.desc(**(nulls if field.null else {}))
+            else:
+                expression = expression.asc(**(nulls if field.null else {}))
+
+            order.append(expression)
+
+        return order
+
+    # Build (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ... in the paging direction
+    def _seek(self, values, reverse):
+        conditions = []
+        equal = Q()
+
+        for (field, desc), value in zip(self.ordering, values):
+            beyond = self._beyond(field, desc, value, reverse)
+
+            if beyond is not None:
+                conditions.append(equal & beyond)
+
+            if value is None:
+                equal &= Q(**{field.attname + '__isnull': True})
+            else:
+                equal &= Q(**{field.attname: value})
+
+        if not conditions:
+            return Q(pk__in=[])
+
+        return reduce(or_, conditions)
+
+    # Condition for rows strictly past value on a single column
+    def _beyond(self, field, desc, value, reverse):
+        name = field.attname
+
+        # nulls sort last going forward, so nothing comes after them
+        if value is None:
+            return Q(**{name + '__isnull': False}) if reverse else None
+
+        if desc != reverse:
+            condition = Q(**{name + '__lt': value})
+        else:
+            condition = Q(**{name + '__gt': value})
+
+        if field.null and not reverse:
+            condition |= Q(**{name + '__isnull': True})
+
+        return condition
+
+## Estimate the number of rows in model's table without counting them: from
+## the planner statistics where there are some (PostgreSQL, or SQLite after
+## ANALYZE), else from the largest integer primary key. None if neither works.
+def estimate_count(model, using='default'):
+    connection = connections[using]
+    table = model._meta.db_table
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [table])
+            row = cursor.fetchone()
+
+            if row and row[0] > 0:
+                return int(row[0])
+
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+
+            if cursor.fetchone():
+                # every entry of a table starts with its number of rows
+                cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table])
+                row = cursor.fetchone()
+
+                if row:
+                    return int(row[0].split()[0])
+
+    if model._meta.pk.get_internal_type() in ('AutoField', 'BigAutoField', 'SmallAutoField'):
+        return model._base_manager.using(using).aggregate(last=Max('pk'))['last'] or 0
+
+    return None
+
+# Paginator for admin changelists of big tables. Unfiltered lists of more than
+# `threshold` rows show an estimated count instead of running COUNT(*).
+class EstimatedCountPaginator(Paginator):
+    threshold = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            estimate = estimate_count(queryset.model, queryset.db)
+
+            if estimate is not None and estimate > self.threshold:
+                return estimate
+
+        return super(EstimatedCountPaginator, self).count
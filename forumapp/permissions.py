@@ -0,0 +1,67 @@
+from django.db.models import Subquery, Value, CharField
+from .models import Channel, ChannelMembership, Thread
+
+# What one viewer may do in one channel, looked up once and then reused
+# by the views and template tags for every row they render
+class ChannelPermissions(object):
+
+    def __init__(self, user, channel_name):
+        self.user = user
+        self.channel_name = channel_name
+        self.channel = Channel.objects.filter(channel_name=channel_name, hidden_date=None).first()
+        self.role = None
+        self._threads = {}
+
+        if self.channel is not None and user.is_authenticated:
+            self.role = ChannelMembership.objects.filter(channel_id=channel_name, \
+                    user_id=user.get_username()).values_list('role', flat=True).first()
+
+    @property
+    def exists(self):
+        return self.channel is not None
+
+    @property
+    def is_owner(self):
+        return self.exists and self.user.is_authenticated \
+                and self.channel.owner_id == self.user.get_username()
+
+    @property
+    def is_moderator(self):
+        return self.is_owner or self.role == ChannelMembership.MODERATOR
+
+    @property
+    def is_banned(self):
+        return self.role == ChannelMembership.BANNED
+
+    # Return the channel's thread with this thread_id, or None (also when
+    # either is hidden)
+    def thread(self, thread_id):
+        if thread_id not in self._threads:
+            self._threads[thread_id] = self.exists and Thread.objects.filter(channel_id=self.channel_name, \
+                    thread_id=thread_id, hidden_date=None).first() or None
+
+        return self._threads[thread_id]
+
+## Return the viewer's permissions for a channel.
+## They are cached on the user object, which lives as long as the request.
+def get_channel_permissions(user, channel_name):
+    cache = getattr(user, '_forum_channel_permissions', None)
+
+    if cache is None:
+        cache = {}
+        user._forum_channel_permissions = cache
+
+    if channel_name not in cache:
+        cache[channel_name] = ChannelPermissions(user, channel_name)
+
+    return cache[channel_name]
+
+## Expression for the user's membership role in the channel named by
+## channel_ref (an OuterRef), for annotating channel or thread querysets
+def role_subquery(user, channel_ref):
+    if not user.is_authenticated:
+        return Value(None, output_field=CharField())
+
+    return Subquery(ChannelMembership.objects.filter(channel_id=channel_ref, \
+            user_id=user.get_username()).values('role')[:1])
+
@@ -0,0 +1,129 @@
+import logging, threading, time
+from django.conf import settings
+from django.db import connections, models, transaction
+from .models import Channel, Comment, PendingPurge, Thread
+from .sqlite import retry_on_lock
+
+logger = logging.getLogger(__name__)
+
+# Deleting a channel or thread hides it at once (see Channel.hide and
+# Thread.hide) and queues a PendingPurge. The rows under it are deleted here a
+# chunk at a time, each chunk in its own short transaction, so a big channel
+# never holds the write lock for long or has to fit in memory.
+#
+# Progress lives in the database: every chunk commits together with the
+# purge's deleted_count, and whatever a crash leaves behind is picked up by
+# the next worker or by "manage.py drain_purges".
+
+def get_chunk_size():
+    return getattr(settings, 'FORUM_PURGE_CHUNK_SIZE', 500)
+
+def get_pause():
+    return getattr(settings, 'FORUM_PURGE_PAUSE', 0.05)
+
+## Delete up to chunk_size rows of one purge in a transaction: the comments
+## first, then the threads, then the hidden channel. Returns the number of
+## rows deleted, 0 once the purge is finished.
+@retry_on_lock
+def purge_chunk(purge_id, chunk_size=None):
+    chunk_size = chunk_size or get_chunk_size()
+
+    with transaction.atomic():
+        purge = PendingPurge.objects.filter(pk=purge_id).first()
+
+        if purge is None:
+            return 0
+
+        if purge.thread_id is None:
+            threads = Thread.objects.filter(channel_id=purge.channel_id)
+        else:
+            threads = Thread.objects.filter(pk=purge.thread_id)
+
+        deleted = 0
+
+        for queryset in (Comment.objects.filter(thread__in=threads.values('pk')), threads):
+            ids = list(queryset.order_by().values_list('pk', flat=True)[:chunk_size])
+
+            if ids:
+                deleted, _ = queryset.model.objects.filter(pk__in=ids).delete()
+                break
+
+        # a thread's purge row went with the thread; a channel goes last
+        else:
+            deleted, _ = Channel.objects.filter(pk=purge.channel_id).delete()
+
+        PendingPurge.objects.filter(pk=purge_id).update(deleted_count=models.F('deleted_count') + deleted)
+
+    return deleted
+
+## Finish every pending purge, oldest first, pausing between chunks so other
+## writers get the lock. progress(purge, deleted) is called after each chunk.
+## Returns the number of rows deleted.
+def drain(chunk_size=None, pause=None, progress=None):
+    pause = get_pause() if pause is None else pause
+    total = 0
+
+    while True:
+        purges = list(PendingPurge.objects.all()[:100])
+
+        if not purges:
+            return total
+
+        for purge in purges:
+            while True:
+                deleted = purge_chunk(purge.pk, chunk_size)
+
+                if not deleted:
+                    break
+
+                total += deleted
+
+                if progress is not None:
+                    progress(purge, deleted)
+
+                time.sleep(pause)
+
+# Drains pending purges on a daemon thread of this process. Waking it while
+# it runs makes it look for new purges once more before it stops.
+class PurgeWorker(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.again = False
+
+    def wake(self):
+        with self.lock:
+            if self.thread is not None:
+                self.again = True
+                return
+
+            self.thread = threading.Thread(target=self.run, name='forum-purge', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    drain()
+
+                except Exception:
+                    logger.exception("Purging hidden channels and threads failed")
+
+                with self.lock:
+                    if not self.again:
+                        self.thread = None
+                        return
+
+                    self.again = False
+
+        finally:
+            connections.close_all()
+
+worker = PurgeWorker()
+
+## Start the background worker once the current transaction commits, unless
+## FORUM_PURGE_IN_BACKGROUND leaves purging to drain_purges
+def schedule(using=None):
+    if getattr(settings, 'FORUM_PURGE_IN_BACKGROUND', True):
+        transaction.on_commit(worker.wake, using=using)
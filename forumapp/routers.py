@@ -0,0 +1,133 @@
+import contextvars, random, time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Read replica routing. The forum's read-only pages may read forum data from a
+# replica, everything else (writes, sessions, users, admin) stays on the
+# primary. A replica is picked per request, so one page never mixes replicas.
+#
+# A user who just posted is pinned to the primary for FORUM_PRIMARY_PIN_SECONDS
+# with a cookie, so the page they are redirected to shows their own post even
+# while the replicas lag behind.
+
+# URL names of the pages served from replicas when answering GET and HEAD
+REPLICA_VIEWS = {'forumapp:channel', 'forumapp:thread', 'forumapp:comment', 'forumapp:user', 'forumapp:favorites', \
+        'forumapp:api_channels', 'forumapp:api_threads', 'forumapp:api_comments'}
+
+# Only these apps' models are read from replicas
+REPLICA_APPS = {'forumapp'}
+
+PIN_COOKIE = 'forum_primary_until'
+
+# alias of the replica the current request reads from, or None for the primary
+_read_alias = contextvars.ContextVar('forum_read_alias', default=None)
+
+def get_replicas():
+    return list(getattr(settings, 'FORUM_READ_REPLICAS', []))
+
+def get_pin_seconds():
+    return getattr(settings, 'FORUM_PRIMARY_PIN_SECONDS', 5)
+
+## Read forum data from a replica (a random one unless alias is given) inside
+## the block; without configured replicas the primary keeps serving reads
+@contextmanager
+def use_replica(alias=None):
+    replicas = get_replicas()
+
+    if alias is None and replicas:
+        alias = random.choice(replicas)
+
+    token = _read_alias.set(alias)
+
+    try:
+        yield alias
+
+    finally:
+        _read_alias.reset(token)
+
+## Return the alias of the replica the current request reads from, or None
+## while it reads the primary
+def get_read_replica():
+    return _read_alias.get()
+
+## Read everything from the primary inside the block
+@contextmanager
+def use_primary():
+    token = _read_alias.set(None)
+
+    try:
+        yield
+
+    finally:
+        _read_alias.reset(token)
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+
+        if alias is None or model._meta.app_label not in REPLICA_APPS:
+            return None
+
+        # related objects come from wherever the object they hang off came from
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    # replicas are copies of the primary and never migrated themselves
+    def allow_migrate(self, db, app_label, **hints):
+        if db in get_replicas():
+            return False
+
+        return None
+
+# Reads the replica pages from a replica unless the user is pinned to the
+# primary, and pins users who send a successful POST (or other write).
+class ReplicaMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+
+        finally:
+            token = getattr(request, '_forum_replica_token', None)
+
+            if token is not None:
+                _read_alias.reset(token)
+
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 and get_pin_seconds():
+            until = time.time() + get_pin_seconds()
+            response.set_cookie(PIN_COOKIE, '%.3f' % until, max_age=get_pin_seconds(), httponly=True, samesite='Lax')
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        replicas = get_replicas()
+
+        if not replicas or request.method not in ('GET', 'HEAD') or is_pinned(request):
+            return None
+
+        if request.resolver_match.view_name in REPLICA_VIEWS:
+            request._forum_replica_token = _read_alias.set(random.choice(replicas))
+
+        return None
+
+## Return whether the request's user posted recently enough to read from the primary
+def is_pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+
+    except ValueError:
+        return False
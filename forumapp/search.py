@@ -0,0 +1,203 @@
+import html, re
+from django.db import connection, transaction
+from django.urls import reverse
+from django.utils.safestring import mark_safe
+from .models import ChannelMembership
+from .pagination import encode_cursor, decode_cursor, InvalidCursor
+
+# FTS5 table created by migration 0006. Comments are stored under their
+# primary key as rowid and threads under their negated primary key.
+SEARCH_TABLE = 'forumapp_search'
+
+# bm25 weights of the title and body columns, so thread names rank first
+RANK = "bm25(forumapp_search, 5.0, 1.0)"
+
+# control characters around matches in snippets, replaced after escaping
+HIGHLIGHT = ('\x02', '\x03')
+
+## Whether the database has the search index (it's SQLite only)
+def is_available():
+    return connection.vendor == 'sqlite'
+
+## Turn free text into an FTS5 query matching every word, the last one as
+## a prefix, so user input can't use or break the query syntax
+def match_query(text):
+    words = ['"%s"' % word for word in re.findall(r'\w+', text)]
+
+    if words:
+        words[-1] += '*'
+
+    return ' '.join(words)
+
+# A matching thread or comment
+class SearchResult(object):
+
+    def __init__(self, rowid, channel, thread_id, comment_id, title, snippet, score):
+        self.rowid = rowid
+        self.channel = channel
+        self.thread_id = thread_id
+        self.comment_id = comment_id
+        self.title = title
+        self.snippet = snippet
+        self.score = score
+
+    @property
+    def is_thread(self):
+        return self.rowid < 0
+
+    # primary key of the matching Thread or Comment
+    @property
+    def object_id(self):
+        return abs(self.rowid)
+
+    def get_absolute_url(self):
+        return reverse('forumapp:comment', kwargs={'channel': self.channel, 'thread': self.thread_id})
+
+    # snippet with matches wrapped in <mark>
+    def highlighted(self):
+        text = html.escape(self.snippet or '')
+        return mark_safe(text.replace(HIGHLIGHT[0], '<mark>').replace(HIGHLIGHT[1], '</mark>'))
+
+# One page of search results
+class SearchPage(object):
+
+    def __init__(self, results, has_next, has_previous):
+        self.object_list = results
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            last = self.object_list[-1]
+            return encode_cursor([last.score, last.rowid])
+
+## Search threads and comments for text, best matches first.
+## Channels user is banned from are left out; channel limits the search to
+## one channel and after is the next_cursor of the previous page.
+def search(text, user=None, channel=None, after=None, per_page=20):
+    query = match_query(text)
+
+    if not query or not is_available():
+        return SearchPage([], has_next=False, has_previous=False)
+
+    sql = ["SELECT rowid, channel, thread_id, comment_id, title, " \
+            "snippet(forumapp_search, -1, %s, %s, '...', 16), " + RANK + \
+            " FROM forumapp_search WHERE forumapp_search MATCH %s"]
+    params = [HIGHLIGHT[0], HIGHLIGHT[1], query]
+
+    if channel:
+        sql.append("AND channel = %s")
+        params.append(channel)
+
+    # hidden channels and threads wait in the purge queue until they're gone
+    sql.append("AND channel NOT IN (SELECT channel_id FROM forumapp_pendingpurge WHERE thread_id IS NULL) " \
+            "AND (channel, thread_id) NOT IN (SELECT t.channel_id, t.thread_id FROM forumapp_pendingpurge p " \
+            "JOIN forumapp_thread t ON t.id = p.thread_id)")
+
+    if user is not None and user.is_authenticated:
+        sql.append("AND channel NOT IN (SELECT channel_id FROM forumapp_channelmembership " \
+                "WHERE user_id = %s AND role = %s)")
+        params.extend([user.get_username(), ChannelMembership.BANNED])
+
+    if after:
+        score, rowid = decode_cursor(after, 2)
+
+        if not isinstance(score, (int, float)) or not isinstance(rowid, int):
+            raise InvalidCursor(after)
+
+        sql.append("AND (" + RANK + " > %s OR (" + RANK + " = %s AND rowid > %s))")
+        params.extend([score, score, rowid])
+
+    # one extra row tells us whether there is another page
+    sql.append("ORDER BY 7, rowid LIMIT %s")
+    params.append(per_page + 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(' '.join(sql), params)
+        results = [SearchResult(*row) for row in cursor.fetchall()]
+
+    return SearchPage(results[:per_page], has_next=len(results) > per_page, has_previous=bool(after))
+
+## Primary keys of the comments (or threads) matching text, for filtering querysets
+def matching_ids(text, threads=False):
+    query = match_query(text)
+
+    if not query or not is_available():
+        return []
+
+    sign = "rowid < 0" if threads else "rowid > 0"
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT abs(rowid) FROM forumapp_search WHERE forumapp_search MATCH %s AND " + sign, [query])
+        return [row[0] for row in cursor.fetchall()]
+
+## Filter a Comment (or Thread) queryset down to the rows matching text, with
+## the matches read in a subquery rather than passed back in as parameters
+def filter_matching(queryset, text, threads=False):
+    query = match_query(text)
+
+    if not query:
+        return queryset.none()
+
+    sign = "rowid < 0" if threads else "rowid > 0"
+    column = '%s.%s' % (connection.ops.quote_name(queryset.model._meta.db_table), connection.ops.quote_name('id'))
+
+    return queryset.extra(where=[column + " IN (SELECT abs(rowid) FROM forumapp_search " \
+            "WHERE forumapp_search MATCH %s AND " + sign + ")"], params=[query])
+
+## Empty the index and fill it again from the thread and comment tables in
+## primary key ranges of chunk_size rows, each copied in its own transaction.
+## The triggers keep indexing rows written meanwhile, so rows already in the
+## index are skipped. Returns the number of rows indexed; progress(count) is
+## called per chunk.
+def rebuild_index(chunk_size=5000, progress=None):
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM forumapp_search")
+
+    sources = [
+        ('forumapp_thread', "SELECT -id, thread_name, description, channel_id, thread_id, NULL " \
+                "FROM forumapp_thread WHERE id > %s AND id <= %s " \
+                "AND NOT EXISTS (SELECT 1 FROM forumapp_search WHERE rowid = -id)"),
+        ('forumapp_comment', "SELECT c.id, '', c.text, t.channel_id, t.thread_id, c.comment_id " \
+                "FROM forumapp_comment c JOIN forumapp_thread t ON t.id = c.thread_id " \
+                "WHERE c.id > %s AND c.id <= %s " \
+                "AND NOT EXISTS (SELECT 1 FROM forumapp_search WHERE rowid = c.id)"),
+    ]
+    count = 0
+
+    for table, select in sources:
+        last = 0
+
+        while True:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+
+                    # find the primary key that ends this chunk
+                    cursor.execute("SELECT max(id) FROM (SELECT id FROM " + table + \
+                            " WHERE id > %s ORDER BY id LIMIT %s)", [last, chunk_size])
+                    end = cursor.fetchone()[0]
+
+                    if end is None:
+                        break
+
+                    cursor.execute("INSERT INTO forumapp_search (rowid, title, body, channel, thread_id, comment_id) " \
+                            + select, [last, end])
+                    count += cursor.rowcount
+
+            last = end
+
+            if progress is not None:
+                progress(count)
+
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO forumapp_search (forumapp_search) VALUES ('optimize')")
+
+    return count
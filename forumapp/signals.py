@@ -1,25 +1,44 @@
-import json
+import functools
 from django.dispatch import receiver
-from django.db.models.signals import post_delete 
+from django.core.signals import request_finished
+from django.db.backends.signals import connection_created
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.contrib.auth.models import User
-from .models import Channel, Thread, Comment
+from .models import Comment
+from . import live, ownership, sqlite, touch
 
-#When we delete a user, reassign or delete channels without owners
+#Remember the channels a user owns, before deleting the user empties their owner
+@receiver(pre_delete, sender=User)
+def remember_channels(sender, instance, using, **kwargs):
+    pending = ownership.get_deferred()
+
+    if pending is None:
+        instance._forum_owned_channels = ownership.owned_channels(instance.get_username(), using)
+
+    elif not ownership.channels_known():
+        pending.update(ownership.owned_channels(instance.get_username(), using))
+
+#When we delete a user, reassign or delete the channels they owned
 @receiver(post_delete, sender=User)
-def delete_repo(sender, instance, **kwargs):
+def delete_repo(sender, instance, using, **kwargs):
+    channels = getattr(instance, '_forum_owned_channels', None)
 
-    channels = Channel.objects.filter(owner=None)
-    for chan in channels:
+    if channels:
+        ownership.reassign_channels(channels, using)
 
-        moderators = json.loads(chan.moderators)
-        for username in moderators:
+#Send new comments to live listeners once they're committed
+@receiver(post_save, sender=Comment)
+def publish_comment(sender, instance, created, using, **kwargs):
+    if created:
+        transaction.on_commit(functools.partial(live.publish, instance), using=using)
 
-            #user might not exist (we dont update moderator list on user deletion)
-            if User.objects.filter(username=username).exists():
+#Write buffered channel rows once they have waited long enough
+@receiver(request_finished)
+def flush_touches(sender, **kwargs):
+    touch.flush_if_due()
 
-                #reassign the owner
-                chan.owner = User.objects.get(username=username)
-                chan.save()
-                break
-        else:
-            chan.delete()
+#Tune every new SQLite connection for concurrent use
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    sqlite.configure_connection(connection)
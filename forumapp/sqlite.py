@@ -0,0 +1,81 @@
+import functools, logging, random, threading, time
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+
+logger = logging.getLogger(__name__)
+
+# SQLite production settings. Every new SQLite connection gets DEFAULT_PRAGMAS
+# with FORUM_SQLITE_PRAGMAS applied over them (WAL lets readers work while one
+# writer commits), and write paths retry with jittered backoff when another
+# writer holds the lock longer than busy_timeout or a read transaction can't
+# be upgraded to a write.
+
+DEFAULT_PRAGMAS = {
+    'busy_timeout': 5000,
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -20000,
+    'mmap_size': 134217728,
+}
+
+## Return the pragmas to set: the defaults, overridden by FORUM_SQLITE_PRAGMAS,
+## without the ones it sets to None
+def get_pragmas():
+    pragmas = dict(DEFAULT_PRAGMAS, **getattr(settings, 'FORUM_SQLITE_PRAGMAS', {}))
+    return {name: value for name, value in pragmas.items() if value is not None}
+
+## Apply the configured pragmas to a new SQLite connection, busy_timeout
+## first so switching the journal mode waits for other connections
+def configure_connection(connection):
+    if connection.vendor != 'sqlite':
+        return
+
+    pragmas = sorted(get_pragmas().items(), key=lambda item: item[0] != 'busy_timeout')
+
+    with connection.cursor() as cursor:
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+def is_lock_error(error):
+    message = str(error).lower()
+    return isinstance(error, OperationalError) and ('locked' in message or 'busy' in message)
+
+_retrying = threading.local()
+
+## Decorate a function that writes to the database so it runs again, after a
+## random delay that doubles with every attempt, when it fails on a locked
+## database. Up to FORUM_LOCK_RETRIES retries; the delay starts at
+## FORUM_LOCK_RETRY_DELAY seconds. The function must be safe to repeat as a
+## whole, which holds when its writes happen in one transaction or not at all.
+##
+## Nothing is retried inside a transaction, which the error has broken, or
+## inside another retried function, which retries the whole thing.
+def retry_on_lock(func=None, using=DEFAULT_DB_ALIAS):
+    if func is None:
+        return functools.partial(retry_on_lock, using=using)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_retrying, 'active', False) or connections[using].in_atomic_block:
+            return func(*args, **kwargs)
+
+        retries = getattr(settings, 'FORUM_LOCK_RETRIES', 5)
+        delay = getattr(settings, 'FORUM_LOCK_RETRY_DELAY', 0.05)
+        _retrying.active = True
+
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    return func(*args, **kwargs)
+
+                except OperationalError as e:
+                    if attempt == retries or not is_lock_error(e):
+                        raise
+
+                    logger.info("%s hit a locked database, retry %d of %d", func.__name__, attempt + 1, retries)
+                    time.sleep(random.uniform(0, min(1.0, delay * 2 ** attempt)))
+
+        finally:
+            _retrying.active = False
+
+    return wrapper
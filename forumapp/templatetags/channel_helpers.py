@@ -1,5 +1,4 @@
-import json
-from forumapp.models import Channel, UserSettings
+from forumapp.models import Channel, Favorite
 from django import template
 
 register = template.Library()
@@ -12,10 +11,22 @@ register = template.Library()
 #     print(channels)
 #     return Channel.objects.filter(channel_name__in=channels)
 
+# Names of the user's favorite channels, loaded in one query and cached on
+# the user object for the rest of the request
+def favorite_names(user):
+    names = getattr(user, '_forum_favorites', None)
+
+    if names is None:
+        names = set()
+
+        if user.is_authenticated:
+            names = set(Favorite.objects.filter(user_id=user.get_username()).values_list('channel_id', flat=True))
+
+        user._forum_favorites = names
+
+    return names
+
 @register.filter
-def is_favorite(channel_name, user):
-    u = UserSettings.objects.filter(user=user)
-    if u.exists():
-        favs = u.get().favorites
-        return str(channel_name) in json.loads(favs)
-    return False
+def is_favorite(channel, user):
+    channel_name = getattr(channel, 'channel_name', channel)
+    return str(channel_name) in favorite_names(user)
@@ -1,41 +1,18 @@
-import json
 from django import template
-from forumapp.models import Channel, Thread, Comment
+from forumapp.permissions import get_channel_permissions
 
 register = template.Library()
 
 #Create filter for threads to see if they are owned by the user passed in
 @register.filter
 def is_owner(kwargs, user):
-    channel = Channel.objects.filter(channel_name=kwargs.get('channel'))
-
-    if channel.exists():
-        return channel.get().owner == user
-
-    return False
+    return get_channel_permissions(user, kwargs.get('channel')).is_owner
 
 @register.filter
 def is_moderator(kwargs, user):
-    channel = Channel.objects.filter(channel_name=kwargs.get('channel'))
-
-    if channel.exists():
-        channel = channel.get()
-
-        if user == channel.owner:
-            return True
-        else:
-            return user.get_username() in json.loads(channel.moderators)
-
-    return False
+    return get_channel_permissions(user, kwargs.get('channel')).is_moderator
 
 @register.filter
 def is_banned_from(user, channel_name):
-    channel = Channel.objects.filter(channel_name=channel_name)
-
     # see if user is in list of banned users
-    if channel.exists():
-        channel = channel.get()
-        return user.get_username() in json.loads(channel.banned_users)
-
-    else:
-        return False
+    return get_channel_permissions(user, channel_name).is_banned
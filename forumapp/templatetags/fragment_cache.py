@@ -0,0 +1,72 @@
+from django import template
+from forumapp import fragments, routers
+
+register = template.Library()
+
+# Cache the enclosed markup per viewer role until the channel or thread it
+# was rendered from changes:
+#
+#   {% fragment "thread_listing" "thread" listing.pk channel=view.kwargs.channel %}
+#       ...
+#   {% endfragment %}
+#
+# The name and any further values identify the fragment, "thread" listing.pk
+# is whose version it depends on and channel lets moderators get their own copy.
+# Forms with csrf tokens must stay outside, they differ per visitor.
+#
+# Pages read from a replica use cached fragments but don't store any: a replica
+# that lags behind would store old rows under the version a write just bumped.
+class FragmentNode(template.Node):
+
+    def __init__(self, nodelist, name, kind, ident, parts, channel):
+        self.nodelist = nodelist
+        self.name = name
+        self.kind = kind
+        self.ident = ident
+        self.parts = parts
+        self.channel = channel
+
+    def render(self, context):
+        request = context.get('request')
+
+        if request is None or not fragments.get_timeout():
+            return self.nodelist.render(context)
+
+        name = self.name.resolve(context)
+        kind = self.kind.resolve(context)
+        ident = self.ident.resolve(context)
+        channel = self.channel.resolve(context) if self.channel else None
+
+        versions = [fragments.get_version(request, kind, ident), \
+                request._forum_fragment_versions.get(fragments.GLOBAL)]
+        parts = [kind, ident] + [part.resolve(context) for part in self.parts]
+        key = fragments.fragment_key(name, parts, fragments.get_role(request.user, channel), versions)
+
+        html = fragments.get_fragment(key)
+
+        if html is None:
+            html = self.nodelist.render(context)
+
+            if routers.get_read_replica() is None:
+                fragments.set_fragment(key, html)
+
+        return html
+
+@register.tag
+def fragment(parser, token):
+    bits = token.split_contents()
+    channel = None
+
+    if bits[-1].startswith('channel='):
+        channel = parser.compile_filter(bits.pop()[len('channel='):])
+
+    if len(bits) < 4:
+        raise template.TemplateSyntaxError("'%s' takes a name, a version kind and its id" % bits[0])
+
+    nodelist = parser.parse(('endfragment',))
+    parser.delete_first_token()
+
+    name, kind, ident = [parser.compile_filter(bit) for bit in bits[1:4]]
+    parts = [parser.compile_filter(bit) for bit in bits[4:]]
+
+    return FragmentNode(nodelist, name, kind, ident, parts, channel)
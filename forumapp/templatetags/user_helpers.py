@@ -1,57 +1,54 @@
-import json
 from django.contrib.auth.models import User
-from forumapp.models import UserSettings, Channel, Thread, Comment
+from forumapp.models import UserSettings, Channel, ChannelMembership, Thread, Comment
 from django import template
 from django.db.models import Q
 register = template.Library()
 
+# names of the channels where user has the given role
+def channels_with_role(user, role):
+    return ChannelMembership.objects.filter(user_id=user.get_username(), role=role).values('channel_id')
+
+# names of the channels where user has any role
+def channels_with_any_role(user):
+    return ChannelMembership.objects.filter(user_id=user.get_username()).values('channel_id')
+
 @register.filter
 def get_owned_channels(user):
-    return Channel.objects.filter(owner=user)
+    return Channel.objects.filter(owner=user, hidden_date=None)
 
 @register.filter
 def get_owned_channels_moderated_by_user(owner, user):
-    return Channel.objects.filter(owner=owner, moderators__contains='"'+user.get_username()+'"') 
+    return Channel.objects.filter(owner=owner, hidden_date=None, \
+            channel_name__in=channels_with_role(user, ChannelMembership.MODERATOR))
 
 @register.filter
 def get_owned_channels_not_moderated_by_user(owner, user):
-    channels = Channel.objects.filter(Q(owner=owner), ~Q(moderators__contains='"'+user.get_username()+'"'))
-    
-    # exclude banned users
-    return channels.filter(~Q(banned_users__contains='"'+user.get_username()+'"'))
+    # exclude channels where user is a moderator or banned
+    return Channel.objects.filter(owner=owner, hidden_date=None).exclude(channel_name__in=channels_with_any_role(user))
 
 @register.filter
 def is_banned_from(user, channel_name):
-    channel = Channel.objects.filter(channel_name=channel_name)
-    
     #see if user is in list of banned users
-    if channel.exists():
-        channel = channel.get()
-        return user.get_username() in json.loads(channel.banned_users)
-    
-    else:
-        return False
+    return ChannelMembership.objects.filter(channel_id=channel_name, user_id=user.get_username(), \
+            role=ChannelMembership.BANNED).exists()
 
 # get owned channels that user is not banned from assuming calling user has permissions
 @register.filter
 def get_moderated_channels_minus_banned(moderator, user):
-    channels = Channel.objects.filter(moderators__contains='"'+moderator.get_username()+'"') | \
-            Channel.objects.filter(owner=moderator)
-    
-    # exclude cahannels where user is banned
-    channels = channels.filter(~Q(banned_users__contains='"'+user.get_username()+'"'))
+    channels = Channel.objects.filter(Q(owner=moderator) | \
+            Q(channel_name__in=channels_with_role(moderator, ChannelMembership.MODERATOR)), hidden_date=None)
     
-    # eclude channels where user is owner or moderator
-    return channels.filter(~Q(owner=user), ~Q(moderators__contains='"'+user.get_username()+'"'))
+    # exclude channels where user is owner, moderator or already banned
+    return channels.exclude(owner=user).exclude(channel_name__in=channels_with_any_role(user))
 
 # get owned channels that user is banned from assuming calling user has permissions
 @register.filter
 def get_moderated_channels_only_banned(moderator, user):
-    channels = Channel.objects.filter(moderators__contains='"'+moderator.get_username()+'"') | \
-            Channel.objects.filter(owner=moderator)
+    channels = Channel.objects.filter(Q(owner=moderator) | \
+            Q(channel_name__in=channels_with_role(moderator, ChannelMembership.MODERATOR)), hidden_date=None)
 
     # only include banned users
-    return channels.filter(banned_users__contains='"'+user.get_username()+'"')
+    return channels.filter(channel_name__in=channels_with_role(user, ChannelMembership.BANNED))
 
 @register.filter
 def get_bio(user):
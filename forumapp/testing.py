@@ -0,0 +1,178 @@
+import functools, os, re, sys
+from collections import Counter
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.template.base import Node, TokenType
+from . import fragments
+
+# Test helpers that hold views to a query budget and catch N+1 queries: a page
+# is rendered once with a few rows and once with many, and every statement
+# that runs more often with more rows is reported with the template tag and
+# the forumapp line that issued it.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(APP_DIR)
+
+# frames of these files are never the culprit
+SKIPPED_FILES = {os.path.join(APP_DIR, name) for name in ('testing.py', 'tests.py', 'metrics.py')}
+
+_strings = re.compile(r"'(?:[^']|'')*'")
+_numbers = re.compile(r'\b\d+(?:\.\d+)?\b')
+_in_lists = re.compile(r'\bIN \((?:\?, )*\?\)')
+_spaces = re.compile(r'\s+')
+
+## Reduce a statement to its shape, so the same query with other parameters
+## (or another number of them in an IN list) groups together
+def normalize_sql(sql):
+    sql = sql.replace('%s', '?')
+    sql = _strings.sub('?', sql)
+    sql = _numbers.sub('?', sql)
+    sql = _in_lists.sub('IN (...)', sql)
+    return _spaces.sub(' ', sql).strip()
+
+def _relative(path):
+    return os.path.relpath(path, PROJECT_DIR)
+
+## Describe where the running statement comes from: the innermost template
+## node being rendered and the innermost line of forumapp code
+def find_origin(frame):
+    code = node = None
+
+    while frame is not None and (code is None or node is None):
+        filename = frame.f_code.co_filename
+
+        if code is None and filename.startswith(APP_DIR) and filename not in SKIPPED_FILES:
+            code = '%s:%d in %s' % (_relative(filename), frame.f_lineno, frame.f_code.co_name)
+
+        if node is None:
+            candidate = frame.f_locals.get('self')
+
+            # type() rather than isinstance(), which would evaluate lazy objects
+            if issubclass(type(candidate), Node) and getattr(candidate, 'token', None) is not None:
+                origin = getattr(candidate, 'origin', None)
+                name = getattr(origin, 'template_name', None) or '<string>'
+                tag = '{{ %s }}' if candidate.token.token_type == TokenType.VAR else '{%% %s %%}'
+                node = 'template %s:%d %s' % (name, candidate.token.lineno, tag % candidate.token.contents)
+
+        frame = frame.f_back
+
+    return ' <- '.join(part for part in (node, code) if part) or 'unknown'
+
+# Records every statement run on a database connection with its origin
+#
+#     with QueryRecorder() as queries:
+#         self.client.get(url)
+#     print(queries.report())
+class QueryRecorder(object):
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.statements.append((normalize_sql(sql), find_origin(sys._getframe(1))))
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.wrapper = connections[self.using].execute_wrapper(self)
+        self.wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.wrapper.__exit__(*exc_info)
+
+    def __len__(self):
+        return len(self.statements)
+
+    ## Return {statement: Counter(origin)}
+    def grouped(self):
+        groups = {}
+
+        for sql, origin in self.statements:
+            groups.setdefault(sql, Counter())[origin] += 1
+
+        return groups
+
+    def counts(self):
+        return Counter(sql for sql, origin in self.statements)
+
+    def report(self, statements=None, limit=200):
+        groups = self.grouped()
+        lines = []
+
+        for sql in statements if statements is not None else sorted(groups, key=lambda s: -sum(groups[s].values())):
+            origins = groups.get(sql, Counter())
+            lines.append('  %dx %s' % (sum(origins.values()), sql if len(sql) <= limit else sql[:limit] + '...'))
+
+            for origin, count in origins.most_common(3):
+                lines.append('      %dx %s' % (count, origin))
+
+        return '\n'.join(lines)
+
+## Return the statements that ran more often in large than in small, most
+## repeated first
+def growing_statements(small, large):
+    before, after = small.counts(), large.counts()
+    grown = [sql for sql in after if after[sql] > before.get(sql, 0)]
+
+    return sorted(grown, key=lambda sql: before.get(sql, 0) - after[sql])
+
+## Fail test_case if large ran more statements than small, naming the
+## statements that grew
+def assert_no_growth(test_case, small, large, labels=('few rows', 'many rows')):
+    grown = growing_statements(small, large)
+
+    if len(large) > len(small) and grown:
+        test_case.fail("Query count grows with rows: %d queries with %s, %d with %s. Repeated statements:\n%s" \
+                % (len(small), labels[0], len(large), labels[1], large.report(grown)))
+
+def assert_budget(test_case, recorder, max_queries, label='the page'):
+    if len(recorder) > max_queries:
+        test_case.fail("%d queries for %s, the budget is %d:\n%s" % (len(recorder), label, max_queries, recorder.report()))
+
+# Decorate a test method that takes a number of rows, creates that many rows
+# and returns the URL to GET (or a function to call). The page is measured
+# with each number of rows, each time in a transaction that is rolled back
+# afterwards, after one untimed request and with an empty fragment cache so
+# cached listings can't hide queries. The test fails when the query count
+# grows with the rows or goes over max_queries.
+#
+#     @query_budget(8)
+#     def testCommentPage(self, rows):
+#         make_comments(self.thread, rows)
+#         return self.comment_url
+def query_budget(max_queries=None, rows=(10, 1000), using=DEFAULT_DB_ALIAS):
+
+    def decorator(test):
+
+        @functools.wraps(test)
+        def wrapper(self):
+            recorders = []
+
+            for count in rows:
+                with transaction.atomic(using=using):
+                    target = test(self, count)
+                    request = target if callable(target) else functools.partial(self.client.get, target)
+
+                    status = getattr(request(), 'status_code', 200)
+                    self.assertLess(status, 400, "%s answered %d" % (target, status))
+
+                    fragments.get_cache().clear()
+
+                    with QueryRecorder(using) as recorder:
+                        request()
+
+                    recorders.append(recorder)
+                    transaction.set_rollback(True, using=using)
+
+            labels = ['%d rows' % count for count in rows]
+
+            for small, large, fewer, more in zip(recorders, recorders[1:], labels, labels[1:]):
+                assert_no_growth(self, small, large, (fewer, more))
+
+            if max_queries is not None:
+                for recorder, label in zip(recorders, labels):
+                    assert_budget(self, recorder, max_queries, label)
+
+        return wrapper
+
+    return decorator
@@ -1,14 +1,26 @@
-import datetime, json
+import datetime, gzip, io, json, re, sqlite3, tempfile, threading, time
 from contextlib import contextmanager
-from django.test import TestCase, Client
-from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
+from django.db import OperationalError, connection, connections, router, transaction
+from django.test.utils import CaptureQueriesContext
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from django.core.exceptions import MiddlewareNotUsed, ValidationError
 
 from django.utils import timezone
+from django.utils.http import http_date
 from django.urls import reverse
+from django.template import Context, Template
 
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
-from .models import Channel, Thread, Comment, UserSettings
+from .models import Channel, ChannelMembership, Favorite, PendingPurge, Thread, Comment, UserSettings
+from .pagination import CursorEncoder, EstimatedCountPaginator, KeysetPaginator, InvalidCursor
+from .permissions import get_channel_permissions
+from . import export, fragments, importer, live, metrics, ownership, purge, routers, search, sqlite, touch
+from .testing import QueryRecorder, normalize_sql, query_budget
+from .users import defer_owners, get_user
+from .views import post_comment
 
 #Allow easy testing for validation errors
 class ValidationErrorTestMixin(object):
@@ -107,8 +119,7 @@ class ChannelTests(ValidationErrorTestMixin, TestCase):
         subthread = create_thread(channel, owner)
 
         # set moderator
-        channel.moderators = json.dumps([otheruser.username])
-        channel.save()
+        ChannelMembership.objects.create(channel=channel, user=otheruser, role=ChannelMembership.MODERATOR)
 
         #delete channel and see if the owner was changed to to the otheruser
         owner.delete()
@@ -487,8 +498,10 @@ class UserTests(ValidationErrorTestMixin, TestCase):
 
         owner.delete()
 
-        # Channel and its children should be gone (this tests cascade deletion
-        #   for channels->threads->comments)
+        # the channel is hidden at once, and purged with its children later
+        self.assertFalse(Channel.objects.filter(owner=None, hidden_date=None).exists())
+        purge.drain(pause=0)
+
         self.assertFalse(Channel.objects.filter(owner=None).exists())
         self.assertFalse(Thread.objects.filter(channel=None).exists())
         self.assertFalse(Comment.objects.filter(thread=None).exists())
@@ -498,6 +511,91 @@ class UserTests(ValidationErrorTestMixin, TestCase):
         self.assertTrue(Thread.objects.filter(channel__channel_name=self.channel_name2, thread_id=thread_id2).exists())
         self.assertTrue(Comment.objects.filter(thread__channel__channel_name=self.channel_name2, thread__thread_id=otherthread_id, comment_id=comment_id2).exists())
 
+    ## Channels go to their longest-serving moderator; other ownerless channels are left alone
+    def testUserDeleteReassignsChannels(self):
+        owner = User.objects.create(username=self.username)
+        first, second = make_users(2, 'mod')
+
+        channel = create_channel(self.channel_name, owner)
+        ChannelMembership.objects.create(channel=channel, user=first, role=ChannelMembership.MODERATOR)
+        ChannelMembership.objects.create(channel=channel, user=second, role=ChannelMembership.MODERATOR)
+        create_channel(self.channel_name2, None)
+
+        owner.delete()
+
+        channel.refresh_from_db()
+        self.assertEqual(channel.owner_id, first.username)
+        self.assertEqual(list(channel.moderator_names()), [second.username])
+        self.assertTrue(Channel.objects.filter(pk=self.channel_name2, owner=None).exists())
+
+    ## Deleting many users costs the same number of queries as deleting a few
+    def testBulkUserDelete(self):
+        survivor = User.objects.create(username=self.username)
+
+        def delete(count, prefix):
+            users = make_users(count, prefix)
+            channels = [create_channel('%s-channel%d' % (prefix, i), user) for i, user in enumerate(users)]
+
+            # every other channel has a moderator who survives, the rest one who is deleted too
+            for i, channel in enumerate(channels):
+                moderator = survivor if i % 2 else users[(i + 1) % count]
+                ChannelMembership.objects.create(channel=channel, user=moderator, role=ChannelMembership.MODERATOR)
+
+            with CaptureQueriesContext(connection) as queries:
+                ownership.delete_users(User.objects.filter(username__startswith=prefix))
+
+            names = [channel.channel_name for channel in channels]
+            self.assertEqual(Channel.objects.filter(pk__in=names, hidden_date=None).count(), count // 2)
+            self.assertFalse(Channel.objects.filter(pk__in=names, hidden_date=None).exclude(owner=survivor).exists())
+            self.assertEqual(PendingPurge.objects.filter(channel__in=names).count(), count - count // 2)
+            self.assertFalse(survivor.channel_memberships.exists())
+            return len(queries)
+
+        self.assertEqual(delete(4, 'few'), delete(40, 'many'))
+
+    ## The admin's bulk delete action goes through delete_users
+    def testAdminBulkUserDelete(self):
+        admin_user = User.objects.create(username=self.username, is_staff=True, is_superuser=True)
+        owner, moderator = make_users(2, 'adminbulk')
+        channel = create_channel(self.channel_name, owner)
+        other = create_channel(self.channel_name2, owner)
+        ChannelMembership.objects.create(channel=channel, user=moderator, role=ChannelMembership.MODERATOR)
+
+        deleted = []
+        delete_users = ownership.delete_users
+        ownership.delete_users = lambda queryset: deleted.append(sorted(queryset.values_list('username', flat=True))) \
+                or delete_users(queryset)
+
+        self.client.force_login(admin_user)
+        try:
+            response = self.client.post(reverse('admin:auth_user_changelist'), {'action': 'delete_selected', \
+                    'post': 'yes', '_selected_action': [owner.pk]})
+        finally:
+            ownership.delete_users = delete_users
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(deleted, [[owner.username]])
+        self.assertEqual(Channel.objects.get(pk=self.channel_name).owner_id, moderator.username)
+        self.assertFalse(Channel.objects.filter(pk=self.channel_name2, hidden_date=None).exists())
+
+    ## Users deleted one by one inside deferred_reassignment are handled together
+    def testDeferredReassignment(self):
+        owner, moderator, survivor = make_users(3, 'deferred')
+        channel = create_channel(self.channel_name, owner)
+        other = create_channel(self.channel_name2, owner)
+        ChannelMembership.objects.create(channel=channel, user=moderator, role=ChannelMembership.MODERATOR)
+        ChannelMembership.objects.create(channel=channel, user=survivor, role=ChannelMembership.MODERATOR)
+
+        with ownership.deferred_reassignment():
+            owner.delete()
+
+            # nothing changes before the block ends
+            self.assertTrue(Channel.objects.filter(pk=self.channel_name2, owner=None).exists())
+            moderator.delete()
+
+        self.assertEqual(Channel.objects.get(pk=self.channel_name).owner_id, survivor.username)
+        self.assertFalse(Channel.objects.filter(pk=self.channel_name2, hidden_date=None).exists())
+
     def testUniqueUser(self):
         user1 = User.objects.create(username=self.username)
         user2 = User.objects.create(username=self.username2)
@@ -514,4 +612,1937 @@ class UserTests(ValidationErrorTestMixin, TestCase):
         pass
 
     def testChannelBanUser(self):
-        pass
+        password = "P@ssw0rd1"
+        owner = User.objects.create_user(username=self.username, password=password)
+        user = User.objects.create(username=self.username2)
+        channel = create_channel(self.channel_name, owner)
+        url = reverse('forumapp:user', kwargs={'username': user.username})
+
+        self.client.login(username=self.username, password=password)
+
+        self.client.post(url, {'promote_mod': '', 'channel_name': channel.channel_name})
+        self.assertEqual(list(channel.moderator_names()), [user.username])
+
+        # banning a moderator replaces their role
+        self.client.post(url, {'channel_ban': '', 'channel_name': channel.channel_name})
+        self.assertEqual(list(channel.moderator_names()), [])
+        self.assertEqual(list(channel.banned_names()), [user.username])
+
+        # banned users can't be promoted
+        response = self.client.post(url, {'promote_mod': '', 'channel_name': channel.channel_name}, follow=True)
+        self.assertContains(response, "Channel-banned users cannot be promoted.")
+        self.assertEqual(list(channel.moderator_names()), [])
+
+        self.client.post(url, {'channel_unban': '', 'channel_name': channel.channel_name})
+        self.assertFalse(channel.memberships.exists())
+
+    def testMembershipHelpers(self):
+        from .templatetags import user_helpers
+
+        owner = User.objects.create(username=self.username)
+        user = User.objects.create(username=self.username2)
+        modded = create_channel(self.channel_name, owner)
+        banned = create_channel(self.channel_name2, owner)
+        free = create_channel(self.channel_name + "free", owner)
+
+        ChannelMembership.objects.create(channel=modded, user=user, role=ChannelMembership.MODERATOR)
+        ChannelMembership.objects.create(channel=banned, user=user, role=ChannelMembership.BANNED)
+
+        self.assertQuerysetEqual(user_helpers.get_owned_channels_moderated_by_user(owner, user), [modded])
+        self.assertQuerysetEqual(user_helpers.get_owned_channels_not_moderated_by_user(owner, user), [free])
+        self.assertQuerysetEqual(user_helpers.get_moderated_channels_only_banned(owner, user), [banned])
+        self.assertQuerysetEqual(user_helpers.get_moderated_channels_minus_banned(owner, user), [free])
+        self.assertTrue(user_helpers.is_banned_from(user, banned.channel_name))
+        self.assertFalse(user_helpers.is_banned_from(user, modded.channel_name))
+
+        # moderators can ban in channels they moderate
+        self.assertQuerysetEqual(user_helpers.get_moderated_channels_minus_banned(user, owner), [])
+
+        # deleted channels are left out of every menu
+        for channel in (modded, banned, free):
+            channel.hide()
+
+        self.assertQuerysetEqual(user_helpers.get_owned_channels(owner), [])
+        self.assertQuerysetEqual(user_helpers.get_owned_channels_moderated_by_user(owner, user), [])
+        self.assertQuerysetEqual(user_helpers.get_owned_channels_not_moderated_by_user(owner, user), [])
+        self.assertQuerysetEqual(user_helpers.get_moderated_channels_only_banned(owner, user), [])
+        self.assertQuerysetEqual(user_helpers.get_moderated_channels_minus_banned(owner, user), [])
+
+## Keyset pagination tests
+@override_settings(FORUM_PAGE_SIZE=2)
+class PaginationTests(TestCase):
+    username = "pageowner"
+    channel_name = "pagedchannel"
+
+    def setUp(self):
+        self.owner = User.objects.create(username=self.username)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+
+    def testCommentPagesNewestFirst(self):
+        comments = [create_comment(self.thread, self.owner, text="comment%d" % i, days=i-5) for i in range(5)]
+        url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+
+        response = self.client.get(url)
+        page = response.context['page']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c.comment_id for c in response.context['comment_list']], [4, 3])
+        self.assertTrue(page.has_next)
+        self.assertFalse(page.has_previous)
+
+        response = self.client.get(url, {'after': page.next_cursor})
+        page = response.context['page']
+
+        self.assertEqual([c.comment_id for c in response.context['comment_list']], [2, 1])
+        self.assertTrue(page.has_previous)
+
+        response = self.client.get(url, {'after': page.next_cursor})
+        last = response.context['page']
+
+        self.assertEqual([c.comment_id for c in response.context['comment_list']], [0])
+        self.assertFalse(last.has_next)
+
+        # step back to the newer page
+        response = self.client.get(url, {'before': last.previous_cursor})
+
+        self.assertEqual([c.comment_id for c in response.context['comment_list']], [2, 1])
+
+    def testSamePubDateUsesCommentId(self):
+        date = timezone.now()
+        for i in range(3):
+            Comment.objects.create(thread=self.thread, owner=self.owner, text="same", pub_date=date)
+
+        paginator = KeysetPaginator(Comment.objects.filter(thread=self.thread), ('-pub_date', '-comment_id'), 2)
+        first = paginator.page()
+        second = paginator.page(after=first.next_cursor)
+
+        self.assertEqual([c.comment_id for c in first], [2, 1])
+        self.assertEqual([c.comment_id for c in second], [0])
+
+    def testPinnedThreadsFirst(self):
+        threads = [create_thread(self.channel, self.owner, name="thread%d" % i) for i in range(4)]
+        threads[0].pin_date = timezone.now()
+        threads[0].save()
+
+        paginator = KeysetPaginator(Thread.objects.filter(channel=self.channel), \
+                ('pin_date', '-recent_date', '-thread_id'), 2)
+
+        seen = []
+        page = paginator.page()
+        while True:
+            seen.extend(t.thread_id for t in page)
+            if not page.has_next:
+                break
+            page = paginator.page(after=page.next_cursor)
+
+        self.assertEqual(seen[0], threads[0].thread_id)
+        self.assertEqual(sorted(seen), sorted(t.thread_id for t in Thread.objects.filter(channel=self.channel)))
+
+        # walking back from the last page reaches the pinned thread again
+        while page.has_previous:
+            page = paginator.page(before=page.previous_cursor)
+
+        self.assertEqual(page[0].thread_id, threads[0].thread_id)
+
+    def testInvalidCursor(self):
+        url = reverse('forumapp:thread', kwargs={'channel': self.channel_name})
+
+        response = self.client.get(url, {'after': 'not-a-cursor'})
+
+        self.assertEqual(response.status_code, 404)
+
+        with self.assertRaises(InvalidCursor):
+            KeysetPaginator(Channel.objects.all(), ('-recent_date', 'channel_name'), 2).decode_cursor('W10')
+
+## Data migration from the JSON moderator/ban lists
+class MembershipMigrationTests(TransactionTestCase):
+    migrate_from = [('forumapp', '0001_initial')]
+    migrate_to = [('forumapp', '0002_channelmembership')]
+
+    def testJsonCopiedToMemberships(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        apps = executor.loader.project_state(self.migrate_from).apps
+
+        OldUser = apps.get_model('auth', 'User')
+        OldChannel = apps.get_model('forumapp', 'Channel')
+        for name in ('owner', 'mod', 'banned'):
+            OldUser.objects.create(username=name)
+
+        OldChannel.objects.create(channel_name='jsonchannel', owner_id='owner', \
+                moderators=json.dumps(['mod', 'deleted', 'banned']), banned_users=json.dumps(['banned']))
+
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(self.migrate_to)
+        apps = executor.loader.project_state(self.migrate_to).apps
+
+        Membership = apps.get_model('forumapp', 'ChannelMembership')
+        roles = dict(Membership.objects.values_list('user_id', 'role'))
+
+        self.assertEqual(roles, {'mod': ChannelMembership.MODERATOR, 'banned': ChannelMembership.BANNED})
+
+        # leave the database fully migrated for the following tests
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+## Channel permissions are resolved once per request
+class PermissionTests(TestCase):
+    username = "permowner"
+    username2 = "permmod"
+    channel_name = "permchannel"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.owner = User.objects.create(username=self.username)
+        self.mod = User.objects.create_user(username=self.username2, password=self.password)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+
+        ChannelMembership.objects.create(channel=self.channel, user=self.mod, role=ChannelMembership.MODERATOR)
+
+    # count the queries a page runs that aren't loading the rows' owners
+    def countQueries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        return len([q for q in queries if 'FROM "auth_user"' not in q['sql']])
+
+    def testPermissions(self):
+        perms = get_channel_permissions(self.mod, self.channel_name)
+
+        self.assertTrue(perms.is_moderator)
+        self.assertFalse(perms.is_owner)
+        self.assertFalse(perms.is_banned)
+        self.assertIs(perms, get_channel_permissions(self.mod, self.channel_name))
+        self.assertTrue(get_channel_permissions(self.owner, self.channel_name).is_owner)
+
+        perms = get_channel_permissions(User.objects.get(username=self.username2), "missingchannel")
+
+        self.assertFalse(perms.exists)
+        self.assertFalse(perms.is_moderator)
+
+    def testCommentPageQueryCount(self):
+        self.client.login(username=self.username2, password=self.password)
+        url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+
+        create_comment(self.thread, self.owner)
+        few = self.countQueries(url)
+
+        for i in range(20):
+            create_comment(self.thread, self.owner)
+        many = self.countQueries(url)
+
+        self.assertEqual(few, many)
+
+    def testThreadPageQueryCount(self):
+        self.client.login(username=self.username2, password=self.password)
+        url = reverse('forumapp:thread', kwargs={'channel': self.channel_name})
+
+        few = self.countQueries(url)
+
+        for i in range(20):
+            create_thread(self.channel, self.owner, name="thread%d" % i)
+        many = self.countQueries(url)
+
+        self.assertEqual(few, many)
+
+## Favorites tests
+class FavoriteTests(TestCase):
+    username = "favuser"
+    channel_name = "fav-channel"
+    channel_name2 = "otherfavchannel"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.user = User.objects.create_user(username=self.username, password=self.password)
+        self.channel = create_channel(self.channel_name, self.user)
+        self.channel2 = create_channel(self.channel_name2, self.user)
+        self.client.login(username=self.username, password=self.password)
+
+    def testToggleFavorite(self):
+        url = reverse('forumapp:favorites')
+
+        self.client.post(reverse('forumapp:channel'), {'add_favorite': '', 'channel_name': self.channel_name})
+        self.client.post(reverse('forumapp:channel'), {'add_favorite': '', 'channel_name': self.channel_name})
+
+        self.assertEqual(Favorite.objects.filter(user=self.user).count(), 1)
+
+        response = self.client.get(url)
+
+        self.assertQuerysetEqual(response.context['favorites_list'], [self.channel])
+        self.assertContains(response, "Unfavorite")
+
+        response = self.client.post(url, {'add_favorite': '', 'channel_name': self.channel_name}, follow=True)
+        self.assertContains(response, "Channel already in favorites")
+
+        self.client.post(url, {'remove_favorite': '', 'channel_name': self.channel_name})
+        response = self.client.post(url, {'remove_favorite': '', 'channel_name': self.channel_name}, follow=True)
+
+        self.assertContains(response, "Channel not found in favorites")
+        self.assertFalse(Favorite.objects.filter(user=self.user).exists())
+
+    def testFavoritesLoadedOnce(self):
+        Favorite.objects.create(user=self.user, channel=self.channel)
+        Favorite.objects.create(user=self.user, channel=self.channel2)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('forumapp:channel'))
+
+        self.assertContains(response, "Unfavorite", count=2)
+        self.assertEqual(len([q for q in queries if 'forumapp_favorite' in q['sql']]), 1)
+
+## Concurrent id allocation
+class SequenceTests(TransactionTestCase):
+    posters = 8
+    posts = 10
+
+    def testAllocateBlock(self):
+        owner = User.objects.create(username="seqowner")
+        channel = create_channel("seqchannel", owner)
+        thread = create_thread(channel, owner)
+
+        self.assertEqual(list(thread.allocate_comment_ids(3)), [0, 1, 2])
+        self.assertEqual(create_comment(thread, owner).comment_id, 3)
+        self.assertEqual(list(channel.allocate_thread_ids(2)), [1, 2])
+        self.assertEqual(create_thread(channel, owner).thread_id, 3)
+
+    def testConcurrentComments(self):
+        owner = User.objects.create(username="seqowner")
+        channel = create_channel("seqchannel", owner)
+        thread = create_thread(channel, owner)
+        errors = []
+
+        def post():
+            try:
+                for i in range(self.posts):
+                    create_comment(thread, owner)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        posters = [threading.Thread(target=post) for i in range(self.posters)]
+        for poster in posters:
+            poster.start()
+        for poster in posters:
+            poster.join()
+
+        ids = list(Comment.objects.filter(thread=thread).values_list('comment_id', flat=True))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(ids), list(range(self.posters * self.posts)))
+
+## Denormalized activity counters
+class ActivityTests(TestCase):
+    username = "activeowner"
+    username2 = "activeposter"
+    channel_name = "activechannel"
+
+    def setUp(self):
+        self.owner = User.objects.create(username=self.username)
+        self.poster = User.objects.create(username=self.username2)
+        self.channel = create_channel(self.channel_name, self.owner)
+
+    def assertCounts(self, channel_threads, channel_comments, thread=None, thread_comments=None):
+        channel = Channel.objects.get(pk=self.channel_name)
+
+        self.assertEqual((channel.thread_count, channel.comment_count), (channel_threads, channel_comments))
+
+        if thread is not None:
+            self.assertEqual(Thread.objects.get(pk=thread.pk).comment_count, thread_comments)
+
+    def testCountersFollowCreateAndDelete(self):
+        thread = create_thread(self.channel, self.owner)
+        other = create_thread(self.channel, self.owner)
+        create_comment(thread, self.owner, days=-1)
+        last = create_comment(thread, self.poster)
+        create_comment(other, self.owner, days=-2)
+
+        self.assertCounts(2, 3, thread, 2)
+
+        channel = Channel.objects.get(pk=self.channel_name)
+        self.assertEqual((channel.last_thread_id, channel.last_comment_id, channel.last_comment_owner_id), \
+                (thread.thread_id, last.comment_id, self.username2))
+
+        # deleting the newest comment falls back to the next newest
+        last.delete()
+        self.assertCounts(2, 2, thread, 1)
+
+        thread = Thread.objects.get(pk=thread.pk)
+        self.assertEqual(thread.last_comment_owner_id, self.username)
+
+        # deleting a thread removes its comments from the channel
+        thread.delete()
+        self.assertCounts(1, 1)
+
+        channel = Channel.objects.get(pk=self.channel_name)
+        self.assertEqual(channel.last_thread_id, other.thread_id)
+
+    def testCommentViewDeletesKeepCounts(self):
+        password = "P@ssw0rd1"
+        self.owner.set_password(password)
+        self.owner.save()
+        self.client.login(username=self.username, password=password)
+
+        thread = create_thread(self.channel, self.owner)
+        comment = create_comment(thread, self.poster)
+        create_comment(thread, self.poster)
+        url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': thread.thread_id})
+
+        self.client.post(url, {'delete_comment': '', 'comment_id': comment.comment_id})
+        self.assertCounts(1, 1, thread, 1)
+
+        self.client.post(url, {'delete_thread': ''})
+        self.assertCounts(0, 0)
+
+    def testRecountActivity(self):
+        thread = create_thread(self.channel, self.owner)
+        create_comment(thread, self.poster)
+        create_comment(thread, self.owner)
+
+        Channel.objects.update(thread_count=10, comment_count=10, last_comment_owner=None)
+        Thread.objects.update(comment_count=10)
+
+        call_command('recount_activity', stdout=io.StringIO())
+
+        self.assertCounts(1, 2, thread, 2)
+        self.assertEqual(Channel.objects.get(pk=self.channel_name).last_comment_owner_id, self.username)
+
+    def testListingShowsCounts(self):
+        thread = create_thread(self.channel, self.owner)
+        create_comment(thread, self.poster)
+
+        response = self.client.get(reverse('forumapp:channel'))
+        self.assertContains(response, "1 thread / 1 comment")
+
+        response = self.client.get(reverse('forumapp:thread', kwargs={'channel': self.channel_name}))
+        self.assertContains(response, "1 comment")
+        self.assertContains(response, self.username2)
+
+class SearchTests(TestCase):
+    username = "searchowner"
+    channel_name = "searchchannel"
+    other_name = "otherchannel"
+
+    def setUp(self):
+        self.owner = User.objects.create(username=self.username, is_staff=True, is_superuser=True)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.other = create_channel(self.other_name, self.owner)
+
+        self.thread = create_thread(self.channel, self.owner, name="Gardening tips", desc="about plants")
+        self.comment = create_comment(self.thread, self.owner, text="Tomatoes need plenty of sun & water")
+        other_thread = create_thread(self.other, self.owner, name="Cooking", desc="recipes")
+        create_comment(other_thread, self.owner, text="Tomato soup with garden herbs")
+
+    def testTitleRanksFirst(self):
+        page = search.search("gardening")
+        self.assertEqual(page.object_list[0].rowid, -self.thread.pk)
+
+        # the last word matches as a prefix
+        rowids = {result.rowid for result in search.search("tomat")}
+        self.assertEqual(len(rowids), 2)
+
+    def testChannelAndBans(self):
+        page = search.search("tomat", channel=self.channel_name)
+        self.assertEqual([result.object_id for result in page], [self.comment.pk])
+
+        banned = User.objects.create(username="searchbanned")
+        ChannelMembership.objects.create(channel=self.channel, user=banned, role=ChannelMembership.BANNED)
+        self.assertEqual([result.channel for result in search.search("tomat", user=banned)], [self.other_name])
+
+    def testSnippetEscaped(self):
+        result = search.search("sun").object_list[0]
+        self.assertIn("<mark>sun</mark> &amp; water", result.highlighted())
+
+        # query syntax in user input is treated as plain words
+        self.assertEqual(len(search.search('sun" OR NEAR(')), 0)
+
+    def testCursor(self):
+        for i in range(5):
+            create_comment(self.thread, self.owner, text="tomato number %d" % i)
+
+        first = search.search("tomato", per_page=4)
+        second = search.search("tomato", after=first.next_cursor, per_page=4)
+
+        self.assertTrue(first.has_next)
+        self.assertFalse(second.has_next)
+        rowids = [result.rowid for result in list(first) + list(second)]
+        self.assertEqual(len(set(rowids)), 7)
+
+    def testIndexFollowsChanges(self):
+        self.comment.text = "Cucumbers instead"
+        self.comment.save()
+        self.assertEqual(search.matching_ids("cucumbers"), [self.comment.pk])
+        self.assertNotIn(self.comment.pk, search.matching_ids("tomatoes"))
+
+        self.comment.delete()
+        self.assertEqual(search.matching_ids("cucumbers"), [])
+
+        self.thread.delete()
+        self.assertEqual(search.matching_ids("gardening", threads=True), [])
+
+    def testRebuildIndex(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM forumapp_search")
+
+        out = io.StringIO()
+        call_command('rebuild_search_index', '--chunk-size', '1', stdout=out)
+        self.assertIn("Indexed 4", out.getvalue())
+        self.assertEqual(search.matching_ids("gardening", threads=True), [self.thread.pk])
+
+    # the triggers index comments posted while the rebuild runs
+    def testRebuildWhilePosting(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM forumapp_search")
+
+        posted = []
+
+        def progress(count):
+            if not posted:
+                posted.append(create_comment(self.thread, self.owner, text="posted during the rebuild"))
+
+        self.assertEqual(search.rebuild_index(chunk_size=1, progress=progress), 4)
+        self.assertEqual(search.matching_ids("rebuild"), [posted[0].pk])
+        self.assertEqual(len(search.matching_ids("tomat")), 2)
+
+    def testSearchViewAndAdmin(self):
+        response = self.client.get(reverse('forumapp:search'), {'q': 'tomatoes'})
+        self.assertContains(response, "<mark>Tomatoes</mark>")
+
+        response = self.client.get(reverse('forumapp:search'), {'q': 'tomatoes', 'after': 'bad'})
+        self.assertEqual(response.status_code, 404)
+
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('admin:forumapp_comment_changelist'), {'q': 'soup'})
+        self.assertContains(response, "1 result")
+        self.assertEqual([obj.pk for obj in response.context['cl'].result_list], \
+                search.matching_ids("soup"))
+
+        response = self.client.get(reverse('admin:forumapp_thread_changelist'), {'q': 'gardening'})
+        self.assertEqual([obj.pk for obj in response.context['cl'].result_list], [self.thread.pk])
+
+class FragmentCacheTests(TestCase):
+    username = "fragowner"
+    username2 = "fragreader"
+    channel_name = "fragchannel"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.reader = User.objects.create_user(username=self.username2, password=self.password)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+
+        for i in range(3):
+            create_comment(self.thread, self.owner, text="fragment comment %d" % i)
+
+        self.url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+        fragments.reset_stats()
+
+    # the primary read as a replica, which hasn't applied the rename yet when
+    # the page is first read from it
+    @override_settings(FORUM_READ_REPLICAS=['default'])
+    def testStaleReplicaLeavesFragmentsAlone(self):
+        url = reverse('forumapp:thread', kwargs={'channel': self.channel_name})
+        fragments.invalidate('thread', self.thread.pk)
+
+        self.assertContains(self.client.get(url), self.thread.thread_name)
+        self.assertEqual(fragments.get_stats()['misses'], 1)
+
+        Thread.objects.filter(pk=self.thread.pk).update(thread_name="renamed thread")
+        self.assertContains(self.client.get(url), "renamed thread")
+        self.assertEqual(fragments.get_stats()['misses'], 2)
+
+        # pages read from the primary still fill the cache
+        with override_settings(FORUM_READ_REPLICAS=[]):
+            self.client.get(url)
+            self.assertContains(self.client.get(url), "renamed thread")
+
+        self.assertEqual(fragments.get_stats()['hits'], 1)
+
+    def testSecondRenderHits(self):
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(self.url)
+
+        self.assertEqual(fragments.get_stats()['misses'], 3)
+
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(self.url)
+
+        self.assertEqual(fragments.get_stats()['hits'], 3)
+        self.assertContains(response, "fragment comment 2")
+
+        # the owners of cached comments aren't loaded again
+        self.assertLess(len(second), len(first))
+
+    def testWritesBumpVersion(self):
+        thread_url = reverse('forumapp:thread', kwargs={'channel': self.channel_name})
+        self.assertContains(self.client.get(thread_url), "3 comments")
+
+        self.client.login(username=self.username2, password=self.password)
+        self.client.post(self.url, {'create': '', 'text': "a brand new comment"})
+
+        self.assertContains(self.client.get(self.url), "a brand new comment")
+        self.assertContains(self.client.get(thread_url), "4 comments")
+
+        self.thread.thread_name = "renamed thread"
+        self.thread.save()
+        self.assertContains(self.client.get(thread_url), "renamed thread")
+
+    def testRolesCachedSeparately(self):
+        self.client.get(self.url)
+
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(self.url)
+
+        # the owner moderates the channel, so gets the layout with delete buttons
+        self.assertContains(response, "small-7 medium-8 large-10", count=3)
+        self.assertContains(response, 'name="delete_comment"', count=3)
+        self.assertEqual(fragments.get_stats()['hits'], 0)
+
+    def testFormsNotCached(self):
+        self.client.login(username=self.username, password=self.password)
+        self.client.get(self.url)
+
+        # a second moderator gets cached listings but a working delete form
+        other = Client(enforce_csrf_checks=True)
+        other.login(username=self.username, password=self.password)
+        response = other.get(self.url)
+        self.assertEqual(fragments.get_stats()['hits'], 3)
+
+        token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', response.content.decode()).group(1)
+        comment = Comment.objects.filter(thread=self.thread).first()
+        other.post(self.url, {'delete_comment': '', 'comment_id': comment.comment_id, 'csrfmiddlewaretoken': token})
+
+        self.assertFalse(Comment.objects.filter(pk=comment.pk).exists())
+
+    def testFileBasedCache(self):
+        with tempfile.TemporaryDirectory() as path:
+            caches = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': path}}
+
+            with override_settings(CACHES=caches):
+                self.client.get(self.url)
+                create_comment(self.thread, self.owner, text="after the first render")
+                response = self.client.get(self.url)
+
+        self.assertContains(response, "after the first render")
+        self.assertEqual(fragments.get_stats(), {'hits': 0, 'misses': 7, 'hit_rate': 0.0})
+
+class ConditionalGetTests(TestCase):
+    username = "etagowner"
+    username2 = "etagreader"
+    channel_name = "etagchannel"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.reader = User.objects.create_user(username=self.username2, password=self.password)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+        create_comment(self.thread, self.owner)
+
+        self.thread_url = reverse('forumapp:thread', kwargs={'channel': self.channel_name})
+        self.comment_url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code
+
+    def testNotModified(self):
+        etag = self.client.get(self.comment_url)['ETag']
+
+        # the check is a single query that touches neither comments nor templates
+        with self.assertNumQueries(1):
+            response = self.client.get(self.comment_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+
+        # no date covers deletes and unpins, so there's no Last-Modified to check against
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(self.client.get(self.comment_url, HTTP_IF_MODIFIED_SINCE=http_date()).status_code, 200)
+
+        create_comment(self.thread, self.reader)
+        self.assertEqual(self.revalidate(self.comment_url, etag), 200)
+
+    def testCommentDeleteChangesEtag(self):
+        comment = create_comment(self.thread, self.reader)
+        etag = self.client.get(self.comment_url)['ETag']
+
+        comment.delete()
+        self.assertEqual(self.revalidate(self.comment_url, etag), 200)
+
+    def testThreadListChanges(self):
+        etag = self.client.get(self.thread_url)['ETag']
+        self.assertEqual(self.revalidate(self.thread_url, etag), 304)
+
+        self.thread.pin_date = timezone.now()
+        self.thread.save()
+        etag = self.client.get(self.thread_url)['ETag']
+        self.assertEqual(self.revalidate(self.thread_url, etag), 304)
+
+        self.thread.pin_date = None
+        self.thread.save()
+        self.assertEqual(self.revalidate(self.thread_url, etag), 200)
+
+        etag = self.client.get(self.thread_url)['ETag']
+        create_thread(self.channel, self.reader, name="another")
+        self.assertEqual(self.revalidate(self.thread_url, etag), 200)
+
+    def testViewerAndBans(self):
+        anonymous = self.client.get(self.comment_url)['ETag']
+
+        self.client.login(username=self.username2, password=self.password)
+        response = self.client.get(self.comment_url)
+        self.assertNotEqual(response['ETag'], anonymous)
+        self.assertIn('private', response['Cache-Control'])
+
+        ChannelMembership.objects.create(channel=self.channel, user=self.reader, role=ChannelMembership.BANNED)
+        self.assertEqual(self.revalidate(self.comment_url, response['ETag']), 200)
+
+    def testPendingMessagesRender(self):
+        self.client.login(username=self.username2, password=self.password)
+        etag = self.client.get(self.comment_url)['ETag']
+
+        # a too short comment is rejected with a message shown on the next page
+        self.client.post(self.comment_url, {'create': '', 'text': "no"})
+        response = self.client.get(self.comment_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+class CreatePipelineTests(ValidationErrorTestMixin, TestCase):
+    username = "pipeowner"
+    channel_name = "pipechannel"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+        self.client.login(username=self.username, password=self.password)
+
+        self.thread_url = reverse('forumapp:thread', kwargs={'channel': self.channel_name})
+        self.comment_url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+
+    def countWrites(self, url, data):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url, data)
+
+        writes = [q for q in queries if q['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        return len([q for q in writes if 'django_session' not in q['sql']])
+
+    def testRejectedPostsWriteNothing(self):
+        self.assertEqual(self.countWrites(self.comment_url, {'create': '', 'text': "short"}), 0)
+        self.assertEqual(self.countWrites(self.thread_url, {'create': '', 'thread_name': "short", 'description': "a description"}), 0)
+
+        # no ids were used up by the rejected posts
+        comment = create_comment(self.thread, self.owner)
+        self.assertEqual(comment.comment_id, 0)
+        self.assertEqual(create_thread(self.channel, self.owner).thread_id, 1)
+
+    def testPostWrites(self):
+        # counter update with the snapshot, insert, channel update
+        self.assertEqual(self.countWrites(self.comment_url, {'create': '', 'text': "a fine comment"}), 3)
+        self.assertEqual(self.countWrites(self.thread_url, {'create': '', 'thread_name': "a new thread", \
+                'description': "a description"}), 2)
+
+        thread = Thread.objects.get(pk=self.thread.pk)
+        channel = Channel.objects.get(pk=self.channel_name)
+
+        self.assertEqual((thread.comment_count, thread.last_comment_id), (1, 0))
+        self.assertEqual((channel.thread_count, channel.comment_count, channel.last_comment_owner_id), (2, 1, self.username))
+        self.assertGreater(thread.recent_date, self.thread.recent_date)
+        self.assertGreater(channel.recent_date, self.channel.recent_date)
+
+    def testValidateUniqueHonorsExclude(self):
+        comment = Comment(thread=self.thread, comment_id=create_comment(self.thread, self.owner).comment_id)
+
+        with self.assertNumQueries(0):
+            comment.validate_unique(exclude=['thread', 'comment_id'])
+
+        with self.assertValidationErrors(['thread', 'comment_id']):
+            comment.validate_unique()
+
+    def testBenchWrites(self):
+        out = io.StringIO()
+        call_command('bench_writes', '--posts', '2', stdout=out)
+
+        self.assertIn("validate first", out.getvalue())
+        self.assertFalse(Channel.objects.filter(pk='bench-writes').exists())
+
+@override_settings(FORUM_TOUCH_BUFFER=True, FORUM_TOUCH_INTERVAL=60, FORUM_TOUCH_MAX_STALENESS=60)
+class TouchBufferTests(TestCase):
+    username = "touchowner"
+    channel_name = "touchchannel"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.channel = create_channel(self.channel_name, self.owner, days=-1)
+        self.thread = create_thread(self.channel, self.owner, days=-1)
+        Channel.objects.update(recent_date=self.channel.pub_date)
+        Thread.objects.update(recent_date=self.thread.pub_date)
+
+        self.url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+        self.client.login(username=self.username, password=self.password)
+
+    def tearDown(self):
+        touch.flush()
+
+    def recentDates(self):
+        return Channel.objects.get(pk=self.channel_name).recent_date, Thread.objects.get(pk=self.thread.pk).recent_date
+
+    def testCoalescedFlush(self):
+        buffer = touch.get_buffer()
+        now = timezone.now()
+
+        for days in (-3, 0, -2):
+            buffer.touch(self.channel_name, now + datetime.timedelta(days=days))
+        self.assertEqual(len(buffer), 1)
+
+        # one update, keeping the newest date
+        with self.assertNumQueries(1):
+            self.assertEqual(buffer.flush(), 1)
+
+        self.assertEqual(self.recentDates()[0], now)
+
+        # an older touch doesn't move a newer recent_date back
+        buffer.touch(self.channel_name, now - datetime.timedelta(hours=1))
+        buffer.flush()
+        self.assertEqual(self.recentDates()[0], now)
+
+    # posts write their thread but leave the channel row to the flush
+    def testPostsDeferChannel(self):
+        before = self.recentDates()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, {'create': '', 'text': "a buffered comment"})
+
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE "forumapp_channel"')])
+        self.assertEqual(Channel.objects.get(pk=self.channel_name).comment_count, 0)
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).comment_count, 1)
+        self.assertGreater(self.recentDates()[1], before[1])
+
+        touch.flush()
+        channel = Channel.objects.get(pk=self.channel_name)
+        self.assertEqual((channel.comment_count, channel.last_thread_id, channel.last_comment_id), \
+                (1, self.thread.thread_id, 0))
+        self.assertEqual(channel.recent_date, self.recentDates()[1])
+
+    # the flush recomputes the channel from its threads, so comments deleted
+    # and threads hidden before it aren't counted twice
+    def testChangesBeforeFlush(self):
+        other = create_thread(self.channel, self.owner)
+
+        for thread in (self.thread, other, other):
+            post_comment(thread, self.owner, {'text': "a buffered comment"})
+
+        Comment.objects.filter(thread=self.thread).get().delete()
+        other.hide()
+        touch.flush()
+
+        channel = Channel.objects.get(pk=self.channel_name)
+        self.assertEqual((channel.thread_count, channel.comment_count, channel.last_comment_id), (1, 0, None))
+
+    # listings cached between a post and the flush show the old row until the flush
+    def testFlushInvalidatesFragments(self):
+        version = fragments.get_cache().get(fragments.version_key('channel', self.channel_name))
+
+        touch.get_buffer().touch(self.channel_name, timezone.now())
+        touch.flush()
+
+        self.assertNotEqual(fragments.get_cache().get(fragments.version_key('channel', self.channel_name)), version)
+
+    @override_settings(FORUM_TOUCH_INTERVAL=0)
+    def testFlushedWhenRequestFinishes(self):
+        before = self.recentDates()
+        self.client.post(self.url, {'create': '', 'text': "a buffered comment"})
+
+        self.assertGreater(self.recentDates()[0], before[0])
+        self.assertEqual(Channel.objects.get(pk=self.channel_name).comment_count, 1)
+        self.assertEqual(len(touch.get_buffer()), 0)
+
+class BenchmarkTests(TestCase):
+
+    def generate(self, seed=1):
+        call_command('generate_forum', '--users', '20', '--channels', '5', '--threads', '40', '--comments', '400', \
+                '--seed', str(seed), '--clear', stdout=io.StringIO())
+
+        return list(Channel.objects.order_by('pk').values_list('pk', 'owner_id', 'thread_count', 'comment_count'))
+
+    def testGenerateForum(self):
+        channels = self.generate()
+
+        self.assertEqual((Thread.objects.count(), Comment.objects.count()), (40, 400))
+        self.assertEqual(sum(row[3] for row in channels), 400)
+        self.assertTrue(ChannelMembership.objects.exists())
+        self.assertTrue(Favorite.objects.exists())
+
+        # ids and counters are consistent, so posting continues the sequences
+        thread = Thread.objects.order_by('-comment_count').first()
+        self.assertEqual(thread.comment_seq, thread.comment_count)
+        self.assertEqual(create_comment(thread, thread.owner).comment_id, thread.comment_count)
+
+        # the same seed gives the same forum
+        self.assertEqual(self.generate(), channels)
+        self.assertNotEqual(self.generate(seed=2), channels)
+
+    def testBenchEndpoints(self):
+        self.generate()
+
+        with tempfile.TemporaryDirectory() as path:
+            output = path + '/results.json'
+            out = io.StringIO()
+            call_command('bench_endpoints', '--runs', '2', '--warmup', '0', '--output', output, stdout=out)
+
+            with open(output) as results_file:
+                results = json.load(results_file)
+
+            endpoints, summary = results['endpoints'], results['summary']
+
+            self.assertEqual(set(endpoints), {'channel', 'thread', 'comment', 'user', 'favorites'})
+            self.assertTrue(all(result['status'] == 200 and result['queries'] > 0 for result in endpoints.values()))
+            self.assertEqual(summary['max_queries'], max(result['queries'] for result in endpoints.values()))
+            self.assertIn("queries per request", out.getvalue())
+
+            call_command('bench_endpoints', '--runs', '2', '--warmup', '0', '--baseline', output, \
+                    '--tolerance', '1000', stdout=out)
+            self.assertIn("No regressions", out.getvalue())
+
+class MetricsTests(TestCase):
+    username = "metricsowner"
+    staffname = "metricsstaff"
+    channel_name = "metricschannel"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        metrics.aggregator.reset()
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.staff = User.objects.create_user(username=self.staffname, password=self.password, is_staff=True)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+        create_comment(self.thread, self.owner)
+
+        self.comment_url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+
+    def testRecordsRoute(self):
+        self.client.get(self.comment_url)
+        self.client.get(self.comment_url)
+        self.client.get('/no/such/page/')
+
+        routes = metrics.aggregator.collect()
+        stats = routes['forumapp:comment']
+
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.statuses, {('GET', 200): 2})
+        self.assertEqual(stats.renders, 2)
+        self.assertEqual(sum(stats.buckets), 2)
+        self.assertGreater(stats.queries, 0)
+        self.assertGreater(stats.response_bytes, 0)
+        self.assertEqual(routes['unmatched'].statuses, {('GET', 404): 1})
+
+    def testCollectsAllThreads(self):
+        worker = threading.Thread(target=metrics.aggregator.record, args=('x', 'GET', 200, 0.5, 3, 0.1, None, 10))
+        worker.start()
+        worker.join()
+        metrics.aggregator.record('x', 'POST', 302, 0.001, 1, 0.0, None, 0)
+
+        stats = metrics.aggregator.collect()['x']
+        self.assertEqual((stats.count, stats.queries, stats.renders), (2, 4, 0))
+        self.assertEqual(stats.statuses, {('GET', 200): 1, ('POST', 302): 1})
+
+    # finished threads are folded into the totals instead of kept one by one
+    def testRetiresFinishedThreads(self):
+        metrics.aggregator.record('x', 'GET', 200, 0.5, 1, 0.0, None, 0)
+        live = len(metrics.aggregator.threads)
+
+        for i in range(20):
+            worker = threading.Thread(target=metrics.aggregator.record, args=('x', 'GET', 200, 0.5, 1, 0.0, None, 0))
+            worker.start()
+            worker.join()
+
+        self.assertEqual(len(metrics.aggregator.threads), live)
+        self.assertEqual(metrics.aggregator.collect()['x'].count, 21)
+
+    def testStaffOnly(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.client.login(username=self.username, password=self.password)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.client.login(username=self.staffname, password=self.password)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def testToken(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer secret').status_code, 404)
+
+        with self.settings(FORUM_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+
+    def testPrometheusFormat(self):
+        self.client.get(self.comment_url)
+        self.client.login(username=self.staffname, password=self.password)
+        response = self.client.get(reverse('metrics'))
+
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+
+        self.assertIn('# TYPE forum_request_duration_seconds histogram', text)
+        self.assertIn('forum_request_duration_seconds_bucket{le="+Inf",route="forumapp:comment"} 1', text)
+        self.assertIn('forum_requests_total{method="GET",route="forumapp:comment",status="200"} 1', text)
+        self.assertIn('forum_template_renders_total{route="forumapp:comment"} 1', text)
+
+        for line in text.splitlines():
+            self.assertTrue(line.startswith('#') or re.match(r'^[a-z_]+(\{[^}]*\})? [0-9.e+-]+$', line), line)
+
+    @override_settings(FORUM_METRICS=False)
+    def testDisabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            metrics.MetricsMiddleware(lambda request: None)
+
+## Bulk helpers for the query budgets: rows owned by distinct users, so
+## nothing is shared between rows by accident
+def make_users(count, prefix):
+    users = [User(username='%s%d' % (prefix, i), password='!') for i in range(count)]
+    return User.objects.bulk_create(users)
+
+def make_channels(count, owners):
+    now = timezone.now()
+    channels = [Channel(channel_name='budget%d' % i, owner=owners[i % len(owners)], description='desc', \
+            pub_date=now, recent_date=now) for i in range(count)]
+    return Channel.objects.bulk_create(channels)
+
+def make_threads(channel, count, owners):
+    now = timezone.now()
+    Thread.objects.bulk_create([Thread(channel=channel, thread_id=i + 1, thread_name='thread%d' % i, description='desc', \
+            owner=owners[i % len(owners)], pub_date=now, recent_date=now) for i in range(count)])
+    Channel.objects.filter(pk=channel.pk).update(thread_seq=count + 1, thread_count=count + 1)
+
+def make_comments(thread, count, owners):
+    now = timezone.now()
+    Comment.objects.bulk_create([Comment(thread=thread, comment_id=i, text='text%d' % i, \
+            owner=owners[i % len(owners)], pub_date=now) for i in range(count)])
+    Thread.objects.filter(pk=thread.pk).update(comment_seq=count, comment_count=count)
+
+class QueryBudgetTests(TestCase):
+    username = "budgetowner"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.channel = create_channel("budgetchannel", self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+        self.client.login(username=self.username, password=self.password)
+
+    def testNormalizeSql(self):
+        self.assertEqual(normalize_sql('SELECT * FROM "t" WHERE "a" IN (%s, %s, %s) AND "b" = \'x\' LIMIT 21'), \
+                'SELECT * FROM "t" WHERE "a" IN (...) AND "b" = ? LIMIT ?')
+        self.assertEqual(normalize_sql('SELECT 1 FROM "t" WHERE "a" IN (%s)'), 'SELECT ? FROM "t" WHERE "a" IN (...)')
+
+    def testReportsOrigin(self):
+        owners = make_users(3, 'origin')
+        make_comments(self.thread, 3, owners)
+        template = Template('{% for comment in comments %}{{ comment.owner.username }}{% endfor %}')
+
+        with QueryRecorder() as queries:
+            template.render(Context({'comments': list(Comment.objects.filter(thread=self.thread))}))
+
+        self.assertEqual(len(queries), 4)
+        self.assertIn('3x template <string>:1 {{ comment.owner.username }}', queries.report())
+
+    def testDetectsGrowth(self):
+
+        @query_budget(rows=(2, 5))
+        def listing(test, rows):
+            owners = make_users(rows, 'grow')
+            make_comments(self.thread, rows, owners)
+            return lambda: [comment.owner.username for comment in Comment.objects.filter(thread=self.thread)]
+
+        with self.assertRaisesRegex(AssertionError, r'(?s)3 queries with 2 rows, 6 with 5 rows.*5x SELECT .*auth_user'):
+            listing(self)
+
+        # everything was rolled back
+        self.assertFalse(Comment.objects.filter(thread=self.thread).exists())
+
+    def testBudget(self):
+
+        @query_budget(1, rows=(2,))
+        def listing(test, rows):
+            return lambda: (list(Comment.objects.all()), list(Thread.objects.all()))
+
+        with self.assertRaisesRegex(AssertionError, '2 queries for 2 rows, the budget is 1'):
+            listing(self)
+
+    def testDeferOwners(self):
+        owners = make_users(2, 'defer')
+        make_comments(self.thread, 4, owners)
+        request = RequestFactory().get('/')
+        request.user = self.owner
+
+        # nothing is loaded until an owner is used, then all of them at once
+        with self.assertNumQueries(1):
+            comments = defer_owners(request, Comment.objects.filter(thread=self.thread).order_by('comment_id'))
+
+        with self.assertNumQueries(1):
+            self.assertEqual([comment.owner.username for comment in comments], ['defer0', 'defer1', 'defer0', 'defer1'])
+
+        # owners are shared, and the identity map serves later lookups
+        with self.assertNumQueries(0):
+            self.assertIs(get_user(request, 'defer0'), comments[0].owner._wrapped)
+            self.assertIs(get_user(request, self.username), self.owner)
+
+    @query_budget(5)
+    def testChannelPage(self, rows):
+        make_channels(rows, make_users(rows, 'cowner'))
+        return reverse('forumapp:channel')
+
+    @query_budget(7)
+    def testThreadPage(self, rows):
+        make_threads(self.channel, rows, make_users(rows, 'towner'))
+        return reverse('forumapp:thread', kwargs={'channel': self.channel.pk})
+
+    @query_budget(8)
+    def testCommentPage(self, rows):
+        make_comments(self.thread, rows, make_users(rows, 'mowner'))
+        return reverse('forumapp:comment', kwargs={'channel': self.channel.pk, 'thread': self.thread.thread_id})
+
+    @query_budget(5)
+    def testFavoritesPage(self, rows):
+        channels = make_channels(rows, make_users(rows, 'fowner'))
+        Favorite.objects.bulk_create([Favorite(user=self.owner, channel=channel) for channel in channels])
+        return reverse('forumapp:favorites')
+
+    @query_budget(4)
+    def testUserPage(self, rows):
+        make_channels(rows, [self.owner])
+        make_comments(self.thread, rows, [self.owner])
+        return reverse('forumapp:user', kwargs={'username': self.username})
+
+# Records which database aliases run statements
+class AliasRecorder(object):
+
+    def __init__(self):
+        self.aliases = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.aliases.append(context['connection'].alias)
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def record(self):
+        with connections['default'].execute_wrapper(self), connections['replica'].execute_wrapper(self):
+            yield self
+
+@override_settings(FORUM_READ_REPLICAS=['replica'], FORUM_PRIMARY_PIN_SECONDS=5)
+class ReplicaRoutingTests(TestCase):
+    databases = {'default', 'replica'}
+    username = "replicaowner"
+    channel_name = "replicachannel"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+        create_comment(self.thread, self.owner, text="an older comment")
+
+        self.url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+        self.client.login(username=self.username, password=self.password)
+
+    def get(self, url):
+        with AliasRecorder().record() as recorder:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        return response, set(recorder.aliases)
+
+    def testReadPagesUseReplica(self):
+        for url in [reverse('forumapp:channel'), reverse('forumapp:thread', kwargs={'channel': self.channel_name}), \
+                self.url, reverse('forumapp:favorites'), reverse('forumapp:user', kwargs={'username': self.username})]:
+            response, aliases = self.get(url)
+            self.assertIn('replica', aliases, url)
+
+        # sessions and users stay on the primary
+        self.assertIn('default', aliases)
+
+        # other pages and the router outside of requests use the primary
+        self.assertEqual(self.get(reverse('forumapp:search') + '?q=older')[1], {'default'})
+        self.assertEqual(Comment.objects.all().db, 'default')
+
+        with routers.use_replica():
+            self.assertEqual(Comment.objects.all().db, 'replica')
+            self.assertEqual(User.objects.all().db, 'default')
+            self.assertEqual(router.db_for_write(Comment), 'default')
+
+    def testWritesStickToPrimary(self):
+        with AliasRecorder().record() as recorder:
+            response = self.client.post(self.url, {'create': '', 'text': "my own comment"})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(set(recorder.aliases), {'default'})
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+
+        # the redirect target is read from the primary, showing the new comment
+        response, aliases = self.get(self.url)
+        self.assertEqual(aliases, {'default'})
+        self.assertContains(response, "my own comment")
+
+        # once the window is over the replica serves the page again
+        self.client.cookies[routers.PIN_COOKIE] = '%.3f' % (time.time() - 1)
+        self.assertIn('replica', self.get(self.url)[1])
+
+    @override_settings(FORUM_READ_REPLICAS=[])
+    def testWithoutReplicas(self):
+        self.assertEqual(self.get(self.url)[1], {'default'})
+
+    def testSnapshot(self):
+        from .management.commands.snapshot_replica import snapshot
+
+        with tempfile.TemporaryDirectory() as path:
+            target = path + '/replica.sqlite3'
+            snapshot(connection.settings_dict['NAME'], target)
+
+            with sqlite3.connect(target) as copy:
+                tables = {row[0] for row in copy.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+            self.assertIn('forumapp_comment', tables)
+
+        with self.assertRaises(CommandError):
+            call_command('snapshot_replica', '--database', 'default', stdout=io.StringIO())
+
+class QueryPlanTests(TestCase):
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        owners = make_users(5, 'planner')
+        self.channel = create_channel("planchannel", owners[0])
+        self.thread = create_thread(self.channel, owners[1])
+        make_threads(self.channel, 20, owners)
+        make_comments(self.thread, 20, owners)
+
+    def plan(self, queryset, ordering):
+        paginator = KeysetPaginator(queryset, ordering, 10)
+        return queryset.order_by(*paginator._order_by(False))[:11].explain()
+
+    def testPagesUseIndexes(self):
+        from .views import ChannelView, ThreadView, CommentView
+
+        plans = [
+            self.plan(Channel.objects.all(), ChannelView.ordering_keys),
+            self.plan(Thread.objects.filter(channel_id=self.channel.pk), ThreadView.ordering_keys),
+            self.plan(Comment.objects.filter(thread__thread_id=self.thread.thread_id, \
+                    thread__channel_id=self.channel.pk), CommentView.ordering_keys),
+        ]
+
+        for plan in plans:
+            self.assertNotIn('TEMP B-TREE', plan)
+            self.assertNotRegex(plan, r'(?m)SCAN forumapp_\w+$')
+
+    def testCheckQueryPlans(self):
+        out = io.StringIO()
+        call_command('check_query_plans', stdout=out)
+        self.assertIn("use indexes", out.getvalue())
+
+class SQLiteTuningTests(TransactionTestCase):
+    posters = 12
+    posts = 5
+    password = "P@ssw0rd1"
+
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def testPragmas(self):
+        connection.close()
+        connection.ensure_connection()
+
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('cache_size'), -20000)
+
+    # settings override single defaults and None leaves one out
+    @override_settings(FORUM_SQLITE_PRAGMAS={'cache_size': -4000, 'mmap_size': None})
+    def testPragmaOverrides(self):
+        pragmas = sqlite.get_pragmas()
+
+        self.assertEqual(pragmas['cache_size'], -4000)
+        self.assertEqual(pragmas['journal_mode'], sqlite.DEFAULT_PRAGMAS['journal_mode'])
+        self.assertNotIn('mmap_size', pragmas)
+
+    @override_settings(FORUM_LOCK_RETRY_DELAY=0)
+    def testRetryOnLock(self):
+        calls = []
+
+        @sqlite.retry_on_lock
+        def write(failures, message="database is locked"):
+            calls.append(1)
+
+            if len(calls) <= failures:
+                raise OperationalError(message)
+
+            return len(calls)
+
+        self.assertEqual(write(2), 3)
+
+        # other errors, too many failures and open transactions aren't retried
+        for failures, message in [(1, "no such table: x"), (10, "database is locked")]:
+            calls.clear()
+
+            with self.assertRaises(OperationalError):
+                write(failures, message)
+
+            self.assertEqual(len(calls), 1 if failures == 1 else 6)
+
+        calls.clear()
+        with self.assertRaises(OperationalError), transaction.atomic():
+            write(1)
+
+        self.assertEqual(len(calls), 1)
+
+    # Posters write through the view at the same time, each on its own
+    # connection, while others read the thread
+    def testConcurrentPosters(self):
+        owner = User.objects.create_user(username="lockowner", password=self.password)
+        channel = create_channel("lockchannel", owner)
+        thread = create_thread(channel, owner)
+        url = reverse('forumapp:comment', kwargs={'channel': channel.pk, 'thread': thread.thread_id})
+
+        users = [User.objects.create_user(username="poster%d" % i, password=self.password) for i in range(self.posters)]
+        start = threading.Barrier(self.posters)
+        errors = []
+
+        def post(user):
+            try:
+                client = Client()
+                client.force_login(user)
+                start.wait()
+
+                for i in range(self.posts):
+                    response = client.post(url, {'create': '', 'text': "comment %d by %s" % (i, user.username)})
+                    self.assertEqual(response.status_code, 302)
+                    self.assertEqual(client.get(url).status_code, 200)
+
+            except Exception as e:
+                errors.append(e)
+
+            finally:
+                connection.close()
+
+        posters = [threading.Thread(target=post, args=(user,)) for user in users]
+        for poster in posters:
+            poster.start()
+        for poster in posters:
+            poster.join()
+
+        self.assertEqual(errors, [])
+
+        thread.refresh_from_db()
+        ids = sorted(Comment.objects.filter(thread=thread).values_list('comment_id', flat=True))
+        self.assertEqual(ids, list(range(self.posters * self.posts)))
+        self.assertEqual(thread.comment_count, self.posters * self.posts)
+
+## Deleting hides at once and purges the rows in chunks
+class PurgeTests(TestCase):
+    username = "purgeowner"
+    password = "P@ssw0rd1"
+    channel_name = "purgechannel"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.threads = [create_thread(self.channel, self.owner, name="purgethread%d" % i) for i in range(2)]
+
+        for thread in self.threads:
+            make_comments(thread, 3, [self.owner])
+
+        self.client.login(username=self.username, password=self.password)
+
+    def drain(self, chunk_size=2):
+        chunks = []
+        purge.drain(chunk_size, 0, lambda pending, deleted: chunks.append(deleted))
+        return chunks
+
+    def testDeleteThreadHidesIt(self):
+        thread = self.threads[0]
+        url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': thread.thread_id})
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(url, {'delete_thread': ''})
+
+        self.assertIn(purge.worker.wake, callbacks)
+        self.assertTrue(Thread.objects.filter(pk=thread.pk, hidden_date__isnull=False).exists())
+        self.assertEqual(Comment.objects.filter(thread=thread).count(), 3)
+
+        response = self.client.get(reverse('forumapp:thread', kwargs={'channel': self.channel_name}))
+        self.assertEqual([listing.pk for listing in response.context['thread_list']], [self.threads[1].pk])
+        self.assertQuerysetEqual(self.client.get(url).context['comment_list'], [])
+        self.assertEqual(len(search.search("purgethread0")), 0)
+
+        # comments two at a time, then the thread with its purge row
+        self.assertEqual(self.drain(), [2, 1, 2])
+        self.assertFalse(Thread.objects.filter(pk=thread.pk).exists())
+        self.assertFalse(PendingPurge.objects.exists())
+        self.assertEqual(Comment.objects.filter(thread=self.threads[1]).count(), 3)
+
+    def testDeleteChannelHidesIt(self):
+        Favorite.objects.create(user=self.owner, channel=self.channel)
+        self.client.post(reverse('forumapp:thread', kwargs={'channel': self.channel_name}), {'delete_channel': ''})
+
+        self.assertTrue(Channel.objects.filter(pk=self.channel_name, hidden_date__isnull=False).exists())
+        self.assertQuerysetEqual(self.client.get(reverse('forumapp:channel')).context['channel_list'], [])
+        self.assertQuerysetEqual(self.client.get(reverse('forumapp:favorites')).context['favorites_list'], [])
+
+        response = self.client.get(reverse('forumapp:thread', kwargs={'channel': self.channel_name}))
+        self.assertQuerysetEqual(response.context['thread_list'], [])
+
+        chunks = self.drain()
+        self.assertTrue(all(deleted <= 2 for deleted in chunks[:-1]))
+        self.assertFalse(Channel.objects.filter(pk=self.channel_name).exists())
+        self.assertFalse(Thread.objects.exists())
+        self.assertFalse(Comment.objects.exists())
+        self.assertFalse(PendingPurge.objects.exists())
+
+    ## A purge interrupted after a chunk carries on where it stopped
+    def testResumePurge(self):
+        self.channel.hide()
+        pending = PendingPurge.objects.get()
+
+        self.assertEqual(purge.purge_chunk(pending.pk, 4), 4)
+        pending.refresh_from_db()
+        self.assertEqual(pending.deleted_count, 4)
+        self.assertEqual(Comment.objects.count(), 2)
+
+        out = io.StringIO()
+        call_command('drain_purges', '--pause', '0', stdout=out)
+        self.assertIn("1 hidden channels and threads", out.getvalue())
+        self.assertFalse(Channel.objects.filter(pk=self.channel_name).exists())
+        self.assertFalse(Comment.objects.exists())
+
+    def testHideTwice(self):
+        self.assertTrue(self.threads[0].hide())
+        self.assertFalse(self.threads[0].hide())
+        self.assertEqual(PendingPurge.objects.count(), 1)
+        self.assertEqual(Channel.objects.get(pk=self.channel_name).thread_count, 1)
+
+## The admin pages stay cheap however many rows there are
+@override_settings(FORUM_ADMIN_INLINE_LIMIT=5)
+class AdminTests(TestCase):
+    username = "adminowner"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.owner = User.objects.create_superuser(username=self.username, password=self.password)
+        self.channel = create_channel("adminchannel", self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+        self.client.login(username=self.username, password=self.password)
+
+    @query_budget(rows=(10, 50))
+    def testChannelChangeForm(self, rows):
+        make_threads(self.channel, rows, make_users(rows, 'tadmin'))
+        return reverse('admin:forumapp_channel_change', args=[self.channel.pk])
+
+    @query_budget(rows=(10, 50))
+    def testThreadChangeForm(self, rows):
+        make_comments(self.thread, rows, make_users(rows, 'cadmin'))
+        return reverse('admin:forumapp_thread_change', args=[self.thread.pk])
+
+    @query_budget(rows=(10, 50))
+    def testCommentChangelist(self, rows):
+        make_comments(self.thread, rows, make_users(rows, 'ladmin'))
+        return reverse('admin:forumapp_comment_changelist')
+
+    def testCappedInline(self):
+        make_comments(self.thread, 12, [self.owner])
+        Thread.objects.filter(pk=self.thread.pk).update(comment_count=12)
+
+        response = self.client.get(reverse('admin:forumapp_thread_change', args=[self.thread.pk]))
+        formset = response.context['inline_admin_formsets'][0].formset
+
+        self.assertEqual(formset.initial_form_count(), 5)
+        self.assertContains(response, "Showing 5 of 12 comments.")
+        self.assertContains(response, reverse('admin:forumapp_comment_changelist') + '?thread=%d' % self.thread.pk)
+
+    def testEstimatedCount(self):
+        make_comments(self.thread, 12, [self.owner])
+        Comment.objects.filter(thread=self.thread, comment_id=0).delete()
+        last = Comment.objects.order_by('-pk').values_list('pk', flat=True).first()
+        url = reverse('admin:forumapp_comment_changelist')
+
+        EstimatedCountPaginator.threshold, threshold = 10, EstimatedCountPaginator.threshold
+
+        try:
+            # the largest id stands in for COUNT(*) on the whole table...
+            self.assertEqual(self.client.get(url).context['cl'].result_count, last)
+
+            # ...but filtered lists are counted
+            response = self.client.get(url, {'thread': self.thread.pk})
+            self.assertEqual(response.context['cl'].result_count, 11)
+
+        finally:
+            EstimatedCountPaginator.threshold = threshold
+
+    def testBenchAdmin(self):
+        make_comments(self.thread, 12, [self.owner])
+        out = io.StringIO()
+
+        with tempfile.TemporaryDirectory() as path:
+            output = path + '/results.json'
+            call_command('bench_admin', '--runs', '2', '--warmup', '0', '--output', output, stdout=out)
+
+            with open(output) as results:
+                endpoints = json.load(results)['endpoints']
+
+        self.assertEqual(set(endpoints), {'channels', 'threads', 'comments', 'channel', 'thread', 'comment'})
+        self.assertTrue(all(result['status'] == 200 for result in endpoints.values()))
+
+## New comments reach live listeners through the hub
+class LiveTests(TestCase):
+    username = "liveowner"
+    password = "P@ssw0rd1"
+    channel_name = "livechannel"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+        self.old = create_comment(self.thread, self.owner, text="already here")
+        self.client.login(username=self.username, password=self.password)
+
+        self.url = reverse('forumapp:live', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+        self.comment_url = reverse('forumapp:comment', kwargs={'channel': self.channel_name, 'thread': self.thread.thread_id})
+
+    # every listener unsubscribed
+    def tearDown(self):
+        connections, live.hub.connections, live.hub.subscriptions = live.hub.connections, 0, {}
+        self.assertEqual(connections, 0)
+
+    def post(self, text):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.comment_url, {'create': '', 'text': text})
+
+    # let the stream time out, which closes the response like a server would
+    def finish(self, response):
+        with self.settings(FORUM_LIVE_TIMEOUT=0):
+            list(response.streaming_content)
+
+    def testSubscriberReceivesComment(self):
+        with live.hub.subscribe(self.thread.pk) as subscription:
+            self.post("hello listeners")
+            events, overflowed = subscription.wait(0)
+
+        self.assertFalse(overflowed)
+        self.assertEqual([(event['comment_id'], event['text'], event['owner']) for event in events], \
+                [(1, "hello listeners", self.username)])
+
+    @override_settings(FORUM_LIVE_HEARTBEAT=0.01)
+    def testStream(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = iter(response.streaming_content)
+
+        self.assertEqual(next(stream), b'retry: 10\n\n')
+        self.assertEqual(next(stream), b': heartbeat\n\n')
+
+        # a waiting listener gets new comments from the hub, without queries
+        self.post("streamed comment")
+
+        with self.assertNumQueries(0):
+            event = next(stream).decode()
+            self.assertEqual(next(stream), b': heartbeat\n\n')
+
+        self.assertTrue(event.startswith('id: 1\nevent: comment\ndata: '))
+        self.assertEqual(json.loads(event.split('data: ')[1])['text'], "streamed comment")
+        self.finish(response)
+
+    # banned users are turned away before they subscribe, in both modes
+    def testBannedListener(self):
+        banned = User.objects.create_user(username="livebanned", password=self.password)
+        ChannelMembership.objects.create(channel=self.channel, user=banned, role=ChannelMembership.BANNED)
+        self.client.login(username="livebanned", password=self.password)
+
+        for params in ({'poll': 1, 'after': -1}, {'after': -1}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 403)
+            self.assertNotContains(response, "already here", status_code=403)
+            self.assertEqual(live.hub.connections, 0)
+
+    # a comment posted between reading the thread and subscribing is still sent
+    @override_settings(FORUM_LIVE_HEARTBEAT=0.01)
+    def testCommentBeforeSubscribing(self):
+        subscribe = live.hub.subscribe
+
+        def late_subscribe(thread_pk):
+            create_comment(self.thread, self.owner, text="slipped in")
+            return subscribe(thread_pk)
+
+        live.hub.subscribe = late_subscribe
+        try:
+            response = self.client.get(self.url)
+        finally:
+            del live.hub.subscribe
+
+        stream = iter(response.streaming_content)
+        next(stream)
+
+        self.assertIn('"slipped in"', next(stream).decode())
+        self.finish(response)
+
+    def testCatchUp(self):
+        response = self.client.get(self.url, HTTP_LAST_EVENT_ID='-1')
+        stream = iter(response.streaming_content)
+        next(stream)
+
+        self.assertIn('"already here"', next(stream).decode())
+        self.finish(response)
+
+    def testLongPoll(self):
+        response = self.client.get(self.url, {'poll': 1, 'after': -1})
+        self.assertEqual([event['text'] for event in response.json()['comments']], ["already here"])
+        self.assertEqual(response.json()['after'], 0)
+
+        with override_settings(FORUM_LIVE_HEARTBEAT=0.01):
+            self.assertEqual(self.client.get(self.url, {'poll': 1}).json(), {'comments': [], 'after': 0})
+
+    @override_settings(FORUM_LIVE_MAX_CONNECTIONS=1)
+    def testConnectionLimit(self):
+        first = self.client.get(self.url)
+        self.assertEqual(self.client.get(self.url).status_code, 503)
+
+        self.finish(first)
+        self.finish(self.client.get(self.url))
+
+    @override_settings(FORUM_LIVE_BACKLOG=2)
+    def testOverflowReadsDatabase(self):
+        with live.hub.subscribe(self.thread.pk) as subscription:
+            for i in range(3):
+                self.post("overflowing %d" % i)
+
+            events, overflowed = subscription.wait(0)
+            self.assertEqual((events, overflowed), ([], True))
+            self.assertEqual(len(live.poll(subscription, 0, 0)), 2)
+
+## The JSON API reads the same rows as the HTML pages
+class ApiTests(TestCase):
+    username = "apiowner"
+    password = "P@ssw0rd1"
+    channel_name = "apichannel"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password)
+        self.channel = create_channel(self.channel_name, self.owner)
+        self.thread = create_thread(self.channel, self.owner)
+        self.client.login(username=self.username, password=self.password)
+
+        self.threads_url = reverse('forumapp:api_threads', kwargs={'channel': self.channel_name})
+        self.comments_url = reverse('forumapp:api_comments', kwargs={'channel': self.channel_name, \
+                'thread': self.thread.thread_id})
+
+    def walk(self, url, **params):
+        rows, cursor = [], None
+
+        while True:
+            data = self.client.get(url, dict(params, **({'after': cursor} if cursor else {}))).json()
+            rows += data['results']
+            cursor = data['next']
+
+            if cursor is None:
+                return rows
+
+    def testChannels(self):
+        make_channels(5, [self.owner])
+        Channel.objects.filter(pk='budget3').update(hidden_date=timezone.now())
+        url = reverse('forumapp:api_channels')
+
+        rows = self.walk(url, limit=2, fields='channel_name,owner')
+        self.assertEqual(rows[0], {'channel_name': 'budget0', 'owner': self.username})
+        self.assertEqual([row['channel_name'] for row in rows], \
+                [channel.channel_name for channel in self.client.get(reverse('forumapp:channel')).context['channel_list']])
+        self.assertNotIn('budget3', [row['channel_name'] for row in rows])
+
+        # the previous cursor leads back to the first page
+        second = self.client.get(url, {'limit': 2, 'after': self.client.get(url, {'limit': 2}).json()['next']}).json()
+        first = self.client.get(url, {'limit': 2, 'before': second['previous']}).json()
+        self.assertEqual([row['channel_name'] for row in first['results']], ['budget0', 'budget1'])
+        self.assertIsNone(first['previous'])
+
+    def testComments(self):
+        make_comments(self.thread, 5, make_users(5, 'apicomment'))
+
+        response = self.client.get(self.comments_url, {'fields': 'comment_id,text', 'limit': 3})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.json()['results'], \
+                [{'comment_id': 4, 'text': 'text4'}, {'comment_id': 3, 'text': 'text3'}, {'comment_id': 2, 'text': 'text2'}])
+        self.assertEqual(response.json()['permissions'], {'banned': False, 'can_post': True, 'can_moderate': True})
+        self.assertEqual(len(self.walk(self.comments_url, limit=2)), 5)
+
+        for params in ({'fields': 'text,password'}, {'after': 'nonsense'}, {'limit': 'none'}):
+            response = self.client.get(self.comments_url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json())
+
+        self.assertEqual(self.client.post(self.comments_url).status_code, 405)
+
+    def testPermissions(self):
+        banned = User.objects.create_user(username="apibanned", password=self.password)
+        ChannelMembership.objects.create(channel=self.channel, user=banned, role=ChannelMembership.BANNED)
+        create_comment(self.thread, self.owner, text="not for banned eyes")
+        self.client.login(username="apibanned", password=self.password)
+
+        # banned users get the permissions but none of the rows, like on the HTML pages
+        for url in (self.threads_url, self.comments_url):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['results'], [])
+            self.assertEqual(response.json()['permissions'], {'banned': True, 'can_post': False, 'can_moderate': False})
+            self.assertNotContains(response, "not for banned eyes")
+
+        self.client.login(username=self.username, password=self.password)
+        self.thread.hide()
+        self.assertEqual(self.client.get(self.threads_url).json()['results'], [])
+        self.assertEqual(self.client.get(self.comments_url).status_code, 404)
+
+        self.channel.hide()
+        response = self.client.get(self.threads_url)
+        self.assertEqual((response.status_code, response.json()), (404, {'error': "Couldn't find that channel."}))
+
+    @query_budget(rows=(10, 50))
+    def testThreadListing(self, rows):
+        make_threads(self.channel, rows, make_users(rows, 'tapi'))
+        return self.threads_url + '?limit=100'
+
+    @query_budget(rows=(10, 50))
+    def testCommentListing(self, rows):
+        make_comments(self.thread, rows, make_users(rows, 'capi'))
+        return self.comments_url + '?limit=100'
+
+    def testBenchApi(self):
+        make_comments(self.thread, 12, [self.owner])
+        out = io.StringIO()
+
+        with tempfile.TemporaryDirectory() as path:
+            output = path + '/results.json'
+            call_command('bench_api', '--runs', '2', '--warmup', '0', '--username', self.username, \
+                    '--output', output, stdout=out)
+
+            with open(output) as results:
+                endpoints = json.load(results)['endpoints']
+
+        self.assertEqual(set(endpoints), {'channel', 'thread', 'comment', 'api_channel', 'api_thread', 'api_comment'})
+        self.assertTrue(all(result['status'] == 200 and result['bytes'] > 0 for result in endpoints.values()))
+        self.assertLess(endpoints['api_comment']['bytes'], endpoints['comment']['bytes'])
+        self.assertIn("api_comment", out.getvalue())
+
+## Channels are exported as NDJSON in chunks and exports can resume
+class ExportTests(TestCase):
+    username = "exportowner"
+    password = "P@ssw0rd1"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username, password=self.password, is_staff=True)
+        self.channel = create_channel("exportchannel", self.owner)
+        self.other = create_channel("exportother", self.owner)
+
+        self.threads = [create_thread(self.channel, self.owner, name="export thread %d" % i) for i in range(3)]
+        for thread in self.threads[:2]:
+            for i in range(3):
+                create_comment(thread, self.owner, text="comment %d" % i)
+
+        create_comment(create_thread(self.other, self.owner), self.owner)
+        self.client.login(username=self.username, password=self.password)
+
+    def testRecords(self):
+        records = list(export.records("exportchannel"))
+
+        self.assertEqual([export.get_position(record) for record in records], [("exportchannel", None, None), \
+                ("exportchannel", 0, None), ("exportchannel", 0, 0), ("exportchannel", 0, 1), ("exportchannel", 0, 2), \
+                ("exportchannel", 1, None), ("exportchannel", 1, 0), ("exportchannel", 1, 1), ("exportchannel", 1, 2), \
+                ("exportchannel", 2, None)])
+        self.assertEqual(records[1]['thread_name'], "export thread 0")
+        self.assertEqual((records[2]['text'], records[2]['owner']), ("comment 0", self.username))
+        self.assertEqual(list(export.records("exportchannel", chunk_size=2)), records)
+
+        self.threads[1].hide()
+        self.assertEqual(len(list(export.records("exportchannel"))), 6)
+        self.assertEqual(len(list(export.records())), 9)
+
+    def testChunkedQueries(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(export.records(chunk_size=2))
+
+        self.assertTrue(all('LIMIT 2' in query['sql'] for query in queries.captured_queries))
+
+    def testResume(self):
+        records = list(export.records())
+
+        for i, record in enumerate(records):
+            position = export.parse_position(export.format_position(export.get_position(record)))
+            self.assertEqual(list(export.records(after=position, chunk_size=2)), records[i + 1:])
+
+        self.assertEqual(export.parse_position("2:1", "exportchannel"), ("exportchannel", 2, 1))
+        self.assertRaises(ValueError, export.parse_position, "exportchannel:x")
+
+    def testCommand(self):
+        err = io.StringIO()
+
+        with tempfile.TemporaryDirectory() as path:
+            output = path + '/forum.ndjson.gz'
+            call_command('export_forum', '--output', output, '--gzip', '--chunk-size', '2', stderr=err)
+
+            with gzip.open(output, 'rt') as lines:
+                records = [json.loads(line) for line in lines]
+
+            call_command('export_forum', '--channel', 'exportchannel', '--after', '1:1', '--output', output, stderr=err)
+
+            with open(output) as lines:
+                resumed = [json.loads(line) for line in lines]
+
+        self.assertEqual(records, json.loads(json.dumps(list(export.records()), cls=CursorEncoder)))
+        self.assertEqual([record['type'] for record in resumed], ['comment', 'thread'])
+        self.assertIn("Exported 2 records", err.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('export_forum', '--after', 'exportchannel:x', stderr=err)
+
+    def testEndpoint(self):
+        url = reverse('forumapp:export')
+
+        response = self.client.get(url, {'channel': 'exportchannel', 'gzip': 1})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('exportchannel.ndjson.gz', response['Content-Disposition'])
+
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(len(lines), 10)
+
+        response = self.client.get(url, {'after': 'exportother:0'})
+        self.assertEqual([json.loads(line)['type'] for line in b''.join(response.streaming_content).decode().splitlines()], \
+                ['comment'])
+
+        self.assertEqual(self.client.get(url, {'channel': 'missing'}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'after': 'exportchannel:x'}).status_code, 404)
+
+        User.objects.filter(pk=self.owner.pk).update(is_staff=False)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+## Dumps are imported with bulk inserts and set-based recounts
+class ImportTests(TestCase):
+    username = "importowner"
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username=self.username)
+        self.channel = create_channel("importsource", self.owner)
+
+        for i in range(3):
+            thread = create_thread(self.channel, self.owner, name="import thread %d" % i, days=-3 + i)
+            for j in range(i * 2):
+                create_comment(thread, self.owner, text="reply %d" % j, days=-2 + i)
+
+    # the source channel's export, renamed
+    def dump(self, name="importcopy"):
+        records = json.loads(json.dumps(list(export.records("importsource")), cls=CursorEncoder))
+
+        for record in records:
+            record['channel_name' if record['type'] == 'channel' else 'channel'] = name
+
+        return records
+
+    def write(self, path, records):
+        with open(path, 'w') as out:
+            out.writelines(json.dumps(record) + '\n' for record in records)
+
+    def run_import(self, records, *args):
+        with tempfile.TemporaryDirectory() as path:
+            self.write(path + '/dump.ndjson', records)
+            out = io.StringIO()
+            call_command('import_forum', path + '/dump.ndjson', *args, stdout=out)
+
+        return out.getvalue()
+
+    def listing(self, name):
+        threads = Thread.objects.filter(channel=name).order_by('thread_id')
+        return [(thread.thread_id, thread.thread_name, thread.owner_id, thread.comment_count, thread.comment_seq, \
+                thread.last_comment_id, [(comment.comment_id, comment.text) for comment in \
+                Comment.objects.filter(thread=thread).order_by('comment_id')]) for thread in threads]
+
+    def testRoundTrip(self):
+        output = self.run_import(self.dump(), '--batch-size', '2')
+        self.assertIn("Imported 1 channels, 3 threads and 6 comments", output)
+
+        source, copy = Channel.objects.get(pk="importsource"), Channel.objects.get(pk="importcopy")
+        self.assertEqual(self.listing("importcopy"), self.listing("importsource"))
+        fields = ('owner_id', 'thread_seq', 'thread_count', 'comment_count', 'last_thread_id', 'last_comment_id')
+        self.assertEqual([getattr(copy, field) for field in fields], [getattr(source, field) for field in fields])
+
+        # activity dates come from the last comments
+        for thread in Thread.objects.filter(channel=copy):
+            self.assertEqual(thread.recent_date, thread.last_comment_date or thread.pub_date)
+        self.assertEqual(copy.recent_date, copy.last_comment_date)
+
+        # the sequences continue after the imported ids
+        thread = Thread.objects.get(channel=copy, thread_id=2)
+        self.assertEqual(create_comment(thread, self.owner).comment_id, 4)
+        self.assertEqual(create_thread(copy, self.owner, name="after the import").thread_id, 3)
+
+    def testIntoExistingChannel(self):
+        records = [record for record in self.dump("importsource") if record['type'] != 'channel']
+        self.run_import(records[:3])
+
+        self.assertEqual(list(Thread.objects.filter(channel="importsource").order_by('thread_id') \
+                .values_list('thread_id', 'thread_name')), [(0, "import thread 0"), (1, "import thread 1"), \
+                (2, "import thread 2"), (3, "import thread 0"), (4, "import thread 1")])
+        self.assertEqual(Channel.objects.get(pk="importsource").thread_count, 5)
+
+    def testCsvOwners(self):
+        with tempfile.TemporaryDirectory() as path:
+            with open(path + '/dump.csv', 'w', newline='') as out:
+                out.write("type,channel_name,channel,thread_id,thread,thread_name,text,owner,pub_date\n")
+                out.write("channel,csvchannel,,,,,,%s,2020-01-01T00:00:00+00:00\n" % self.username)
+                out.write("thread,,csvchannel,7,,from csv,,newcomer,2020-01-02T00:00:00+00:00\n")
+                out.write("comment,,csvchannel,,7,,hello,ghost,2020-01-03T00:00:00+00:00\n")
+
+            call_command('import_forum', path + '/dump.csv', stdout=io.StringIO())
+            self.assertEqual(list(Comment.objects.filter(thread__channel="csvchannel") \
+                    .values_list('comment_id', 'text', 'owner_id', 'thread__thread_id', 'thread__owner_id')), \
+                    [(0, "hello", None, 0, None)])
+            self.assertEqual(Channel.objects.get(pk="csvchannel").recent_date, \
+                    datetime.datetime(2020, 1, 3, tzinfo=datetime.timezone.utc))
+
+            Channel.objects.filter(pk="csvchannel").delete()
+            out = io.StringIO()
+            call_command('import_forum', path + '/dump.csv', '--create-users', stdout=out)
+
+        self.assertEqual(Comment.objects.get(thread__channel="csvchannel").owner_id, "ghost")
+        self.assertIn("Created 2 users.", out.getvalue())
+
+    def testInvalidRecord(self):
+        records = self.dump()
+        records.insert(4, {'type': 'comment', 'channel': 'importcopy', 'thread': 99, 'text': "lost"})
+
+        with self.assertRaisesRegex(CommandError, "Line 5: Comment of unknown thread importcopy:99 \\(imported 1 channels"):
+            self.run_import(records, '--batch-size', '2')
+
+        # everything before the error is written and counted
+        self.assertEqual(Thread.objects.filter(channel="importcopy").count(), 2)
+        self.assertEqual(Comment.objects.filter(thread__channel="importcopy").count(), 1)
+        self.assertEqual(Channel.objects.filter(pk="importcopy").values_list('thread_count', 'comment_count').get(), (2, 1))
+
+    def testQueriesPerBatch(self):
+
+        def count_queries(comments):
+            records = self.dump("importbig%d" % comments)[:2]
+            records += [{'type': 'comment', 'channel': records[0]['channel_name'], 'thread': 0, 'text': "bulk %d" % i, \
+                    'owner': self.username} for i in range(comments)]
+
+            with CaptureQueriesContext(connection) as queries:
+                importer.Importer(batch_size=1000).run(enumerate(records, 1))
+
+            return len(queries)
+
+        self.assertEqual(count_queries(10), count_queries(150))
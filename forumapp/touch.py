@@ -0,0 +1,134 @@
+import atexit, logging, threading, time
+from django.conf import settings
+from django.db import DatabaseError, connection, models
+from . import fragments
+from .activity import channel_updates
+from .models import Channel, Thread
+
+logger = logging.getLogger(__name__)
+
+# Collects the channels new comments were posted in ("touches") in memory and
+# writes their rows later with one UPDATE, instead of making every post write
+# its channel's counters, last comment snapshot and recent_date inside its own
+# transaction. The post still writes its thread's, which it has to lock for the
+# comment id anyway; the flush recomputes each channel's from its threads, so
+# posts, deletes and hides in between can't make it count anything twice, and
+# a busy channel's row is written once per flush instead of once per post.
+#
+# Pending touches are written when a request finishes and the oldest of them
+# is older than FORUM_TOUCH_INTERVAL, by a timer after FORUM_TOUCH_MAX_STALENESS
+# when no requests come in, and when the process exits.
+class TouchBuffer(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.oldest = None
+        self.timer = None
+
+    def touch(self, channel_name, date):
+        with self.lock:
+            if channel_name not in self.pending or self.pending[channel_name] < date:
+                self.pending[channel_name] = date
+
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+
+            if self.timer is None:
+                self.timer = threading.Timer(get_max_staleness(), self._flush_from_timer)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def is_due(self):
+        with self.lock:
+            return self.oldest is not None and time.monotonic() - self.oldest >= get_interval()
+
+    # Write all pending touches, returning the number of channels they cover
+    def flush(self):
+        with self.lock:
+            pending, self.pending, self.oldest = self.pending, {}, None
+
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        try:
+            touch_channels(pending)
+
+        except DatabaseError:
+            logger.exception("Couldn't write %d touches, keeping them for the next flush", len(pending))
+
+            for channel_name, date in pending.items():
+                self.touch(channel_name, date)
+
+            return 0
+
+        return len(pending)
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+
+        finally:
+            # the timer thread has its own connection
+            connection.close()
+
+## Bring many channels up to date with their threads with one UPDATE, given
+## {channel name: date of the newest post}: counters and last comment snapshots
+## are recomputed and recent_date moves forward, never back. The channels'
+## cached listings were rendered from the old row, so they're invalidated.
+def touch_channels(dates):
+    if not dates:
+        return 0
+
+    whens = [models.When(models.Q(pk=pk) & models.Q(recent_date__lt=date), then=models.Value(date)) \
+            for pk, date in dates.items()]
+
+    count = Channel.objects.filter(pk__in=list(dates)).update(**channel_updates(Thread), \
+            recent_date=models.Case(*whens, default=models.F('recent_date'), output_field=models.DateTimeField()))
+
+    for pk in dates:
+        fragments.invalidate('channel', pk)
+
+    return count
+
+def get_interval():
+    return getattr(settings, 'FORUM_TOUCH_INTERVAL', 0.25)
+
+def get_max_staleness():
+    return getattr(settings, 'FORUM_TOUCH_MAX_STALENESS', 2.0)
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+## Return the process's TouchBuffer, or None when FORUM_TOUCH_BUFFER is off
+## and posts should write their channel themselves
+def get_buffer():
+    global _buffer
+
+    if not getattr(settings, 'FORUM_TOUCH_BUFFER', False):
+        return None
+
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = TouchBuffer()
+                atexit.register(_buffer.flush)
+
+    return _buffer
+
+## Write everything the buffer holds, e.g. before measuring or shutting down
+def flush():
+    if _buffer is not None:
+        return _buffer.flush()
+
+    return 0
+
+## Flush the buffer if its oldest touch waited FORUM_TOUCH_INTERVAL
+def flush_if_due():
+    if _buffer is not None and _buffer.is_due():
+        _buffer.flush()
@@ -21,7 +21,13 @@ urlpatterns = [
     path('settings/', views.UserSettingsView.as_view(), name='settings'),
     path('settings/<str:channel>/', views.ChannelSettingsView.as_view(), name='channel_settings'),
     path('favorites/', views.FavoritesView.as_view(), name='favorites'),
+    path('search/', views.SearchView.as_view(), name='search'),
+    path('export/', views.ExportView.as_view(), name='export'),
     path('user/<str:username>/', views.UserView.as_view(), name='user'),
+    path('api/v1/channels/', views.ChannelApiView.as_view(), name='api_channels'),
+    path('api/v1/channels/<str:channel>/threads/', views.ThreadApiView.as_view(), name='api_threads'),
+    path('api/v1/channels/<str:channel>/threads/<int:thread>/comments/', views.CommentApiView.as_view(), name='api_comments'),
+    path('<str:channel>/<int:thread>/live/', views.LiveCommentsView.as_view(), name='live'),
     path('<str:channel>/<int:thread>/', views.CommentView.as_view(), name='comment'),
     path('<str:channel>/', views.ThreadView.as_view(), name='thread'),
     path('', views.ChannelView.as_view(), name='channel'),
@@ -0,0 +1,62 @@
+import functools
+from django.contrib.auth.models import User
+from django.utils.functional import SimpleLazyObject
+
+# Request-scoped identity map of users by username. Every user loaded through
+# it is loaded once per request and shared, so rows owned by the same user
+# point at the same object, and the viewer never has to be loaded again.
+
+def _identity_map(request):
+    users = getattr(request, '_forum_users', None)
+
+    if users is None:
+        users = {}
+        request._forum_users = users
+
+        viewer = getattr(request, 'user', None)
+        if viewer is not None and viewer.is_authenticated:
+            users[viewer.get_username()] = viewer
+
+    return users
+
+## Return {username: User or None} for usernames, loading the ones this
+## request hasn't seen with a single query
+def load_users(request, usernames):
+    users = _identity_map(request)
+    missing = {name for name in usernames if name not in users}
+
+    if missing:
+        found = {user.username: user for user in User.objects.filter(username__in=missing)}
+
+        for name in missing:
+            users[name] = found.get(name)
+
+    return {name: users[name] for name in usernames}
+
+def get_user(request, username):
+    return load_users(request, [username])[username]
+
+## Give every object a lazy owner. The first owner a template actually uses
+## loads the owners of all the objects with one query, so a page whose
+## listings come from the fragment cache loads none of them.
+def defer_owners(request, objects, field_name='owner'):
+    objects = list(objects)
+
+    if not objects:
+        return objects
+
+    field = objects[0]._meta.get_field(field_name)
+    pending = {getattr(obj, field.attname) for obj in objects}
+    users = _identity_map(request)
+
+    def load(username):
+        if username not in users:
+            load_users(request, pending)
+
+        return users[username]
+
+    for obj in objects:
+        if not field.is_cached(obj):
+            field.set_cached_value(obj, SimpleLazyObject(functools.partial(load, getattr(obj, field.attname))))
+
+    return objects
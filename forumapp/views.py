@@ -1,14 +1,23 @@
-import json
+import hashlib, hmac
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import User
-from django.http import Http404, HttpResponseRedirect
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.views import generic
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.urls import reverse
 from django.forms.models import model_to_dict
-from .models import UserSettings, Channel, Thread, Comment
+from .models import UserSettings, Channel, ChannelMembership, Favorite, Thread, Comment
 from .forms import UserSettingsForm, ChannelForm, ThreadForm, CommentForm
+from .pagination import KeysetPaginator, InvalidCursor
+from .permissions import get_channel_permissions, role_subquery
+from .sqlite import retry_on_lock
+from . import api, export, fragments, live, metrics, purge, search, touch, users
 
 ## Get or create the user's settings (because get_or_create returns an annoying tuple)
 def get_or_create_settings(user):
@@ -18,6 +27,22 @@ def get_or_create_settings(user):
     else:
         return UserSettings.objects.create(user=user)
 
+## Add a channel to the user's favorites, returning False if it was already there
+def add_favorite(user, channel_name):
+    channel = Channel.objects.filter(channel_name=channel_name, hidden_date=None)
+
+    if not channel.exists():
+        raise Http404("Couldn't find that channel.")
+
+    # the unique (user, channel) index settles concurrent toggles
+    favorite, created = Favorite.objects.get_or_create(user=user, channel_id=channel_name)
+    return created
+
+## Remove a channel from the user's favorites, returning False if it wasn't there
+def remove_favorite(user, channel_name):
+    deleted, _ = Favorite.objects.filter(user=user, channel_id=channel_name).delete()
+    return deleted > 0
+
 ## Return whether a user is an owner or moderator of the channel
 def is_mod(obj, user):
     # retrieve channel regardless of if we have a channel, thread, or comment
@@ -25,8 +50,9 @@ def is_mod(obj, user):
             or (isinstance(obj, Thread) and obj.channel or obj)
 
     # check if user is owner or moderator
-    return user == channel.owner \
-            or user.get_username() in json.loads(channel.moderators)
+    return channel.owner_id == user.get_username() \
+            or channel.memberships.filter(user_id=user.get_username(), \
+                    role=ChannelMembership.MODERATOR).exists()
 
 ## Return whether a user is an owner of the channel
 def is_owner(obj, user):
@@ -35,7 +61,54 @@ def is_owner(obj, user):
             or (isinstance(obj, Thread) and obj.channel or obj)
 
     # check if user is owner
-    return user == channel.owner
+    return channel.owner_id == user.get_username()
+
+## Validate POST data for a new thread in channel and save it with a single
+## insert. Returns (thread, None), or (None, error message) without writing.
+@retry_on_lock
+def post_thread(channel, owner, data):
+    form = ThreadForm(data, instance=Thread(channel=channel, owner=owner))
+
+    if not form.is_valid():
+        if Thread.objects.filter(channel=channel, thread_name=form.data.get('thread_name')).exists():
+            return None, "Thread already exists with that name."
+
+        return None, "Invalid input"
+
+    if len(form.cleaned_data.get('thread_name')) <= 5:
+        return None, "Thread name must be at least 6 characters."
+
+    if len(form.cleaned_data.get('description')) <= 5:
+        return None, "Thread description must be at least 6 characters."
+
+    thread = form.save(commit=False)
+    thread.save(recent_date=timezone.now())
+
+    return thread, None
+
+## Validate POST data for a new comment in thread and save it with a single
+## insert. Returns (comment, None), or (None, error message) without writing.
+@retry_on_lock
+def post_comment(thread, owner, data):
+    form = CommentForm(data, instance=Comment(thread=thread, owner=owner))
+
+    if not form.is_valid():
+        return None, "Invalid input"
+
+    if len(form.cleaned_data.get('text')) <= 5:
+        return None, "Comments must be at least 6 characters."
+
+    comment = form.save(commit=False)
+    date = timezone.now()
+    buffer = touch.get_buffer()
+
+    # with the touch buffer on, the channel row is written later in a batch
+    comment.save(recent_date=date, defer_channel=buffer is not None)
+
+    if buffer is not None:
+        buffer.touch(thread.channel_id, date)
+
+    return comment, None
 
 ## Automatically lets views attach form and context_objects to the context if defined
 class ViewMixin(generic.base.ContextMixin):
@@ -58,6 +131,81 @@ class ViewMixin(generic.base.ContextMixin):
 
         return context
 
+## Lets list views show one keyset page at a time, read from the after/before query parameters
+class KeysetPageMixin(object):
+    ordering_keys = ()
+    page_size = None
+
+    # (kind, attribute) naming the fragment cache version each row's listing
+    # depends on, so the versions of a whole page are looked up at once
+    fragment_version = None
+
+    def get_page_size(self):
+        return self.page_size or getattr(settings, 'FORUM_PAGE_SIZE', 50)
+
+    # Return the requested page of queryset, evaluated once per request
+    def paginate(self, queryset):
+        if not hasattr(self, 'page'):
+            paginator = KeysetPaginator(queryset, self.ordering_keys, self.get_page_size())
+
+            try:
+                self.page = paginator.page(after=self.request.GET.get('after'), \
+                        before=self.request.GET.get('before'))
+
+            except InvalidCursor:
+                raise Http404("Invalid page.")
+
+            if self.fragment_version:
+                kind, attname = self.fragment_version
+                fragments.preload_versions(self.request, kind, \
+                        {getattr(obj, attname) for obj in self.page.object_list})
+
+            # listings that miss the fragment cache show their owners
+            users.defer_owners(self.request, self.page.object_list)
+
+        return self.page.object_list
+
+    def get_context_data(self, **kwargs):
+        context = super(KeysetPageMixin, self).get_context_data(**kwargs)
+
+        if hasattr(self, 'page'):
+            context['page'] = self.page
+
+        return context
+
+## Answers GET requests with 304 Not Modified when the client's copy is still
+## current, checked with the single query in get_validators()
+class ConditionalGetMixin(object):
+
+    # Return the fields the page depends on as a dict, or None to always
+    # render. Only an ETag is sent: no single date moves on every change, as
+    # deletes, unpins and role changes leave none behind.
+    def get_validators(self):
+        return None
+
+    def get(self, request, *args, **kwargs):
+        view = super(ConditionalGetMixin, self).get
+
+        # pages with pending messages show them once, so always render those
+        if len(messages.get_messages(request)):
+            return view(request, *args, **kwargs)
+
+        validators = self.get_validators()
+
+        if validators is None:
+            return view(request, *args, **kwargs)
+
+        # the page also differs per viewer
+        user = request.user
+        key = [user.get_username(), user.is_staff, sorted(validators.items())]
+        etag = hashlib.md5(repr(key).encode()).hexdigest()
+
+        response = condition(etag_func=lambda *args, **kwargs: etag)(view)(request, *args, **kwargs)
+
+        # let browsers and proxies keep the page but revalidate every time
+        patch_cache_control(response, no_cache=True, private=user.is_authenticated)
+        return response
+
 # Show the settings menu
 class UserSettingsView(ViewMixin, generic.DetailView):
     model = UserSettings
@@ -82,6 +230,7 @@ class UserSettingsView(ViewMixin, generic.DetailView):
 
         return super(UserSettingsView, self).get(self, request, *args, **kwargs)
 
+    @method_decorator(retry_on_lock)
     def post(self, request, *args, **kwargs):
         self.object = self.get_object()
 
@@ -108,7 +257,7 @@ class ChannelSettingsView(ViewMixin, generic.DetailView):
     def get_object(self):
         if self.request.user.is_authenticated:
             channel_name = self.kwargs.get('channel')
-            channel = self.queryset.filter(channel_name=channel_name)
+            channel = self.queryset.filter(channel_name=channel_name, hidden_date=None)
 
             if channel.exists():
                 return channel.get()
@@ -128,6 +277,7 @@ class ChannelSettingsView(ViewMixin, generic.DetailView):
 
         return super(ChannelSettingsView, self).get(self, request, *args, **kwargs)
 
+    @method_decorator(retry_on_lock)
     def post(self, request, *args, **kwargs):
         self.object = self.get_object()
 
@@ -147,40 +297,31 @@ class ChannelSettingsView(ViewMixin, generic.DetailView):
         return HttpResponseRedirect(self.request.path_info)
 
 # Create your views here.
-class ChannelView(ViewMixin, generic.ListView):
+class ChannelView(KeysetPageMixin, ViewMixin, generic.ListView):
     model = Channel
     template_name = 'forumapp/channel.html'
 
     form_class = ChannelForm
 
     queryset = Channel.objects
-    print(queryset)
-    print(queryset.all())
     context_object_name = 'channel_list'
+    ordering_keys = ('pin_date', '-recent_date', 'channel_name')
+    fragment_version = ('channel', 'channel_name')
 
     def get_object(self, exclude=None):
-        return self.queryset.all()
+        return self.paginate(self.queryset.filter(hidden_date=None))
 
 
+    @method_decorator(retry_on_lock)
     def post(self, request, *args, **kwargs):
 
         if 'add_favorite' in request.POST:
-            settings = get_or_create_settings(self.request.user)
-            favs = json.loads(settings.favorites)
-            channel_name = request.POST['channel_name']
-
-            favs.append(channel_name)
-            settings.favorites = json.dumps(favs)
-            settings.save()
+            if request.user.is_authenticated:
+                add_favorite(request.user, request.POST['channel_name'])
 
         elif 'remove_favorite' in request.POST:
-            settings = get_or_create_settings(self.request.user)
-            favs = json.loads(settings.favorites)
-            channel_name = request.POST['channel_name']
-
-            favs = [c for c in favs if not c == channel_name]
-            settings.favorites = json.dumps(favs)
-            settings.save()
+            if request.user.is_authenticated:
+                remove_favorite(request.user, request.POST['channel_name'])
 
         elif 'pin' in request.POST:
             channel_name = request.POST['channel_name']
@@ -192,7 +333,7 @@ class ChannelView(ViewMixin, generic.ListView):
                 # Require staff status to pin channels
                 if request.user.is_staff:
                     channel.pin_date = timezone.now()
-                    channel.save()
+                    channel.save(update_fields=['pin_date'])
 
         elif 'unpin' in request.POST:
             channel_name = request.POST['channel_name']
@@ -204,7 +345,7 @@ class ChannelView(ViewMixin, generic.ListView):
                 # Require staff status to unpin channels
                 if request.user.is_staff:
                     channel.pin_date = None
-                    channel.save()
+                    channel.save(update_fields=['pin_date'])
 
         elif 'create' in request.POST:
             if not request.user.is_authenticated:
@@ -245,7 +386,7 @@ class ChannelView(ViewMixin, generic.ListView):
 
         return HttpResponseRedirect(self.request.path_info)
 
-class ThreadView(ViewMixin, generic.DetailView):
+class ThreadView(ConditionalGetMixin, KeysetPageMixin, ViewMixin, generic.DetailView):
     model = Thread
     template_name = 'forumapp/thread.html'
 
@@ -253,16 +394,44 @@ class ThreadView(ViewMixin, generic.DetailView):
 
     queryset = Thread.objects
     context_object_name = 'thread_list'
+    ordering_keys = ('pin_date', '-recent_date', '-thread_id')
+    fragment_version = ('thread', 'pk')
 
-    # Return querylist of threads in the given channel
+    # Return a page of threads in the given channel, none if it's hidden
     def get_object(self):
         c_name = self.kwargs.get('channel')
+        threads = self.queryset.filter(channel_id=c_name, hidden_date=None)
+
+        if not get_channel_permissions(self.request.user, c_name).exists:
+            threads = threads.none()
+
+        return self.paginate(threads)
+
+    # The channel's id sequence, counters and pinned threads cover every change
+    # to the thread list; pins are counted since unpinning leaves no date
+    def get_validators(self):
+        pinned = Thread.objects.filter(channel=OuterRef('pk'), pin_date__isnull=False) \
+                .order_by().values('channel')
+
+        validators = Channel.objects.filter(pk=self.kwargs.get('channel')).annotate( \
+                role=role_subquery(self.request.user, OuterRef('pk')), \
+                pins=Subquery(pinned.annotate(count=Count('pk')).values('count')), \
+                last_pin=Subquery(pinned.annotate(date=Max('pin_date')).values('date'))) \
+                .values('recent_date', 'description', 'owner_id', 'thread_seq', 'thread_count', 'comment_count', \
+                'last_thread_id', 'last_comment_id', 'hidden_date', 'role', 'pins', 'last_pin').first()
+
+        return validators
+
+    def get_context_data(self, **kwargs):
+        context = super(ThreadView, self).get_context_data(**kwargs)
+        context['permissions'] = get_channel_permissions(self.request.user, self.kwargs.get('channel'))
 
-        return self.queryset.filter(channel__channel_name=c_name)
+        return context
 
+    @method_decorator(retry_on_lock)
     def post(self, request, *args, **kwargs):
 
-        channel = Channel.objects.filter(channel_name=self.kwargs.get('channel'))
+        channel = Channel.objects.filter(channel_name=self.kwargs.get('channel'), hidden_date=None)
         if not channel.exists():
             return HttpResponseRedirect(reverse('forumapp:channel'))
 
@@ -270,7 +439,7 @@ class ThreadView(ViewMixin, generic.DetailView):
 
         if 'delete_thread' in request.POST:
             thread_id = request.POST['thread_id']
-            thread = self.queryset.filter(channel=channel, thread_id=thread_id)
+            thread = self.queryset.select_related('channel').filter(channel=channel, thread_id=thread_id, hidden_date=None)
 
             if thread.exists():
                 thread = thread.get()
@@ -278,7 +447,9 @@ class ThreadView(ViewMixin, generic.DetailView):
                 # Require staff, owner, or mod status to delete threads
                 if request.user.is_staff or is_mod(thread, request.user):
 
-                    thread.delete()
+                    # the comments are deleted in the background
+                    thread.hide()
+                    purge.schedule()
 
                 else:
                     raise Http404("Insufficient permissions.")
@@ -289,7 +460,8 @@ class ThreadView(ViewMixin, generic.DetailView):
         elif 'delete_channel' in request.POST:
 
             if request.user.is_staff or is_owner(channel, request.user):
-                channel.delete()
+                channel.hide()
+                purge.schedule()
 
                 return HttpResponseRedirect(reverse('forumapp:channel'))
 
@@ -300,7 +472,7 @@ class ThreadView(ViewMixin, generic.DetailView):
 
         elif 'pin' in request.POST:
             thread_id = request.POST['thread_id']
-            thread = self.queryset.filter(channel=channel, thread_id=thread_id)
+            thread = self.queryset.select_related('channel').filter(channel=channel, thread_id=thread_id, hidden_date=None)
 
             if thread.exists():
                 thread = thread.get()
@@ -308,7 +480,7 @@ class ThreadView(ViewMixin, generic.DetailView):
                 # Require staff, owner, or mod status to pin threads
                 if is_mod(thread, request.user):
                     thread.pin_date = timezone.now()
-                    thread.save()
+                    thread.save(update_fields=['pin_date'])
 
                 else:
                     raise Http404("Couldn't find that thread.")
@@ -318,7 +490,7 @@ class ThreadView(ViewMixin, generic.DetailView):
 
         elif 'unpin' in request.POST:
             thread_id = request.POST['thread_id']
-            thread = self.queryset.filter(channel=channel, thread_id=thread_id)
+            thread = self.queryset.select_related('channel').filter(channel=channel, thread_id=thread_id, hidden_date=None)
 
             if thread.exists():
                 thread = thread.get()
@@ -326,7 +498,7 @@ class ThreadView(ViewMixin, generic.DetailView):
                 # Require staff, owner, or mod status to unpin threads
                 if is_mod(thread, request.user):
                     thread.pin_date = None
-                    thread.save()
+                    thread.save(update_fields=['pin_date'])
 
                 else:
                     raise Http404("Couldn't find that thread.")
@@ -341,47 +513,17 @@ class ThreadView(ViewMixin, generic.DetailView):
                 
                 return HttpResponseRedirect(self.request.path_info)
 
-            owner = request.user
-            thread = Thread(channel=channel, owner=owner)
-            thread.save()
-            form = self.form_class(request.POST, instance=thread)
-
-            if form.is_valid():
-                thread_name = form.cleaned_data.get('thread_name')
-                description = form.cleaned_data.get('description')
-
-                if len(thread_name) > 5:
-
-                    if len(description) > 5:
-
-                        form.save()
-
-                        #Update recent_date of the channel
-                        date = timezone.now()
-                        channel.recent_date = date
-                        channel.save()
-
-                        return HttpResponseRedirect(reverse('forumapp:comment', \
-                                kwargs={'channel': channel.channel_name, 'thread': thread.thread_id}))
-
-                    else:
-                        thread.delete()
-                        messages.error(request, "Thread description must be at least 6 characters.")
+            thread, error = post_thread(channel, request.user, request.POST)
 
-                else:
-                    thread.delete()
-                    messages.error(request, "Thread name must be at least 6 characters.")
+            if thread is not None:
+                return HttpResponseRedirect(reverse('forumapp:comment', \
+                        kwargs={'channel': channel.channel_name, 'thread': thread.thread_id}))
 
-            elif Thread.objects.filter(channel=channel, thread_name=form.data.get('thread_name')).exists():
-                messages.error(request, "Thread already exists with that name.")
-
-            else:
-                thread.delete()
-                messages.error(request, "Invalid input")
+            messages.error(request, error)
 
         return HttpResponseRedirect(self.request.path_info)
 
-class CommentView(ViewMixin, generic.DetailView):
+class CommentView(ConditionalGetMixin, KeysetPageMixin, ViewMixin, generic.DetailView):
     model = Comment
     template_name = 'forumapp/comment.html'
 
@@ -389,18 +531,43 @@ class CommentView(ViewMixin, generic.DetailView):
 
     queryset = Comment.objects
     context_object_name = 'comment_list'
+    ordering_keys = ('-pub_date', '-comment_id')
+    fragment_version = ('thread', 'thread_id')
 
-    # Return querylist of comments in the given channel and thread
+    # Return a page of comments in the given channel and thread, newest
+    # first; none if either is hidden
     def get_object(self):
-        t_id = self.kwargs.get('thread')
-        c_name = self.kwargs.get('channel')
+        thread = get_channel_permissions(self.request.user, self.kwargs.get('channel')).thread(self.kwargs.get('thread'))
+
+        if thread is None:
+            return self.paginate(self.queryset.none())
+
+        return self.paginate(self.queryset.filter(thread=thread))
 
-        return self.queryset.filter(thread__thread_id=t_id, thread__channel__channel_name=c_name)
+    # New comments move the thread's comment_seq and deletions its counter
+    def get_validators(self):
+        validators = Thread.objects.filter(channel_id=self.kwargs.get('channel'), \
+                thread_id=self.kwargs.get('thread')).annotate( \
+                role=role_subquery(self.request.user, OuterRef('channel_id'))) \
+                .values('recent_date', 'thread_name', 'description', 'comment_seq', 'comment_count', \
+                'last_comment_id', 'hidden_date', 'channel__owner_id', 'channel__hidden_date', 'role').first()
 
+        return validators
+
+    def get_context_data(self, **kwargs):
+        context = super(CommentView, self).get_context_data(**kwargs)
+        permissions = get_channel_permissions(self.request.user, self.kwargs.get('channel'))
+
+        context['permissions'] = permissions
+        context['thread'] = permissions.thread(self.kwargs.get('thread'))
+
+        return context
+
+    @method_decorator(retry_on_lock)
     def post(self, request, *args, **kwargs):
 
-        thread = Thread.objects.filter(channel__channel_name=self.kwargs.get('channel'), \
-                thread_id=self.kwargs.get('thread'))
+        thread = Thread.objects.select_related('channel').filter(channel__channel_name=self.kwargs.get('channel'), \
+                thread_id=self.kwargs.get('thread'), hidden_date=None, channel__hidden_date=None)
 
         if not thread.exists():
             return HttpResponseRedirect(reverse('forumapp:thread', kwargs={'channel': self.kwargs.get('channel')}))
@@ -410,7 +577,7 @@ class CommentView(ViewMixin, generic.DetailView):
         if 'delete_comment' in request.POST:
 
             comment_id = request.POST['comment_id']
-            comment = self.queryset.filter(thread=thread, comment_id=comment_id)
+            comment = self.queryset.select_related('thread__channel').filter(thread=thread, comment_id=comment_id)
 
             if comment.exists():
                 comment = comment.get()
@@ -429,7 +596,8 @@ class CommentView(ViewMixin, generic.DetailView):
         elif 'delete_thread' in request.POST:
 
             if request.user.is_staff or is_mod(thread, request.user):
-                thread.delete()
+                thread.hide()
+                purge.schedule()
 
                 return HttpResponseRedirect(reverse('forumapp:thread', \
                         kwargs={'channel': self.kwargs.get('channel')}))
@@ -444,35 +612,12 @@ class CommentView(ViewMixin, generic.DetailView):
                 
                 return HttpResponseRedirect(self.request.path_info)
             
-            owner = request.user
-            comment = Comment(thread=thread, owner=owner)
-            comment.save()
-            form = self.form_class(request.POST, instance=comment)
-
-            if form.is_valid():
-                text = form.cleaned_data.get('text')
-
-                if len(text) > 5:
-
-                    form.save()
+            comment, error = post_comment(thread, request.user, request.POST)
 
-                    #Update recent_date of the channel and thread
-                    date = timezone.now()
-                    thread.channel.recent_date = date
-                    thread.channel.save()
-
-                    thread.recent_date = date
-                    thread.save()
-
-                    return HttpResponseRedirect(self.request.path_info)
+            if comment is not None:
+                return HttpResponseRedirect(self.request.path_info)
 
-                else:
-                    comment.delete()
-                    messages.error(request, "Comments must be at least 6 characters.")
-
-            else:
-                comment.delete()
-                messages.error(request, "")
+            messages.error(request, error)
 
         return HttpResponseRedirect(self.request.path_info)
 
@@ -483,10 +628,10 @@ class UserView(ViewMixin, generic.DetailView):
     queryset = User.objects
 
     def get_object(self):
-        username = self.kwargs.get('username')
+        user = users.get_user(self.request, self.kwargs.get('username'))
 
-        if self.queryset.filter(username=username).exists():
-            return self.queryset.get(username=username)
+        if user is not None:
+            return user
 
         return self.queryset.none()
 
@@ -498,6 +643,7 @@ class UserView(ViewMixin, generic.DetailView):
 
         return super(UserView, self).get(self, request, *args, **kwargs)
 
+    @method_decorator(retry_on_lock)
     def post(self, request, *args, **kwargs):
         username = self.kwargs.get('username')
         user = self.queryset.filter(username=username)
@@ -536,15 +682,9 @@ class UserView(ViewMixin, generic.DetailView):
 
                     if is_mod(channel, request.user):
 
-                        banned_users = json.loads(channel.banned_users)
-                        banned_users.append(username)
-
-                        moderators = json.loads(channel.banned_users)
-                        moderators = [u for u in moderators if not u == username]
-
-                        channel.banned_users = json.dumps(banned_users)
-                        channel.moderators = json.dumps(moderators)
-                        channel.save()
+                        # a ban replaces any moderator role in the channel
+                        ChannelMembership.objects.update_or_create(channel=channel, user=user, \
+                                defaults={'role': ChannelMembership.BANNED})
 
                     else:
                         raise Http404("Insufficient permissions.")
@@ -566,11 +706,7 @@ class UserView(ViewMixin, generic.DetailView):
 
                     if is_mod(channel, request.user):
 
-                        banned_users = json.loads(channel.banned_users)
-                        banned_users = [u for u in banned_users if not u == username]
-
-                        channel.banned_users = json.dumps(banned_users)
-                        channel.save()
+                        channel.memberships.filter(user=user, role=ChannelMembership.BANNED).delete()
 
                     else:
                         raise Http404("Insufficient permissions.")
@@ -592,14 +728,10 @@ class UserView(ViewMixin, generic.DetailView):
 
                     if is_owner(channel, request.user):
 
-                        if not '"'+username+'"' in channel.banned_users:
-                            moderators = json.loads(channel.moderators)
-                            moderators.append(username)
-
-                            channel.moderators = json.dumps(moderators)
-                            channel.save()
+                        membership, created = ChannelMembership.objects.get_or_create(channel=channel, \
+                                user=user, defaults={'role': ChannelMembership.MODERATOR})
 
-                        else:
+                        if membership.role == ChannelMembership.BANNED:
                             messages.error(request, "Channel-banned users cannot be promoted.")
 
                     else:
@@ -622,11 +754,7 @@ class UserView(ViewMixin, generic.DetailView):
 
                     if is_owner(channel, request.user):
 
-                        moderators = json.loads(channel.moderators)
-                        moderators = [u for u in moderators if not u == username]
-
-                        channel.moderators = json.dumps(moderators)
-                        channel.save()
+                        channel.memberships.filter(user=user, role=ChannelMembership.MODERATOR).delete()
 
                     else:
                         raise Http404("Insufficient permissions.")
@@ -647,39 +775,26 @@ class FavoritesView(ViewMixin, generic.DetailView):
     context_object_name = 'favorites_list'
 
     def get_object(self):
-        if self.request.user.is_authenticated():
-            settings = get_or_create_settings(self.request.user)
-            return self.queryset.filter(channel_name__in=json.loads(settings.favorites))
+        if self.request.user.is_authenticated:
+            if not hasattr(self, 'favorites'):
+                self.favorites = users.defer_owners(self.request, \
+                        self.queryset.filter(favorites__user=self.request.user, hidden_date=None))
+
+            return self.favorites
 
         return self.queryset.none()
 
+    @method_decorator(retry_on_lock)
     def post(self, request, *args, **kwargs):
         if not self.request.user.is_authenticated:
             return HttpResponseRedirect(reverse('forumapp:channel'))
 
         if 'add_favorite' in request.POST:
-            settings = get_or_create_settings(self.request.user)
-            favs = json.loads(settings.favorites)
-            channel_name = request.POST['channel_name']
-
-            if not channel_name in favs:
-                favs.append(channel_name)
-                settings.favorites = json.dumps(favs)
-                settings.save()
-
-            else:
+            if not add_favorite(request.user, request.POST['channel_name']):
                 messages.error(request, "Channel already in favorites")
 
         elif 'remove_favorite' in request.POST:
-            settings = get_or_create_settings(self.request.user)
-            favs = json.loads(settings.favorites)
-            channel_name = request.POST['channel_name']
-
-            if channel_name in favs:
-                favs.remove(channel_name)
-                settings.favorites = json.dumps(favs)
-                settings.save()
-            else:
+            if not remove_favorite(request.user, request.POST['channel_name']):
                 messages.error(request, "Channel not found in favorites")
 
         elif 'pin' in request.POST:
@@ -692,7 +807,7 @@ class FavoritesView(ViewMixin, generic.DetailView):
                 # Require staff status to pin channels
                 if request.user.is_staff:
                     channel.pin_date = timezone.now()
-                    channel.save()
+                    channel.save(update_fields=['pin_date'])
 
         elif 'unpin' in request.POST:
             channel_name = request.POST['channel_name']
@@ -704,6 +819,189 @@ class FavoritesView(ViewMixin, generic.DetailView):
                 # Require staff status to unpin channels
                 if request.user.is_staff:
                     channel.pin_date = None
-                    channel.save()
+                    channel.save(update_fields=['pin_date'])
 
         return HttpResponseRedirect(self.request.path_info)
+
+# New comments in a thread as they are posted, after the cursor in ?after= or
+# the Last-Event-ID header (a comment_id; by default only newer comments).
+# Streams Server-Sent Events, or with ?poll=1 answers a long poll with JSON as
+# soon as there are comments, or empty after FORUM_LIVE_HEARTBEAT seconds.
+class LiveCommentsView(generic.View):
+
+    def get(self, request, *args, **kwargs):
+        permissions = get_channel_permissions(request.user, self.kwargs.get('channel'))
+        thread = permissions.thread(self.kwargs.get('thread'))
+
+        if thread is None:
+            raise Http404("Couldn't find that thread.")
+
+        # the comment page hides the thread from banned users
+        if permissions.is_banned:
+            return HttpResponse("This channel is unavailable.", status=403, content_type='text/plain')
+
+        last = thread.comment_seq - 1
+        cursor = request.GET.get('after') or request.META.get('HTTP_LAST_EVENT_ID')
+
+        try:
+            after = last if cursor is None else int(cursor)
+
+        except ValueError:
+            raise Http404("Invalid cursor.")
+
+        try:
+            subscription = live.hub.subscribe(thread.pk)
+
+        except live.HubFull:
+            response = HttpResponse("Too many listeners, try again later.", status=503, content_type='text/plain')
+            response['Retry-After'] = str(live.get_heartbeat())
+            return response
+
+        if request.GET.get('poll'):
+            with subscription:
+                events = live.poll(subscription, after, live.get_heartbeat())
+
+            return JsonResponse({'comments': events, 'after': events[-1]['comment_id'] if events else after})
+
+        # subscribed first, so nothing posted from here on is missed; what was
+        # posted since the thread was read is caught up from the database
+        last = Thread.objects.filter(pk=thread.pk).values_list('comment_seq', flat=True).first()
+        stream = live.EventStream(subscription, after, caught_up=last is not None and after >= last - 1)
+        response = StreamingHttpResponse(stream, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+
+        return response
+
+# Read-only JSON API (see api.py), answering errors with JSON as well. Hidden
+# channels and threads are missing here too.
+class ApiView(generic.View):
+    http_method_names = ['get', 'head', 'options']
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(ApiView, self).dispatch(request, *args, **kwargs)
+
+        except api.ApiError as e:
+            return api.error(str(e), e.status)
+
+        except Http404 as e:
+            return api.error(str(e), 404)
+
+# A page of channels, in the order of the channel page
+class ChannelApiView(ApiView):
+
+    def get(self, request, *args, **kwargs):
+        channels = Channel.objects.filter(hidden_date=None)
+
+        return api.render(api.read_page(channels, ChannelView.ordering_keys, request.GET))
+
+# A page of a channel's threads, in the order of its thread page; empty for
+# users banned from the channel
+class ThreadApiView(ApiView):
+
+    def get(self, request, *args, **kwargs):
+        permissions = get_channel_permissions(request.user, self.kwargs.get('channel'))
+
+        if not permissions.exists:
+            raise Http404("Couldn't find that channel.")
+
+        threads = Thread.objects.filter(channel_id=permissions.channel_name, hidden_date=None)
+
+        # like the thread page, banned users see none of them
+        if permissions.is_banned:
+            threads = threads.none()
+
+        data = api.read_page(threads, ThreadView.ordering_keys, request.GET)
+        data['permissions'] = api.describe_permissions(request.user, permissions)
+
+        return api.render(data)
+
+# A page of a thread's comments, newest first like its comment page; empty
+# for users banned from the channel
+class CommentApiView(ApiView):
+
+    def get(self, request, *args, **kwargs):
+        permissions = get_channel_permissions(request.user, self.kwargs.get('channel'))
+        thread = permissions.thread(self.kwargs.get('thread'))
+
+        if thread is None:
+            raise Http404("Couldn't find that thread.")
+
+        comments = Comment.objects.filter(thread=thread)
+
+        # like the comment page, banned users see none of them
+        if permissions.is_banned:
+            comments = comments.none()
+
+        data = api.read_page(comments, CommentView.ordering_keys, request.GET)
+        data['permissions'] = api.describe_permissions(request.user, permissions)
+
+        return api.render(data)
+
+# Full-text search over thread names, descriptions and comments
+class SearchView(generic.TemplateView):
+    template_name = 'forumapp/search.html'
+    page_size = 20
+
+    def get_context_data(self, **kwargs):
+        context = super(SearchView, self).get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()
+        channel = self.request.GET.get('channel', '').strip()
+
+        try:
+            page = search.search(query, user=self.request.user, channel=channel or None, \
+                    after=self.request.GET.get('after'), per_page=self.page_size)
+
+        except InvalidCursor:
+            raise Http404("Invalid page.")
+
+        context['query'] = query
+        context['channel'] = channel
+        context['page'] = page
+        return context
+
+# Staff download of a channel (?channel=) or of the whole forum as NDJSON,
+# gzip-compressed with ?gzip=1, resuming after the position in ?after= (see
+# export.py). Rows are read in chunks while the response streams.
+class ExportView(generic.View):
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            raise Http404("Insufficient permissions")
+
+        channel = request.GET.get('channel') or None
+        after = request.GET.get('after')
+
+        if channel is not None and not Channel.objects.filter(pk=channel, hidden_date=None).exists():
+            raise Http404("Couldn't find that channel.")
+
+        try:
+            after = after and export.parse_position(after, channel) or None
+
+        except ValueError:
+            raise Http404("Invalid position.")
+
+        compress = bool(request.GET.get('gzip'))
+        stream = export.ndjson(export.records(channel, after), compress=compress)
+
+        response = StreamingHttpResponse(stream, content_type='application/gzip' if compress else 'application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="%s.ndjson%s"' % (channel or 'forum', '.gz' if compress else '')
+        response['X-Accel-Buffering'] = 'no'
+
+        return response
+
+# Request metrics in the Prometheus text format, for staff or for scrapers
+# sending "Authorization: Bearer <FORUM_METRICS_TOKEN>"
+class MetricsView(generic.View):
+
+    def get(self, request, *args, **kwargs):
+        token = getattr(settings, 'FORUM_METRICS_TOKEN', None)
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        scraper = bool(token) and hmac.compare_digest(header, 'Bearer ' + token)
+
+        if not (request.user.is_staff or scraper):
+            raise Http404("Insufficient permissions")
+
+        return HttpResponse(metrics.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+